@@ -0,0 +1,36 @@
+"""add_files_blob_reference
+
+Revision ID: 9d4f2b7c1e63
+Revises: 0b7d4e9f3a28
+Create Date: 2026-10-18 18:20:44.301937
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d4f2b7c1e63'
+down_revision = '0b7d4e9f3a28'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('files_metadata', sa.Column('blob_sha256', sa.String(length=64), nullable=True))
+    # references were taken by the upload which created the blob and by the deduplicated ones
+    op.execute(
+        """
+        UPDATE files_metadata SET blob_sha256 = sha256
+        WHERE blob_filename IS NOT NULL
+           OR EXISTS (
+               SELECT 1 FROM files_blobs
+               WHERE files_blobs.sha256 = files_metadata.sha256
+                 AND files_blobs.storage_filename = files_metadata.id::text || '.' || files_metadata.extension
+           )
+        """
+    )
+
+
+def downgrade():
+    op.drop_column('files_metadata', 'blob_sha256')
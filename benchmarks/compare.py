@@ -0,0 +1,57 @@
+"""
+Compare two benchmarks.throughput results, exit code 1 if throughput dropped more than --threshold.
+
+    python -m benchmarks.compare benchmarks/results/old.json benchmarks/results/new.json
+"""
+import argparse
+import json
+import sys
+from typing import Dict, Tuple
+
+Key = Tuple[str, int, int, int]
+
+
+def load(path: str) -> Tuple[dict, Dict[Key, dict]]:
+    with open(path) as f:
+        report = json.load(f)
+    results = {
+        (r['phase'], r['file_size'], r['files_per_request'], r['concurrency']): r
+        for r in report['results']
+    }
+    return report, results
+
+
+def change(old, new) -> str:
+    if not old or new is None:
+        return '     -'
+    return f'{(new - old) / old * 100:+6.1f}%'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=10, help='Percent of MB/s drop reported as regression')
+    args = parser.parse_args()
+
+    old_report, old = load(args.old)
+    new_report, new = load(args.new)
+    print(f"{old_report['commit']} -> {new_report['commit']}")
+
+    regressions = 0
+    for key in sorted(old.keys() & new.keys()):
+        phase, size, files, clients = key
+        o, n = old[key], new[key]
+        regression = n['mb_per_s'] < o['mb_per_s'] * (1 - args.threshold / 100)
+        regressions += regression
+        print(
+            f"{phase:<9} size={size:<11} files={files:<3} clients={clients:<3} "
+            f"MB/s {o['mb_per_s']:9.1f} -> {n['mb_per_s']:9.1f} {change(o['mb_per_s'], n['mb_per_s'])}  "
+            f"p99 {change(o['p99_ms'], n['p99_ms'])}  cpu/GB {change(o['cpu_s_per_gb'], n['cpu_s_per_gb'])}"
+            f"{'  REGRESSION' if regression else ''}"
+        )
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+CPU time per GB sent by MediaFileResponse for each way of sending the body.
+
+Ranges can't be sent with pathsend, so with pathsend they are read by chunks.
+The send callable plays the server: chunks are written to /dev/null,
+pathsend and zerocopysend are done with os.sendfile to /dev/null.
+
+    python -m benchmarks.download_cpu --size-mb 512
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import uuid
+
+from src.responses import MediaFileResponse
+
+MODES = {
+    'chunked 64KB': ({}, 64 * 1024),
+    'chunked 1MB': ({}, 1024 * 1024),
+    'pathsend': ({'http.response.pathsend': {}}, None),
+    'zerocopysend': ({'http.response.zerocopysend': {}}, None),
+}
+
+
+def sendfile(out_fd: int, in_fd: int, offset: int, count: int) -> None:
+    while count > 0:
+        sent = os.sendfile(out_fd, in_fd, offset, count)
+        if sent == 0:
+            break
+        offset += sent
+        count -= sent
+
+
+async def download(path: str, extensions: dict, chunk_size: int, byte_range: str = None) -> None:
+    headers = [(b'range', byte_range.encode())] if byte_range else []
+    scope = {'type': 'http', 'method': 'GET', 'headers': headers, 'extensions': extensions}
+    out_fd = os.open(os.devnull, os.O_WRONLY)
+
+    async def send(message):
+        if message['type'] == 'http.response.body':
+            os.write(out_fd, message['body'])
+        elif message['type'] == 'http.response.pathsend':
+            with open(message['path'], 'rb') as f:
+                sendfile(out_fd, f.fileno(), 0, os.fstat(f.fileno()).st_size)
+        elif message['type'] == 'http.response.zerocopysend':
+            sendfile(out_fd, message['file'].fileno(), message['offset'], message['count'])
+
+    response = MediaFileResponse(path, file_id=uuid.uuid4())
+    if chunk_size:
+        response.chunk_size = chunk_size
+    try:
+        await response(scope, None, send)
+    finally:
+        os.close(out_fd)
+
+
+def measure(path: str, size: int, repeat: int, byte_range: str = None) -> dict:
+    results = {}
+    for mode, (extensions, chunk_size) in MODES.items():
+        started_cpu, started = time.process_time(), time.perf_counter()
+        for _ in range(repeat):
+            asyncio.run(download(path, extensions, chunk_size, byte_range))
+        cpu, wall = time.process_time() - started_cpu, time.perf_counter() - started
+        gb = size * repeat / 1024 ** 3
+        results[mode] = {'cpu_s_per_gb': cpu / gb, 'gb_per_s': gb / wall}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=256)
+    parser.add_argument('--repeat', type=int, default=4)
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(os.urandom(1024 * 1024) * args.size_mb)
+        f.flush()
+        for title, byte_range in (('whole file', None), ('range', f'bytes=1024-{size - 1024}')):
+            print(title)
+            for mode, result in measure(f.name, size, args.repeat, byte_range).items():
+                print(f"  {mode:<14} {result['cpu_s_per_gb']:.3f} cpu s/GB  {result['gb_per_s']:.2f} GB/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,421 @@
+"""
+End-to-end upload, download and cleanup throughput of the files app.
+
+The app runs in-process (the ASGI app is called directly, bodies are streamed both ways)
+or under uvicorn with --url. Metadata is kept in memory by default, --db postgres uses DSN__DB.
+Results are written as JSON, compare two runs with benchmarks.compare.
+
+    python -m benchmarks.throughput --sizes 1KB,1MB,64MB,1GB --concurrency 1,8
+    python -m benchmarks.throughput --sizes 4GB --files-per-request 1 --bytes-per-case 8GB
+    python -m benchmarks.throughput --url http://localhost:8000 --server-pid 1234
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import uuid
+from contextlib import AsyncExitStack
+from dataclasses import dataclass, asdict, replace
+from datetime import datetime
+from typing import AsyncIterator, List, Optional, Tuple
+from urllib.parse import urlparse
+
+import httpx
+
+# before the settings are loaded, the app logs every request and the repo is no place for them
+os.environ.setdefault('LOG_DIR', os.path.join(tempfile.gettempdir(), 'files-bench-logs'))
+
+from src.apps.files.services import FilesMetaRepository
+from src.exceptions import RecordNotFound
+from src.settings import settings
+from src.storages.base import FileInfo
+from src.storages.commands.clear_old_files import ClearOldFiles, ClearStats
+from src.storages.registry import STORAGES, LOCAL_STORAGE
+
+BLOCK = os.urandom(1024 * 1024)
+SMALL_BODY = 64 * 1024  # response bodies are kept up to this size, larger ones are only counted
+UNITS = {'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'B': 1}
+
+
+def parse_size(value: str) -> int:
+    value = value.strip().upper()
+    for unit, multiplier in UNITS.items():
+        if value.endswith(unit):
+            return int(float(value[:-len(unit)]) * multiplier)
+    return int(value)
+
+
+class MemoryFilesMetaRepository(FilesMetaRepository):
+    """
+    Metadata in a dict, measures parsing, storages and responses without the database
+    """
+
+    def __init__(self) -> None:
+        self.files = {}
+
+    async def save_files_metadata(self, files: List[FileInfo], replicate: Optional[List[str]] = None):
+        for data in files:
+            # ids are read from the database as UUID
+            self.files[str(data.name)] = replace(data, name=uuid.UUID(str(data.name)))
+
+    async def get_file_metadata(self, id: uuid.UUID) -> FileInfo:
+        try:
+            return self.files[str(id)]
+        except KeyError:
+            raise RecordNotFound(id, 'File')
+
+    async def delete_files(self, ids: List[uuid.UUID]) -> List[str]:
+        return [self.files.pop(str(id)).storage_filename for id in ids if str(id) in self.files]
+
+
+class ProcessStats:
+    """
+    CPU time and peak RSS of the process serving requests, from /proc
+    """
+
+    def __init__(self, pid: int) -> None:
+        self.pid = pid
+
+    def cpu_time(self) -> float:
+        if self.pid == os.getpid():
+            return time.process_time()
+        with open(f'/proc/{self.pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    def peak_rss(self) -> int:
+        with open(f'/proc/{self.pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def reset_peak_rss(self) -> None:
+        try:
+            with open(f'/proc/{self.pid}/clear_refs', 'w') as f:
+                f.write('5')
+        except OSError:
+            # not permitted for other processes
+            pass
+
+
+class InProcessClient:
+    """
+    Calls the ASGI app directly, the response body is counted instead of being collected
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def request(
+            self, method: str, path: str, headers: List[Tuple[str, str]] = (), body: AsyncIterator[bytes] = None
+    ) -> Tuple[int, bytes, int]:
+        url = urlparse(path)
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': method,
+            'scheme': 'http',
+            'path': url.path,
+            'raw_path': url.path.encode(),
+            'query_string': url.query.encode(),
+            'root_path': '',
+            'headers': [(b'host', b'testserver')] + [(k.lower().encode(), v.encode()) for k, v in headers],
+            'server': ('testserver', 80),
+            'client': ('127.0.0.1', 12345),
+        }
+        chunks = body.__aiter__() if body is not None else None
+        status = 0
+        received = 0
+        content = bytearray()
+
+        async def receive():
+            if chunks is None:
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+            try:
+                return {'type': 'http.request', 'body': await chunks.__anext__(), 'more_body': True}
+            except StopAsyncIteration:
+                return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            nonlocal status, received
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                received += len(message.get('body', b''))
+                if len(content) < SMALL_BODY:
+                    content.extend(message.get('body', b''))
+
+        await self.app(scope, receive, send)
+        return status, bytes(content), received
+
+    async def close(self) -> None:
+        pass
+
+
+class HttpClient:
+    def __init__(self, url: str, connections: int) -> None:
+        self.client = httpx.AsyncClient(
+            base_url=url,
+            timeout=None,
+            limits=httpx.Limits(max_connections=connections, max_keepalive_connections=connections),
+        )
+
+    async def request(
+            self, method: str, path: str, headers: List[Tuple[str, str]] = (), body: AsyncIterator[bytes] = None
+    ) -> Tuple[int, bytes, int]:
+        content = bytearray()
+        received = 0
+        async with self.client.stream(method, path, headers=list(headers), content=body) as response:
+            async for chunk in response.aiter_raw():
+                received += len(chunk)
+                if len(content) < SMALL_BODY:
+                    content.extend(chunk)
+        return response.status_code, bytes(content), received
+
+    async def close(self) -> None:
+        await self.client.aclose()
+
+
+async def multipart_body(boundary: str, field_name: str, sizes: List[int]) -> AsyncIterator[bytes]:
+    for i, size in enumerate(sizes):
+        yield (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="{field_name}"; filename="file{i}.bin"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'
+        ).encode()
+        remaining = size
+        while remaining > 0:
+            chunk = BLOCK[:min(len(BLOCK), remaining)]
+            remaining -= len(chunk)
+            yield chunk
+        yield b'\r\n'
+    yield f'--{boundary}--\r\n'.encode()
+
+
+@dataclass
+class PhaseResult:
+    phase: str
+    file_size: int
+    files_per_request: int
+    concurrency: int
+    requests: int
+    errors: int
+    bytes: int
+    seconds: float
+    mb_per_s: float
+    p50_ms: Optional[float]
+    p99_ms: Optional[float]
+    cpu_s_per_gb: Optional[float]
+    peak_rss_mb: Optional[float]
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, math.ceil(q * len(values)) - 1)] * 1000
+
+
+class Benchmark:
+    def __init__(self, client, stats: Optional[ProcessStats], repo: Optional[MemoryFilesMetaRepository]) -> None:
+        self.client = client
+        self.stats = stats
+        self.repo = repo
+
+    async def measure(self, phase: str, jobs: List, run_job, concurrency: int, meta: dict) -> PhaseResult:
+        """
+        run_job(job) -> (ok, bytes)
+        """
+        queue = list(reversed(jobs))
+        latencies = []
+        totals = {'bytes': 0, 'errors': 0}
+
+        async def worker():
+            while queue:
+                job = queue.pop()
+                started = time.perf_counter()
+                ok, transferred = await run_job(job)
+                latencies.append(time.perf_counter() - started)
+                totals['bytes'] += transferred
+                totals['errors'] += not ok
+
+        if self.stats is not None:
+            self.stats.reset_peak_rss()
+            cpu_started = self.stats.cpu_time()
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        seconds = time.perf_counter() - started
+        gb = totals['bytes'] / 1024 ** 3
+
+        cpu_s_per_gb = peak_rss_mb = None
+        if self.stats is not None:
+            if gb:
+                cpu_s_per_gb = (self.stats.cpu_time() - cpu_started) / gb
+            peak_rss_mb = self.stats.peak_rss() / 1024 ** 2
+        return PhaseResult(
+            phase=phase,
+            requests=len(jobs),
+            errors=totals['errors'],
+            bytes=totals['bytes'],
+            seconds=seconds,
+            mb_per_s=totals['bytes'] / 1024 ** 2 / seconds if seconds else 0,
+            p50_ms=percentile(latencies, 0.5),
+            p99_ms=percentile(latencies, 0.99),
+            cpu_s_per_gb=cpu_s_per_gb,
+            peak_rss_mb=peak_rss_mb,
+            concurrency=concurrency,
+            **meta,
+        )
+
+    async def upload(self, sizes: List[int]) -> Tuple[bool, int, List[str]]:
+        boundary = uuid.uuid4().hex
+        batch = len(sizes) > 1
+        status, content, _ = await self.client.request(
+            'POST',
+            '/files/upload/batch' if batch else '/files/upload',
+            headers=[('content-type', f'multipart/form-data; boundary={boundary}')],
+            body=multipart_body(boundary, 'files' if batch else 'file', sizes),
+        )
+        if status != 200:
+            return False, 0, []
+        data = json.loads(content)
+        uris = [file['uri'] for file in data['files']] if batch else [data['uri']]
+        return True, sum(sizes), [os.path.basename(urlparse(uri).path) for uri in uris]
+
+    async def download(self, file_id: str) -> Tuple[bool, int]:
+        # uris point to the web server location, the app serves the same files under /files
+        status, _, received = await self.client.request('GET', f'/files/{settings.MEDIA_ROOT}/{file_id}')
+        return status == 200, received
+
+    async def cleanup(self, file_ids: List[str], file_size: int, concurrency: int, meta: dict) -> PhaseResult:
+        command = ClearOldFiles([STORAGES[LOCAL_STORAGE]])
+        command.semaphore = asyncio.Semaphore(concurrency)
+        ids = [uuid.UUID(file_id) for file_id in file_ids]
+        chunks = [ids[i:i + command.CHUNK_SIZE] for i in range(0, len(ids), command.CHUNK_SIZE)]
+
+        async def delete_chunk(chunk: List[uuid.UUID]) -> Tuple[bool, int]:
+            stats = ClearStats()
+            if self.repo is not None:
+                await command.delete_from_storages(await self.repo.delete_files(chunk), stats)
+            else:
+                await command.delete_expired(chunk, stats)
+            return stats.missing_in_storages == 0, stats.deleted_from_storages * file_size
+
+        # chunks are deleted one by one, files of a chunk concurrently
+        result = await self.measure('cleanup', chunks, delete_chunk, 1, meta)
+        result.concurrency = concurrency
+        return result
+
+    async def run_case(
+            self, file_size: int, files_per_request: int, concurrency: int, total_bytes: int, max_requests: int
+    ):
+        meta = {'file_size': file_size, 'files_per_request': files_per_request}
+        requests = max(concurrency, min(max_requests, math.ceil(total_bytes / (file_size * files_per_request))))
+        file_ids = []
+
+        async def upload_job(sizes):
+            ok, transferred, uploaded = await self.upload(sizes)
+            file_ids.extend(uploaded)
+            return ok, transferred
+
+        results = [await self.measure(
+            'upload', [[file_size] * files_per_request] * requests, upload_job, concurrency, meta
+        )]
+        results.append(await self.measure('download', list(file_ids), self.download, concurrency, meta))
+        if self.stats is not None and os.getpid() == self.stats.pid:
+            # cleanup is run by this process, it can't delete files of a remote server
+            results.append(await self.cleanup(file_ids, file_size, concurrency, meta))
+        return results
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> dict:
+    async with AsyncExitStack() as stack:
+        repo = None
+        if args.url:
+            client = HttpClient(args.url, max(args.concurrency))
+            stats = ProcessStats(args.server_pid) if args.server_pid else None
+        else:
+            from src.main import app
+
+            upload_dir = args.upload_dir or stack.enter_context(tempfile.TemporaryDirectory(prefix='files-bench-'))
+            settings.UPLOAD_DIR = upload_dir
+            if args.db == 'memory':
+                repo = MemoryFilesMetaRepository()
+                app.dependency_overrides[FilesMetaRepository] = lambda: repo
+            else:
+                await stack.enter_async_context(app.router.lifespan_context(app))
+            client = InProcessClient(app)
+            stats = ProcessStats(os.getpid())
+        stack.push_async_callback(client.close)
+
+        benchmark = Benchmark(client, stats, repo)
+        results = []
+        for file_size in args.sizes:
+            for files_per_request in args.files_per_request:
+                for concurrency in args.concurrency:
+                    case = await benchmark.run_case(
+                        file_size, files_per_request, concurrency, args.bytes_per_case, args.max_requests
+                    )
+                    for result in case:
+                        print(
+                            f'{result.phase:<9} size={file_size:<11} files={files_per_request:<3} '
+                            f'clients={concurrency:<3} {result.mb_per_s:10.1f} MB/s  '
+                            f'p50={result.p50_ms or 0:9.1f} ms  p99={result.p99_ms or 0:9.1f} ms  '
+                            f'cpu={result.cpu_s_per_gb or 0:6.2f} s/GB  errors={result.errors}',
+                            flush=True,
+                        )
+                    results.extend(case)
+
+    return {
+        'commit': git_commit(),
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'mode': args.url or f'in-process, {args.db} metadata',
+        'results': [asdict(result) for result in results],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1KB,1MB,64MB', type=lambda v: [parse_size(s) for s in v.split(',')])
+    parser.add_argument('--files-per-request', default='1,10', type=lambda v: [int(n) for n in v.split(',')])
+    parser.add_argument('--concurrency', default='1,8', type=lambda v: [int(n) for n in v.split(',')])
+    parser.add_argument('--bytes-per-case', default='256MB', type=parse_size,
+                        help='Upload at least this much per case, at least one request per client')
+    parser.add_argument('--max-requests', type=int, default=500, help='Upload requests per case for small files')
+    parser.add_argument('--db', choices=('memory', 'postgres'), default='memory')
+    parser.add_argument('--url', help='Benchmark a running server instead of the app in this process')
+    parser.add_argument('--server-pid', type=int, help='Pid of the --url server for CPU and RSS')
+    parser.add_argument('--upload-dir', help='UPLOAD_DIR of the in-process app, a temporary directory by default')
+    parser.add_argument('--output', help='JSON file, benchmarks/results/<time>-<commit>.json by default')
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    output = args.output or os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        'results',
+        f"{datetime.now():%Y%m%d-%H%M%S}-{report['commit'] or 'unknown'}.json",
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results are written to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import asyncio
+from datetime import datetime, timezone
+from typing import Dict, Optional
+from uuid import UUID
+
+from src.apps.files.services import FilesMetaRepository
+from src.db import get_db
+from src.logging import logger
+from src.settings import settings
+
+
+class AccessRecorder:
+    """
+    Coalesce file accesses in memory and write them with one bulk update per flush,
+    so a hot file costs one row update per flush interval instead of one per download
+    """
+
+    def __init__(self, flush_interval: float, max_size: int) -> None:
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self._pending: Dict[UUID, datetime] = {}
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def record(self, id: UUID) -> None:
+        self._pending[id] = datetime.now(timezone.utc)
+        if len(self._pending) >= self.max_size:
+            self._full.set()
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f'Unable to save file accesses: {e}')
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f'Unable to save file accesses: {e}')
+                # the buffer stays full while the database is unavailable
+                await asyncio.sleep(self.flush_interval)
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            async for session in get_db():
+                await FilesMetaRepository(session).update_last_accessed(pending)
+        except BaseException:
+            # saved with the next flush, accesses recorded meanwhile are newer
+            self._pending = {**pending, **self._pending}
+            raise
+
+
+access_recorder = AccessRecorder(
+    flush_interval=settings.ACCESS_FLUSH_INTERVAL,
+    max_size=settings.ACCESS_BUFFER_SIZE,
+)
@@ -1,6 +1,6 @@
 import uuid
 
-from sqlalchemy import Column, BigInteger, String
+from sqlalchemy import Column, BigInteger, String, Integer, DateTime, Boolean, func, true
 from sqlalchemy.dialects.postgresql import UUID
 
 from src.db import Base
@@ -14,3 +14,60 @@ class FileMetadata(Base):
     file_format = Column(String)
     original_filename = Column(String, nullable=False)
     extension = Column(String)
+    sha256 = Column(String(64), index=True)
+    blob_filename = Column(String)
+    # set when the row took a reference to FileBlob, sha256 alone is stored without deduplication too
+    blob_sha256 = Column(String(64))
+    content_encoding = Column(String)
+    created_at = Column(DateTime, nullable=False, server_default=func.now(), index=True)
+    last_accessed_at = Column(DateTime, nullable=False, server_default=func.now(), index=True)
+    # False while a direct upload to the cloud storage is not completed
+    uploaded = Column(Boolean, nullable=False, server_default=true())
+
+
+class FileBlob(Base):
+    """
+    Content stored once for all uploads with the same sha256
+    """
+    __tablename__ = 'files_blobs'
+
+    sha256 = Column(String(64), primary_key=True)
+    storage_filename = Column(String, nullable=False)
+    size = Column(BigInteger, nullable=False)
+    content_encoding = Column(String)
+    ref_count = Column(Integer, nullable=False, default=1)
+
+
+class UploadSession(Base):
+    """
+    Partial resumable upload, FileMetadata is created on finalize
+    """
+    __tablename__ = 'files_upload_sessions'
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    size = Column(BigInteger, nullable=False)
+    offset = Column(BigInteger, nullable=False, default=0)
+    original_filename = Column(String, nullable=False)
+    extension = Column(String)
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+    updated_at = Column(DateTime, nullable=False, server_default=func.now(), index=True)
+    # a request receives the content until then, see UploadSessionsRepository.claim_session
+    locked_until = Column(DateTime)
+
+    @property
+    def storage_filename(self):
+        return f'{self.id}.{self.extension}'
+
+
+class ReplicationJob(Base):
+    """
+    Outbox of files to copy to the cloud storage, written with the metadata
+    """
+    __tablename__ = 'files_replication_jobs'
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    storage_filename = Column(String, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(String)
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+    available_at = Column(DateTime, nullable=False, server_default=func.now(), index=True)
@@ -1,21 +1,94 @@
-from typing import Tuple
+import os
+import time
+from datetime import timedelta
+from typing import BinaryIO, Tuple, List, Optional, Literal
 from uuid import UUID
 
-from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks, status, Request, UploadFile
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks, status, Request, UploadFile, Header, Response, Query
+from fastapi.responses import RedirectResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import ClientDisconnect
 
-from src.storages.base import BaseStorage
+from src.storages.base import BaseStorage, FileInfo, FileStream, get_mime_by_format
+from src.storages.cloud import CloudStorage
+from src.storages.cloud_cache import Fetch, cloud_cache
+from src.storages.local import LocalStorage
 from src.storages.registry import get_storage, CLOUD_STORAGE
+from src.storages.space import InsufficientStorage, space_ledger
 from src.settings import settings
-from .services import FilesMetaRepository
-from .schemas import UploadFileResponseSchema
-from src.exceptions import RecordNotFound
-from src.logging import logger
-from src.utils import parse_files_from_request
+from src.responses import (
+    MediaFileResponse,
+    OffloadFileResponse,
+    DecodedFileResponse,
+    StorageFileResponse,
+    RangeNotSatisfiable,
+    parse_range_header,
+)
+from src.storages.compression import accepts_encoding
+from src.derivatives import derivative_cache, IMAGE_FORMATS, RenderFailed
+from .access import access_recorder
+from .models import UploadSession
+from .services import FilesMetaRepository, UploadSessionsRepository
+from .schemas import (
+    UploadFileResponseSchema,
+    UploadFilesResponseSchema,
+    CreateUploadSchema,
+    UploadSessionSchema,
+    DirectUploadSchema,
+    CompleteDirectUploadSchema,
+)
+from src.exceptions import RecordNotFound, RecordLocked
+from src.logging import log_limited, logger
+from src.parsers import get_content_length
+from src.utils import files_from_request, limit_stream
 
 router = APIRouter(prefix='/files')
 
 
+def schedule_copy(files: List[str], background_tasks: BackgroundTasks, copy_storage: BaseStorage) -> List[str]:
+    """
+    Returns storage filenames to be saved to the replication outbox with the metadata,
+    or copies the files in background tasks if the outbox is disabled
+    """
+    if not files:
+        return []
+    if settings.REPLICATION_OUTBOX:
+        return [os.path.basename(file) for file in files]
+    background_tasks.add_task(copy_storage.upload_files, files=files)
+    return []
+
+
+async def save_uploaded_files(
+    files: Tuple[UploadFile, ...],
+    background_tasks: BackgroundTasks,
+    storage: BaseStorage,
+    copy_storage: BaseStorage,
+    file_meta_repo: FilesMetaRepository,
+) -> List[FileInfo]:
+    """
+    Save metadata of the parsed files in one transaction and schedule their copy to the copy_storage
+    """
+    files_metadata = []
+    files_to_copy = []
+    for file in files:
+        metadata = storage.get_metadata(file)
+        if settings.DEDUPLICATE_UPLOADS and metadata.sha256:
+            blob_filename, content_encoding = await file_meta_repo.register_blob(metadata)
+            metadata.blob_sha256 = metadata.sha256
+            if blob_filename != metadata.storage_filename:
+                # the content is already stored (and copied), keep only the reference
+                await storage.delete(metadata.storage_filename)
+                metadata.blob_filename = blob_filename
+                metadata.content_encoding = content_encoding
+        if not metadata.blob_filename:
+            files_to_copy.append(file.file.name)
+        files_metadata.append(metadata)
+
+    replicate = schedule_copy(files_to_copy, background_tasks, copy_storage)
+    await file_meta_repo.save_files_metadata(files_metadata, replicate=replicate)
+    return files_metadata
+
+
 @router.post(
     '/upload',
     responses={
@@ -51,25 +124,473 @@ async def upload_file(
     storage: BaseStorage = Depends(get_storage()),
     copy_storage: BaseStorage = Depends(get_storage(CLOUD_STORAGE)),
     file_meta_repo: FilesMetaRepository = Depends(),
-    files: Tuple[UploadFile] = Depends(parse_files_from_request)
+    files: Tuple[UploadFile] = Depends(files_from_request(max_files=1))
 ):
     """
     Write directly to file, instead of using tempfiles for optimization
     """
-    file = files[0]
-    metadata = storage.get_metadata(file)
-    background_tasks.add_task(copy_storage.upload_file, file=file.file.name)
-    await file_meta_repo.save_file_metadata(metadata)
+    metadata, = await save_uploaded_files(files[:1], background_tasks, storage, copy_storage, file_meta_repo)
+    return {'uri': storage.get_file_url(request, str(metadata.name))}
+
+
+@router.post(
+    '/upload/batch',
+    responses={
+        201: {'model': UploadFilesResponseSchema},
+    },
+    response_model=UploadFilesResponseSchema,
+    openapi_extra={
+        "requestBody": {
+            "content": {
+                "multipart/form-data": {
+                    "schema": {
+                        "properties": {
+                          "files": {
+                            "type": "array",
+                            "items": {
+                              "type": "string",
+                              "format": "binary"
+                            },
+                            "title": "Files"
+                          },
+                        },
+                        "type": "object",
+                        "required": [
+                          "files"
+                        ],
+                        "title": "Body_upload_files_files_upload_batch_post"
+                      }
+                }
+            },
+            "required": True
+        }}
+)
+async def upload_files(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    storage: BaseStorage = Depends(get_storage()),
+    copy_storage: BaseStorage = Depends(get_storage(CLOUD_STORAGE)),
+    file_meta_repo: FilesMetaRepository = Depends(),
+    files: Tuple[UploadFile] = Depends(files_from_request(max_files=settings.MAX_FILES_PER_UPLOAD))
+):
+    """
+    Upload several files in one request, uris are returned in the order of the files
+    """
+    files_metadata = await save_uploaded_files(files, background_tasks, storage, copy_storage, file_meta_repo)
+    return {'files': [{'uri': storage.get_file_url(request, str(metadata.name))} for metadata in files_metadata]}
+
+
+async def get_upload_session(
+    uploads_repo: UploadSessionsRepository, uuid: UUID, lock: bool = False, lease: Optional[timedelta] = None
+) -> UploadSession:
+    try:
+        if lease is not None:
+            return await uploads_repo.claim_session(uuid, lease)
+        return await uploads_repo.get_session(uuid, lock=lock)
+    except RecordNotFound:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'Upload with id {uuid} not found')
+    except RecordLocked:
+        raise HTTPException(status_code=status.HTTP_423_LOCKED, detail=f'Upload with id {uuid} is in progress')
+
+
+@router.post('/uploads', status_code=status.HTTP_201_CREATED, response_model=UploadSessionSchema)
+async def create_upload(
+    data: CreateUploadSchema,
+    storage: BaseStorage = Depends(get_storage()),
+    uploads_repo: UploadSessionsRepository = Depends(),
+):
+    """
+    Start resumable upload, then send the content with PATCH and finalize the upload
+    """
+    original_filename, extension = storage.splitext(data.filename)
+    upload = await uploads_repo.create_session(original_filename, extension, data.size)
+    return {'id': upload.id, 'size': upload.size, 'offset': upload.offset}
+
+
+@router.head('/uploads/{uuid}')
+async def get_upload_offset(uuid: UUID, uploads_repo: UploadSessionsRepository = Depends()):
+    upload = await get_upload_session(uploads_repo, uuid)
+    return Response(headers={
+        'Upload-Offset': str(upload.offset),
+        'Upload-Length': str(upload.size),
+        'Cache-Control': 'no-store',
+    })
+
+
+@router.patch('/uploads/{uuid}', status_code=status.HTTP_204_NO_CONTENT)
+async def upload_chunk(
+    request: Request,
+    uuid: UUID,
+    upload_offset: int = Header(),
+    storage: LocalStorage = Depends(get_storage()),
+    uploads_repo: UploadSessionsRepository = Depends(),
+):
+    """
+    Append the body to the upload at Upload-Offset, the offset must match the current one (HEAD)
+    """
+    if request.headers.get('content-type') != 'application/offset+octet-stream':
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail='Content-Type must be application/offset+octet-stream'
+        )
+
+    lease = timedelta(seconds=settings.UPLOAD_SESSION_LEASE)
+    upload = await get_upload_session(uploads_repo, uuid, lease=lease)
+    offset = upload.offset
+    try:
+        if upload.offset != upload_offset:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f'Upload-Offset {upload_offset} does not match current offset {upload.offset}'
+            )
+
+        try:
+            # this request carries Content-Length bytes, chunked uploads don't hold the rest of the upload
+            size = upload.size - upload.offset
+            content_length = get_content_length(request.headers)
+            if content_length is not None:
+                size = min(content_length, size)
+            reservation = space_ledger.reserve(size)
+        except InsufficientStorage as e:
+            raise HTTPException(status_code=e.status_code, detail=e.message)
+
+        stream = limit_stream(request.stream(), upload.size - upload.offset)
+        renew_at = time.monotonic() + settings.UPLOAD_SESSION_LEASE / 3
+        with reservation:
+            try:
+                async for written in storage.write_stream(upload.storage_filename, stream, offset):
+                    reservation.consume(written - offset)
+                    offset = written
+                    if time.monotonic() >= renew_at:
+                        await uploads_repo.renew_lease(upload.id, upload.offset, lease)
+                        renew_at = time.monotonic() + settings.UPLOAD_SESSION_LEASE / 3
+            except ClientDisconnect:
+                # keep what is received, the client resumes from the saved offset
+                logger.info(f'Upload {uuid} interrupted at offset {offset}')
+    finally:
+        saved = await uploads_repo.set_offset(upload.id, upload.offset, offset)
+
+    if not saved:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f'Upload with id {uuid} was changed by another request'
+        )
+    return Response(status_code=status.HTTP_204_NO_CONTENT, headers={'Upload-Offset': str(offset)})
+
+
+@router.post(
+    '/uploads/{uuid}/finalize',
+    status_code=status.HTTP_201_CREATED,
+    response_model=UploadFileResponseSchema
+)
+async def finalize_upload(
+    request: Request,
+    uuid: UUID,
+    background_tasks: BackgroundTasks,
+    storage: BaseStorage = Depends(get_storage()),
+    copy_storage: BaseStorage = Depends(get_storage(CLOUD_STORAGE)),
+    uploads_repo: UploadSessionsRepository = Depends(),
+    file_meta_repo: FilesMetaRepository = Depends(),
+):
+    upload = await get_upload_session(uploads_repo, uuid, lock=True)
+    if upload.offset != upload.size:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f'Upload is not complete, received {upload.offset} of {upload.size} bytes'
+        )
+
+    try:
+        upload_path = storage.get_upload_path(upload.storage_filename, check_exists=True)
+    except FileNotFoundError:
+        # reclaimed or lost, the upload can't be completed anymore
+        await uploads_repo.delete_session(upload)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'Content of upload {uuid} not found')
+    metadata = FileInfo(
+        size=upload.size,
+        name=upload.id,
+        file_format=await run_in_threadpool(storage.get_path_format, upload_path),
+        original_filename=upload.original_filename,
+        extension=upload.extension,
+    )
+    await uploads_repo.delete_session(upload, commit=False)
+    replicate = schedule_copy([upload_path], background_tasks, copy_storage)
+    await file_meta_repo.save_file_metadata(metadata, replicate=replicate)
     return {'uri': storage.get_file_url(request, str(metadata.name))}
 
 
-if settings.RETURN_FILES_LOCALLY:
+@router.post('/direct-uploads', status_code=status.HTTP_201_CREATED, response_model=DirectUploadSchema)
+async def create_direct_upload(
+    data: CreateUploadSchema,
+    storage: CloudStorage = Depends(get_storage(CLOUD_STORAGE)),
+    file_meta_repo: FilesMetaRepository = Depends(),
+):
+    """
+    Reserve a file and return presigned urls to upload it directly to the cloud storage,
+    then complete the upload
+    """
+    original_filename, extension = storage.splitext(data.filename)
+    metadata = FileInfo(
+        size=data.size,
+        name=storage.generate_stem(),
+        original_filename=original_filename,
+        extension=extension,
+    )
+    await file_meta_repo.reserve_file(metadata)
+    if data.size >= settings.S3_MULTIPART_THRESHOLD:
+        upload_id, part_size, part_urls = await storage.create_presigned_multipart_upload(
+            metadata.storage_filename, data.size
+        )
+        return {'id': metadata.name, 'upload_id': upload_id, 'part_size': part_size, 'part_urls': part_urls}
+    return {'id': metadata.name, 'url': await storage.generate_upload_url(metadata.storage_filename)}
+
+
+@router.post('/direct-uploads/{uuid}/complete', response_model=UploadFileResponseSchema)
+async def complete_direct_upload(
+    request: Request,
+    uuid: UUID,
+    data: CompleteDirectUploadSchema,
+    storage: CloudStorage = Depends(get_storage(CLOUD_STORAGE)),
+    file_meta_repo: FilesMetaRepository = Depends(),
+):
+    """
+    Size and format are taken from the uploaded object, not from the reservation
+    """
+    try:
+        metadata = await file_meta_repo.get_reserved_file(uuid)
+    except RecordNotFound:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'Upload with id {uuid} not found')
+
+    try:
+        if data.upload_id:
+            await storage.complete_multipart_upload(
+                metadata.storage_filename,
+                data.upload_id,
+                [(part.part_number, part.etag) for part in data.parts],
+            )
+        size, file_format = await storage.get_object_info(metadata.storage_filename)
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=f'File {uuid} is not uploaded')
+    except Exception as e:
+        raise cloud_unavailable(metadata, e)
+
+    if settings.ALLOWED_FILE_FORMATS is not None and file_format not in settings.ALLOWED_FILE_FORMATS:
+        await storage.delete(metadata.storage_filename)
+        await file_meta_repo.delete_reserved_file(uuid)
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail=f'File format {file_format} is not allowed'
+        )
+
+    await file_meta_repo.confirm_file(uuid, size, file_format)
+    return {'uri': str(request.url_for('get_cloud_file', uuid=uuid))}
+
+
+@router.get('/cloud/{uuid}')
+async def get_cloud_file(
+    uuid: UUID,
+    storage: CloudStorage = Depends(get_storage(CLOUD_STORAGE)),
+    files_repo: FilesMetaRepository = Depends(),
+):
+    """
+    Redirect to a presigned url of the file in the cloud storage
+    """
+    try:
+        metadata = await files_repo.get_file_metadata(uuid)
+    except RecordNotFound:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'File with id {uuid} not found')
+
+    access_recorder.record(metadata.name)
+    url = await storage.generate_download_url(
+        metadata.storage_filename,
+        filename=metadata.download_filename,
+        content_encoding=metadata.content_encoding,
+    )
+    return RedirectResponse(url, status_code=status.HTTP_307_TEMPORARY_REDIRECT, headers={'Cache-Control': 'no-store'})
+
+
+async def get_derivative(
+    upload_path: str, metadata: FileInfo, width: Optional[int], file_format: Optional[str]
+) -> MediaFileResponse:
+    if metadata.file_format not in IMAGE_FORMATS:
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail=f'Unable to resize file of format {metadata.file_format}'
+        )
+    try:
+        path = await derivative_cache.get(upload_path, metadata.name, width, file_format or metadata.file_format)
+    except RenderFailed as e:
+        log_limited('WARNING', 'render_failed', f'Unable to render derivative of {metadata.name}: {e}')
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail='Unable to render the image')
+    return MediaFileResponse(path, file_id=metadata.name)
+
+
+def file_not_found(metadata: FileInfo) -> HTTPException:
+    log_limited(
+        'WARNING', 'file_not_found',
+        f'A file record with id {metadata.name} exists in the database, but the file itself does not exist'
+    )
+    return HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail=f'File with id {metadata.name} not found'
+    )
+
+
+def cloud_unavailable(metadata: FileInfo, error: Exception) -> HTTPException:
+    log_limited(
+        'ERROR', 'cloud_unavailable',
+        f'Unable to get {metadata.storage_filename} from the cloud storage: {error!r}'
+    )
+    return HTTPException(
+        status_code=status.HTTP_502_BAD_GATEWAY,
+        detail=f'File with id {metadata.name} is temporarily unavailable'
+    )
+
+
+def encoding_headers(metadata: FileInfo) -> Optional[dict]:
+    if metadata.content_encoding:
+        return {'content-encoding': metadata.content_encoding, 'vary': 'Accept-Encoding'}
+    return None
+
+
+def file_response(
+    path: str,
+    metadata: FileInfo,
+    accept_encoding: Optional[str],
+    offload: bool = bool(settings.FILES_OFFLOAD_HEADER),
+    file: Optional[BinaryIO] = None,
+) -> Response:
+    if metadata.content_encoding and not accepts_encoding(accept_encoding, metadata.content_encoding):
+        return DecodedFileResponse(
+            path if file is None else file,
+            metadata.content_encoding,
+            media_type=get_mime_by_format(metadata.file_format),
+        )
+    headers = encoding_headers(metadata)
+
+    # nginx doesn't keep Content-Encoding of an X-Accel-Redirect response, encoded files are sent by the app
+    if offload and not headers:
+        return OffloadFileResponse(
+            path,
+            root=settings.UPLOAD_DIR,
+            header=settings.FILES_OFFLOAD_HEADER,
+            filename=metadata.download_filename,
+            media_type=get_mime_by_format(metadata.file_format),
+        )
+    return MediaFileResponse(path, file_id=metadata.name, headers=headers, file=file)
+
+
+async def get_cached_cloud_file(
+    metadata: FileInfo, accept_encoding: Optional[str], width: Optional[int], file_format: Optional[str]
+) -> Response:
+    """
+    A file missing locally is fetched from the cloud storage into the cache and streamed while it is fetched
+    """
+    try:
+        cached = await cloud_cache.get(metadata.storage_filename)
+    except FileNotFoundError:
+        raise file_not_found(metadata)
+    except Exception as e:
+        raise cloud_unavailable(metadata, e)
+
+    access_recorder.record(metadata.name)
+    if isinstance(cached, Fetch):
+        encoded = metadata.content_encoding and not accepts_encoding(accept_encoding, metadata.content_encoding)
+        body = cached.open_reader() if width is None and file_format is None and not encoded else None
+        if body is not None:
+            return StorageFileResponse(
+                FileStream(body, cached.size, cached.size),
+                file_id=metadata.name,
+                media_type=get_mime_by_format(metadata.file_format),
+                headers=encoding_headers(metadata),
+            )
+        # the whole file is needed
+        try:
+            cached = await cached.wait()
+        except FileNotFoundError:
+            raise file_not_found(metadata)
+        except Exception as e:
+            raise cloud_unavailable(metadata, e)
+
+    if width is not None or file_format is not None:
+        with cached:
+            return await get_derivative(cached.name, metadata, width, file_format)
+    # the cache is outside of the location of the web server, the response sends and closes the opened file
+    return file_response(cached.name, metadata, accept_encoding, offload=False, file=cached)
+
+
+async def get_cloud_file_stream(
+    cloud_storage: BaseStorage,
+    metadata: FileInfo,
+    accept_encoding: Optional[str],
+    byte_range: Optional[Tuple[int, int]],
+) -> Response:
+    """
+    Proxy the file from the cloud storage, the first bytes are sent as soon as the cloud responds
+    """
+    try:
+        stream = await cloud_storage.stream_file(metadata.storage_filename, byte_range)
+    except FileNotFoundError:
+        raise file_not_found(metadata)
+    except Exception as e:
+        raise cloud_unavailable(metadata, e)
+
+    access_recorder.record(metadata.name)
+    media_type = get_mime_by_format(metadata.file_format)
+    if metadata.content_encoding and not accepts_encoding(accept_encoding, metadata.content_encoding):
+        return DecodedFileResponse(stream.chunks, metadata.content_encoding, media_type=media_type)
+    return StorageFileResponse(
+        stream, file_id=metadata.name, byte_range=byte_range, media_type=media_type, headers=encoding_headers(metadata)
+    )
+
+
+async def get_missing_file(
+    cloud_storage: BaseStorage,
+    metadata: FileInfo,
+    accept_encoding: Optional[str],
+    range_header: Optional[str],
+    width: Optional[int],
+    file_format: Optional[str],
+) -> Response:
+    """
+    A file missing locally is read from the cloud storage: a byte range is proxied,
+    whole files go through the cache, or are proxied too if the cache is disabled
+    """
+    derivative = width is not None or file_format is not None
+    byte_range = None
+    if range_header and not metadata.content_encoding and not derivative:
+        try:
+            ranges = parse_range_header(range_header, metadata.size)
+        except RangeNotSatisfiable:
+            return Response(
+                status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                headers={'content-range': f'bytes */{metadata.size}'},
+            )
+        if len(ranges) == 1:
+            byte_range, = ranges
+
+    if byte_range is None and settings.CLOUD_CACHE_SIZE:
+        return await get_cached_cloud_file(metadata, accept_encoding, width, file_format)
+    if derivative:
+        # derivatives are rendered from local files only
+        raise file_not_found(metadata)
+    return await get_cloud_file_stream(cloud_storage, metadata, accept_encoding, byte_range)
+
+
+if settings.RETURN_FILES_LOCALLY or settings.FILES_OFFLOAD_HEADER:
     @router.get(f'/{settings.MEDIA_ROOT}/{{uuid}}')
     async def get_file(
         uuid: UUID,
         storage: BaseStorage = Depends(get_storage()),
-        files_repo: FilesMetaRepository = Depends()
+        files_repo: FilesMetaRepository = Depends(),
+        accept_encoding: Optional[str] = Header(None),
+        w: Optional[int] = Query(None, ge=1, le=settings.DERIVATIVE_MAX_WIDTH),
+        fmt: Optional[Literal['jpeg', 'png', 'webp']] = Query(None),
+        range_header: Optional[str] = Header(None, alias='range'),
+        cloud_storage: BaseStorage = Depends(get_storage(CLOUD_STORAGE)),
     ):
+        """
+        w, fmt - resized / transcoded image instead of the original
+        """
         try:
             metadata = await files_repo.get_file_metadata(uuid)
         except RecordNotFound as e:
@@ -81,10 +602,15 @@ if settings.RETURN_FILES_LOCALLY:
         try:
             upload_path = storage.get_upload_path(metadata.storage_filename, check_exists=True)
         except FileNotFoundError:
-            logger.warning(f'A file record with id {uuid} exists in the database, but the file itself does not exist')
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail=f'File with id {uuid} not found'
-            )
+            try:
+                return await get_missing_file(cloud_storage, metadata, accept_encoding, range_header, w, fmt)
+            except HTTPException as e:
+                if e.status_code == status.HTTP_404_NOT_FOUND:
+                    # the metadata may be cached before another process deleted the file
+                    await files_repo.forget_file_metadata(uuid)
+                raise
 
-        return FileResponse(upload_path)
+        access_recorder.record(metadata.name)
+        if w is not None or fmt is not None:
+            return await get_derivative(upload_path, metadata, w, fmt)
+        return file_response(upload_path, metadata, accept_encoding)
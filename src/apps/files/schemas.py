@@ -1,5 +1,47 @@
-from pydantic import BaseModel, HttpUrl
+from typing import List, Optional
+from uuid import UUID
+
+from pydantic import BaseModel, HttpUrl, Field
+
+from src.parsers import TargetFileMultipartParser
 
 
 class UploadFileResponseSchema(BaseModel):
     uri: HttpUrl
+
+
+class UploadFilesResponseSchema(BaseModel):
+    files: List[UploadFileResponseSchema]
+
+
+class CreateUploadSchema(BaseModel):
+    filename: str
+    size: int = Field(gt=0, le=TargetFileMultipartParser.max_file_size)
+
+
+class UploadSessionSchema(BaseModel):
+    id: UUID
+    size: int
+    offset: int
+
+
+class DirectUploadSchema(BaseModel):
+    """
+    url - presigned PUT for the whole file,
+    or upload_id, part_size and part_urls for a multipart upload of large files
+    """
+    id: UUID
+    url: Optional[str] = None
+    upload_id: Optional[str] = None
+    part_size: Optional[int] = None
+    part_urls: Optional[List[str]] = None
+
+
+class UploadedPartSchema(BaseModel):
+    part_number: int = Field(ge=1, le=10000)
+    etag: str
+
+
+class CompleteDirectUploadSchema(BaseModel):
+    upload_id: Optional[str] = None
+    parts: List[UploadedPartSchema] = []
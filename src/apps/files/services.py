@@ -1,49 +1,397 @@
-from typing import List
+from collections import Counter
+from datetime import timedelta, datetime
+from typing import List, Set, Optional, Tuple, Dict
 from uuid import UUID
 
 from fastapi import Depends
-from sqlalchemy import insert, select, delete
+from sqlalchemy import insert, select, delete, update, func, tuple_, values, column, or_, DateTime
+from sqlalchemy.dialects.postgresql import UUID as PG_UUID
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from src.apps.files.models import FileMetadata
+from src.apps.files.models import FileMetadata, FileBlob, UploadSession, ReplicationJob
+from src.cache import CacheBackend, LocalCache, NOT_FOUND
 from src.db import Base, get_db
-from src.exceptions import RecordNotFound
+from src.exceptions import RecordNotFound, RecordLocked
+from src.metrics import METADATA_QUERY, METADATA_CACHE, timed
+from src.settings import settings
 from src.storages.base import FileInfo
 
 
+# metadata rows are immutable, so they are cached until deleted
+metadata_cache = LocalCache(maxsize=settings.METADATA_CACHE_SIZE, ttl=settings.METADATA_CACHE_TTL)
+
+
 class FilesMetaRepository:
     model: Base = FileMetadata
+    blob_model: Base = FileBlob
+    cache: CacheBackend = metadata_cache
 
     def __init__(self, session: AsyncSession = Depends(get_db)) -> None:
         self.session = session
 
-    async def save_file_metadata(self, data: FileInfo):
-        stmt = insert(self.model).values(
-            id=data.name,
-            size=data.size,
-            file_format=data.file_format,
-            original_filename=data.original_filename,
-            extension=data.extension,
-        )
+    async def save_file_metadata(self, data: FileInfo, replicate: Optional[List[str]] = None):
+        await self.save_files_metadata([data], replicate=replicate)
+
+    @timed(METADATA_QUERY, 'save_files_metadata')
+    async def save_files_metadata(self, files: List[FileInfo], replicate: Optional[List[str]] = None):
+        """
+        Insert all rows with one statement in one transaction
+        replicate - storage filenames to put into the replication outbox in the same transaction
+        """
+        stmt = insert(self.model).values([
+            dict(
+                id=data.name,
+                size=data.size,
+                file_format=data.file_format,
+                original_filename=data.original_filename,
+                extension=data.extension,
+                sha256=data.sha256,
+                blob_filename=data.blob_filename,
+                blob_sha256=data.blob_sha256,
+                content_encoding=data.content_encoding,
+            )
+            for data in files
+        ])
         await self.session.execute(stmt)
+        if replicate:
+            await ReplicationJobsRepository(self.session).add_jobs(replicate)
         await self.session.commit()
+        # drop cached NOT_FOUND
+        await self.cache.delete([data.name for data in files])
 
-    async def get_file_metadata(self, id: UUID) -> FileInfo:
-        stmt = select(self.model).where(self.model.id == id)
+    async def register_blob(self, data: FileInfo) -> Tuple[str, Optional[str]]:
+        """
+        Take a reference to the blob with the content of the file, creating the blob if it is new.
+        Returns storage filename and content encoding of the blob. Not committed, commit with save_file_metadata.
+        """
+        stmt = pg_insert(self.blob_model).values(
+            sha256=data.sha256,
+            storage_filename=data.storage_filename,
+            size=data.size,
+            content_encoding=data.content_encoding,
+            ref_count=1,
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[self.blob_model.sha256],
+            set_={'ref_count': self.blob_model.ref_count + 1},
+        ).returning(self.blob_model.storage_filename, self.blob_model.content_encoding)
         result = await self.session.execute(stmt)
+        return tuple(result.one())
+
+    async def get_file_metadata(self, id: UUID) -> FileInfo:
+        cached = await self.cache.get(id)
+        METADATA_CACHE.labels('miss' if cached is None else 'hit').inc()
+        if cached is NOT_FOUND:
+            raise RecordNotFound(id, 'File')
+        if cached is not None:
+            return cached
+
+        stmt = select(self.model).where(self.model.id == id, self.model.uploaded.is_(True))
+        with METADATA_QUERY.labels('get_file_metadata').time():
+            result = await self.session.execute(stmt)
         file_meta = result.scalars().first()
         if not file_meta:
+            await self.cache.set(id, NOT_FOUND, ttl=settings.METADATA_CACHE_NEGATIVE_TTL)
             raise RecordNotFound(id, 'File')
 
+        file_info = self.to_file_info(file_meta)
+        await self.cache.set(id, file_info)
+        return file_info
+
+    async def forget_file_metadata(self, id: UUID):
+        """
+        Drop the cached metadata, e.g. of a file deleted by another process
+        """
+        await self.cache.delete([id])
+
+    @staticmethod
+    def to_file_info(file_meta: FileMetadata) -> FileInfo:
         return FileInfo(
             size=file_meta.size,
             name=file_meta.id,
             file_format=file_meta.file_format,
             original_filename=file_meta.original_filename,
             extension=file_meta.extension,
+            sha256=file_meta.sha256,
+            blob_filename=file_meta.blob_filename,
+            blob_sha256=file_meta.blob_sha256,
+            content_encoding=file_meta.content_encoding,
+        )
+
+    async def reserve_file(self, data: FileInfo):
+        """
+        Metadata of a file uploaded directly to the cloud storage, not returned until confirm_file
+        """
+        stmt = insert(self.model).values(
+            id=data.name,
+            size=data.size,
+            original_filename=data.original_filename,
+            extension=data.extension,
+            uploaded=False,
+        )
+        await self.session.execute(stmt)
+        await self.session.commit()
+
+    async def get_reserved_file(self, id: UUID) -> FileInfo:
+        stmt = select(self.model).where(self.model.id == id, self.model.uploaded.is_(False))
+        result = await self.session.execute(stmt)
+        file_meta = result.scalars().first()
+        if not file_meta:
+            raise RecordNotFound(id, 'File')
+        return self.to_file_info(file_meta)
+
+    async def delete_reserved_file(self, id: UUID):
+        stmt = delete(self.model).where(self.model.id == id, self.model.uploaded.is_(False))
+        await self.session.execute(stmt)
+        await self.session.commit()
+
+    async def confirm_file(self, id: UUID, size: int, file_format: Optional[str]):
+        stmt = update(self.model).where(
+            self.model.id == id, self.model.uploaded.is_(False)
+        ).values(uploaded=True, size=size, file_format=file_format)
+        await self.session.execute(stmt)
+        await self.session.commit()
+        await self.cache.delete([id])
+
+    @timed(METADATA_QUERY, 'update_last_accessed')
+    async def update_last_accessed(self, accesses: Dict[UUID, datetime]):
+        """
+        One UPDATE ... FROM (VALUES ...) for all accessed files
+        """
+        accessed = values(
+            column('id', PG_UUID(as_uuid=True)),
+            column('accessed_at', DateTime(timezone=True)),
+            name='accessed',
+        ).data(list(accesses.items()))
+        stmt = update(self.model).where(
+            self.model.id == accessed.c.id,
+            self.model.last_accessed_at < accessed.c.accessed_at,
+        ).values(last_accessed_at=accessed.c.accessed_at).execution_options(synchronize_session=False)
+        await self.session.execute(stmt)
+        await self.session.commit()
+
+    @timed(METADATA_QUERY, 'get_expired_files')
+    async def get_expired_files(
+            self,
+            field: str,
+            older_than: timedelta,
+            limit: int,
+            after: Optional[Tuple[datetime, UUID]] = None,
+    ) -> List[Tuple[UUID, int, datetime]]:
+        """
+        Keyset pagination over the index of created_at / last_accessed_at.
+        Returns (id, size, field value), pass the value and id of the last row as `after` to get the next page.
+        """
+        column = getattr(self.model, field)
+        stmt = select(self.model.id, self.model.size, column).where(column < func.now() - older_than)
+        if after is not None:
+            stmt = stmt.where(tuple_(column, self.model.id) > tuple_(*after))
+        stmt = stmt.order_by(column, self.model.id).limit(limit)
+        result = await self.session.execute(stmt)
+        return [tuple(row) for row in result]
+
+    @timed(METADATA_QUERY, 'delete_files')
+    async def delete_files(self, ids: List[UUID]) -> List[str]:
+        """
+        Delete metadata and release references to the blobs, blobs without references are deleted.
+        Returns storage filenames which are not referenced anymore and can be deleted from storages.
+        """
+        stmt = delete(self.model).where(self.model.id.in_(ids)).returning(
+            self.model.id, self.model.extension, self.model.blob_sha256, self.model.blob_filename
+        )
+        result = await self.session.execute(stmt)
+        rows = result.all()
+        # only rows which took a reference release it
+        released = Counter(row.blob_sha256 for row in rows if row.blob_sha256)
+
+        blobs = set()
+        removed_blobs = []
+        if released:
+            stmt = select(self.blob_model.sha256).where(self.blob_model.sha256.in_(released))
+            blobs = set((await self.session.execute(stmt)).scalars())
+        for sha256 in blobs:
+            stmt = update(self.blob_model).where(
+                self.blob_model.sha256 == sha256
+            ).values(ref_count=self.blob_model.ref_count - released[sha256])
+            await self.session.execute(stmt)
+        if blobs:
+            stmt = delete(self.blob_model).where(
+                self.blob_model.sha256.in_(blobs), self.blob_model.ref_count <= 0
+            ).returning(self.blob_model.storage_filename)
+            removed_blobs = list((await self.session.execute(stmt)).scalars())
+
+        await self.session.commit()
+        await self.cache.delete(ids)
+
+        own_files = [
+            FileInfo(size=0, name=row.id, extension=row.extension, blob_filename=row.blob_filename).storage_filename
+            for row in rows if row.blob_sha256 not in blobs
+        ]
+        return [*own_files, *removed_blobs]
+
+    async def get_referenced_blobs(self, storage_filenames: List[str]) -> Set[str]:
+        stmt = select(self.blob_model.storage_filename).where(
+            self.blob_model.storage_filename.in_(storage_filenames)
         )
+        result = await self.session.execute(stmt)
+        return set(result.scalars())
+
+
+class UploadSessionsRepository:
+    model: Base = UploadSession
+
+    def __init__(self, session: AsyncSession = Depends(get_db)) -> None:
+        self.session = session
 
-    async def delete_files(self, ids: List[UUID]):
-        stmt = delete(self.model).where(self.model.id.in_(ids))
+    async def create_session(self, original_filename: str, extension: str, size: int) -> UploadSession:
+        upload = self.model(original_filename=original_filename, extension=extension, size=size, offset=0)
+        self.session.add(upload)
+        await self.session.commit()
+        await self.session.refresh(upload)
+        return upload
+
+    async def get_session(self, id: UUID, lock: bool = False) -> UploadSession:
+        """
+        lock - lock the row until commit, so only one request writes the upload at a time
+        """
+        stmt = select(self.model).where(self.model.id == id)
+        if lock:
+            stmt = stmt.with_for_update(nowait=True)
+        try:
+            result = await self.session.execute(stmt)
+        except DBAPIError:
+            await self.session.rollback()
+            raise RecordLocked(id, 'Upload')
+        upload = result.scalars().first()
+        if not upload:
+            raise RecordNotFound(id, 'Upload')
+        return upload
+
+    def _not_leased(self):
+        return or_(self.model.locked_until.is_(None), self.model.locked_until < func.now())
+
+    async def claim_session(self, id: UUID, lease: timedelta) -> UploadSession:
+        """
+        Lease the upload to one request and commit, so the body is received without a transaction
+        holding a connection. The lease of a crashed request ends by itself.
+        """
+        stmt = update(self.model).where(self.model.id == id, self._not_leased()).values(
+            locked_until=func.now() + lease,
+            updated_at=func.now(),
+        ).returning(*self.model.__table__.columns).execution_options(synchronize_session=False)
+        result = await self.session.execute(stmt)
+        row = result.first()
+        await self.session.commit()
+        if row is None:
+            await self.get_session(id)
+            raise RecordLocked(id, 'Upload')
+        return self.model(**row._mapping)
+
+    async def renew_lease(self, id: UUID, offset: int, lease: timedelta):
+        stmt = update(self.model).where(self.model.id == id, self.model.offset == offset).values(
+            locked_until=func.now() + lease,
+            updated_at=func.now(),
+        ).execution_options(synchronize_session=False)
         await self.session.execute(stmt)
         await self.session.commit()
+
+    async def set_offset(self, id: UUID, expected: int, offset: int) -> bool:
+        """
+        Save the offset and end the lease, if the offset is still the expected one.
+        False if the upload was deleted or written by another request meanwhile.
+        """
+        stmt = update(self.model).where(self.model.id == id, self.model.offset == expected).values(
+            offset=offset,
+            locked_until=None,
+            updated_at=func.now(),
+        ).execution_options(synchronize_session=False)
+        result = await self.session.execute(stmt)
+        await self.session.commit()
+        return result.rowcount == 1
+
+    async def delete_session(self, upload: UploadSession, commit: bool = True):
+        await self.session.delete(upload)
+        if commit:
+            await self.session.commit()
+
+    async def delete_stale_sessions(self, not_updated_in_last: timedelta) -> List[str]:
+        """
+        Returns storage filenames of the deleted uploads
+        """
+        stmt = delete(self.model).where(
+            self.model.updated_at < func.now() - not_updated_in_last, self._not_leased()
+        ).returning(self.model.id, self.model.extension).execution_options(synchronize_session=False)
+        result = await self.session.execute(stmt)
+        filenames = [self.model(id=id, extension=extension).storage_filename for id, extension in result]
+        await self.session.commit()
+        return filenames
+
+
+class ReplicationJobsRepository:
+    model: Base = ReplicationJob
+
+    def __init__(self, session: AsyncSession = Depends(get_db)) -> None:
+        self.session = session
+
+    async def add_jobs(self, storage_filenames: List[str]):
+        """
+        Not committed, the jobs are committed with the metadata
+        """
+        stmt = insert(self.model).values([
+            dict(storage_filename=filename, attempts=0) for filename in storage_filenames
+        ])
+        await self.session.execute(stmt)
+
+    async def claim_jobs(self, limit: int, lease: timedelta) -> List[Tuple[int, str, int]]:
+        """
+        Take available jobs for lease, jobs of a crashed worker become available again when the lease ends.
+        Returns (id, storage_filename, attempts).
+        """
+        available = select(self.model.id).where(
+            self.model.available_at <= func.now()
+        ).order_by(self.model.id).limit(limit).with_for_update(skip_locked=True)
+        stmt = update(self.model).where(self.model.id.in_(available.scalar_subquery())).values(
+            available_at=func.now() + lease,
+            attempts=self.model.attempts + 1,
+        ).returning(
+            self.model.id, self.model.storage_filename, self.model.attempts
+        ).execution_options(synchronize_session=False)
+        result = await self.session.execute(stmt)
+        jobs = [tuple(row) for row in result]
+        await self.session.commit()
+        return jobs
+
+    async def extend_lease(self, ids: List[int], lease: timedelta):
+        """
+        Keep jobs which are still being copied from being claimed again
+        """
+        stmt = update(self.model).where(self.model.id.in_(ids)).values(
+            available_at=func.now() + lease,
+        ).execution_options(synchronize_session=False)
+        await self.session.execute(stmt)
+        await self.session.commit()
+
+    async def complete_jobs(self, ids: List[int]):
+        if not ids:
+            return
+        await self.session.execute(delete(self.model).where(self.model.id.in_(ids)))
+        await self.session.commit()
+
+    async def retry_job(self, id: int, retry_in: timedelta, error: str):
+        stmt = update(self.model).where(self.model.id == id).values(
+            available_at=func.now() + retry_in,
+            last_error=error,
+        ).execution_options(synchronize_session=False)
+        await self.session.execute(stmt)
+        await self.session.commit()
+
+    async def get_backlog(self) -> Tuple[int, Optional[timedelta]]:
+        """
+        Returns number of pending jobs and age of the oldest one
+        """
+        stmt = select(func.count(self.model.id), func.now() - func.min(self.model.created_at))
+        result = await self.session.execute(stmt)
+        count, lag = result.one()
+        return count, lag
@@ -0,0 +1,63 @@
+import uuid
+from datetime import timedelta
+
+import pytest
+
+from src.apps.files.access import AccessRecorder
+
+
+@pytest.mark.asyncio
+async def test_accesses_coalesced_into_one_update(mocker):
+    update = mocker.patch(
+        'src.apps.files.access.FilesMetaRepository.update_last_accessed',
+        new_callable=mocker.AsyncMock,
+    )
+    mocker.patch('src.apps.files.access.get_db', side_effect=lambda: _sessions())
+    recorder = AccessRecorder(flush_interval=60, max_size=100)
+    hot, cold = uuid.uuid4(), uuid.uuid4()
+
+    for _ in range(10):
+        recorder.record(hot)
+    recorder.record(cold)
+    await recorder.stop()
+
+    update.assert_awaited_once()
+    accesses = update.await_args.args[0]
+    assert set(accesses) == {hot, cold}
+
+    await recorder.flush()
+    update.assert_awaited_once()
+
+
+async def _sessions():
+    yield None
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_keeps_accesses(mocker):
+    recorder = AccessRecorder(flush_interval=60, max_size=100)
+    hot, cold = uuid.uuid4(), uuid.uuid4()
+
+    async def fail_once(accesses):
+        if update.await_count == 1:
+            # accessed again while the update runs
+            recorder._pending[hot] = accesses[hot] + timedelta(seconds=1)
+            raise ConnectionError('database is down')
+
+    update = mocker.patch(
+        'src.apps.files.access.FilesMetaRepository.update_last_accessed',
+        new_callable=mocker.AsyncMock,
+        side_effect=fail_once,
+    )
+    mocker.patch('src.apps.files.access.get_db', side_effect=lambda: _sessions())
+
+    recorder.record(hot)
+    recorder.record(cold)
+    first = recorder._pending[hot]
+    with pytest.raises(ConnectionError):
+        await recorder.flush()
+    await recorder.flush()
+
+    accesses = update.await_args.args[0]
+    assert set(accesses) == {hot, cold}
+    assert accesses[hot] == first + timedelta(seconds=1)
@@ -1,12 +1,25 @@
+import asyncio
+import os
+import uuid
+
 import pytest
 
+from botocore.exceptions import ClientError
 from fastapi import HTTPException
 from fastapi.responses import FileResponse
 
-from unittest.mock import AsyncMock
+from unittest.mock import AsyncMock, MagicMock
 
-from src.apps.files.router import upload_file, get_file
+from src.apps.files.router import (
+    upload_file, upload_files, get_file, upload_chunk, finalize_upload, file_response, complete_direct_upload
+)
+from src.apps.files.schemas import CompleteDirectUploadSchema
 from src.exceptions import RecordNotFound
+from src.responses import DecodedFileResponse, OffloadFileResponse, StorageFileResponse
+from src.storages.base import FileInfo, FileStream
+from src.storages.cloud import CloudStorage
+from src.storages.cloud_cache import Fetch
+from src.storages.space import space_ledger
 
 
 @pytest.mark.asyncio
@@ -18,11 +31,168 @@ async def test_upload_file(post_request, background_tasks, storage, file_repo, f
     assert res.get('uri', False)
 
 
+@pytest.mark.asyncio
+async def test_upload_files(mocker, post_request, background_tasks, storage, file_repo):
+    storage, uid = storage
+    mocker.patch('src.apps.files.router.settings.REPLICATION_OUTBOX', True)
+    files = tuple(MagicMock() for _ in range(3))
+    for i, file in enumerate(files):
+        file.file.name = f'/media/{i}.jpeg'
+    storage.get_metadata.side_effect = [FileInfo(size=1, name=uid, extension='jpeg') for _ in files]
+    storage.get_file_url.return_value = 'http://0.0.0.0:8000/media/file'
+
+    res = await upload_files(post_request, background_tasks, storage, storage, file_repo, files)
+
+    assert len(res['files']) == 3
+    file_repo.save_files_metadata.assert_awaited_once()
+    assert len(file_repo.save_files_metadata.await_args.args[0]) == 3
+    assert file_repo.save_files_metadata.await_args.kwargs['replicate'] == ['0.jpeg', '1.jpeg', '2.jpeg']
+    background_tasks.add_task.assert_not_called()
+
+
 @pytest.mark.asyncio
 async def test_get_file(storage, file, file_repo):
     storage, uid = storage
-    res = await get_file(uid, storage, file_repo)
+    file_repo.get_file_metadata.return_value = FileInfo(size=1, name=uid, extension='pdf')
+    res = await get_file(uid, storage, file_repo, None, None, None)
+    assert isinstance(res, FileResponse)
+
+
+@pytest.mark.asyncio
+async def test_get_compressed_file(storage, file_repo):
+    storage, uid = storage
+    file_repo.get_file_metadata.return_value = FileInfo(
+        size=1, name=uid, extension='json', file_format='json', content_encoding='gzip'
+    )
+
+    res = await get_file(uid, storage, file_repo, 'gzip, deflate, br', None, None)
     assert isinstance(res, FileResponse)
+    assert res.headers['content-encoding'] == 'gzip'
+
+    res = await get_file(uid, storage, file_repo, 'identity', None, None)
+    assert isinstance(res, DecodedFileResponse)
+    assert res.headers['content-type'] == 'application/json'
+
+
+def test_offloaded_compressed_file_sent_by_app(mocker, tmp_path):
+    mocker.patch('src.apps.files.router.settings.FILES_OFFLOAD_HEADER', 'X-Accel-Redirect')
+    mocker.patch('src.apps.files.router.settings.UPLOAD_DIR', str(tmp_path))
+    path = str(tmp_path / 'a.json')
+    metadata = FileInfo(size=1, name=uuid.uuid4(), extension='json', file_format='json')
+
+    assert isinstance(file_response(path, metadata, None, offload=True), OffloadFileResponse)
+
+    metadata.content_encoding = 'gzip'
+    res = file_response(path, metadata, 'gzip', offload=True)
+    assert not isinstance(res, OffloadFileResponse)
+    assert res.headers['content-encoding'] == 'gzip'
+
+
+@pytest.mark.asyncio
+async def test_get_derivative_of_not_image(storage, file_repo):
+    storage, uid = storage
+    file_repo.get_file_metadata.return_value = FileInfo(size=1, name=uid, extension='pdf', file_format='pdf')
+    with pytest.raises(HTTPException) as e:
+        await get_file(uid, storage, file_repo, None, 320, 'webp')
+    assert e.value.status_code == 415
+
+
+@pytest.mark.asyncio
+async def test_get_file_from_cloud_cache(mocker, storage, file_repo, tmp_path):
+    storage, uid = storage
+    storage.get_upload_path.side_effect = FileNotFoundError
+    file_repo.get_file_metadata.return_value = FileInfo(size=1, name=uid, extension='pdf', file_format='pdf')
+    cached = tmp_path / 'file.pdf'
+    cached.write_bytes(b'%PDF')
+    cloud_cache = mocker.patch('src.apps.files.router.cloud_cache')
+    cloud_cache.get = AsyncMock(return_value=open(cached, 'rb'))
+
+    res = await get_file(uid, storage, file_repo, None, None, None, None, storage)
+    assert isinstance(res, FileResponse)
+    assert res.path == str(cached)
+    cloud_cache.get.assert_awaited_once_with(f'{uid}.pdf')
+
+    # evicted before the response is sent
+    os.remove(cached)
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {'type': 'http', 'method': 'GET', 'headers': [], 'extensions': {'http.response.pathsend': {}}}
+    await res(scope, AsyncMock(), send)
+    assert messages[0]['status'] == 200
+    assert b''.join(message.get('body', b'') for message in messages[1:]) == b'%PDF'
+
+
+@pytest.mark.asyncio
+async def test_get_file_from_cloud_cache_fetch_failed(mocker, storage, file_repo):
+    storage, uid = storage
+    storage.get_upload_path.side_effect = FileNotFoundError
+    file_repo.get_file_metadata.return_value = FileInfo(size=1, name=uid, extension='png', file_format='png')
+    fetch = Fetch('/cloud-cache/file.png')
+    fetch.task = asyncio.ensure_future(asyncio.sleep(0))
+    fetch.error = IOError('Received 10 of 100 bytes')
+    cloud_cache = mocker.patch('src.apps.files.router.cloud_cache')
+    cloud_cache.get = AsyncMock(return_value=fetch)
+
+    # a derivative needs the whole file
+    with pytest.raises(HTTPException) as e:
+        await get_file(uid, storage, file_repo, None, 320, 'webp', None, storage)
+    assert e.value.status_code == 502
+
+    cloud_cache.get.side_effect = ConnectionError('cloud is down')
+    with pytest.raises(HTTPException) as e:
+        await get_file(uid, storage, file_repo, None, None, None, None, storage)
+    assert e.value.status_code == 502
+
+
+@pytest.mark.asyncio
+async def test_get_file_from_cloud_storage(mocker, storage, file_repo):
+    storage, uid = storage
+    storage.get_upload_path.side_effect = FileNotFoundError
+    file_repo.get_file_metadata.return_value = FileInfo(size=100, name=uid, extension='pdf', file_format='pdf')
+    cloud_storage = MagicMock()
+    cloud_storage.stream_file = AsyncMock(return_value=FileStream(MagicMock(), 10, 100))
+
+    res = await get_file(uid, storage, file_repo, None, None, None, 'bytes=10-19', cloud_storage)
+    assert isinstance(res, StorageFileResponse)
+    assert res.status_code == 206
+    assert res.headers['content-range'] == 'bytes 10-19/100'
+    cloud_storage.stream_file.assert_awaited_once_with(f'{uid}.pdf', (10, 19))
+
+    res = await get_file(uid, storage, file_repo, None, None, None, 'bytes=200-', cloud_storage)
+    assert res.status_code == 416
+
+    mocker.patch('src.apps.files.router.settings.CLOUD_CACHE_SIZE', 0)
+    cloud_storage.stream_file.return_value = FileStream(MagicMock(), 100, 100)
+    res = await get_file(uid, storage, file_repo, None, None, None, None, cloud_storage)
+    assert res.status_code == 200
+    assert res.headers['content-length'] == '100'
+
+    cloud_storage.stream_file.side_effect = FileNotFoundError
+    with pytest.raises(HTTPException) as e:
+        await get_file(uid, storage, file_repo, None, None, None, None, cloud_storage)
+    assert e.value.status_code == 404
+    file_repo.forget_file_metadata.assert_awaited_once_with(uid)
+
+
+@pytest.mark.asyncio
+async def test_get_file_cloud_storage_unavailable(mocker, storage, file_repo):
+    storage, uid = storage
+    storage.get_upload_path.side_effect = FileNotFoundError
+    file_repo.get_file_metadata.return_value = FileInfo(size=100, name=uid, extension='pdf', file_format='pdf')
+    mocker.patch('src.apps.files.router.settings.CLOUD_CACHE_SIZE', 0)
+    s3 = MagicMock()
+    s3.get_object = AsyncMock(side_effect=ClientError(
+        {'Error': {'Code': 'ServiceUnavailable'}, 'ResponseMetadata': {'HTTPStatusCode': 503}}, 'GetObject'
+    ))
+    cloud_storage = CloudStorage('bucket', 'media')
+    cloud_storage.get_client = AsyncMock(return_value=s3)
+
+    with pytest.raises(HTTPException) as e:
+        await get_file(uid, storage, file_repo, None, None, None, None, cloud_storage)
+    assert e.value.status_code == 502
 
 
 @pytest.mark.asyncio
@@ -31,3 +201,114 @@ async def test_get_file_no_metadata(session, storage, file_repo):
     file_repo.get_file_metadata = AsyncMock(side_effect=RecordNotFound(uid, 'file'))
     with pytest.raises(HTTPException):
         await get_file(uid, storage, file_repo)
+
+
+@pytest.mark.asyncio
+async def test_upload_duplicate_file(mocker, post_request, background_tasks, storage, file_repo, file):
+    storage, uid = storage
+    mocker.patch('src.apps.files.router.settings.DEDUPLICATE_UPLOADS', True)
+    storage.get_metadata.return_value = FileInfo(size=1, name=uid, extension='pdf', sha256='0' * 64)
+    storage.delete = AsyncMock()
+    file_repo.register_blob = AsyncMock(return_value=('existing.pdf', None))
+
+    res = await upload_file(post_request, background_tasks, storage, storage, file_repo, (file,))
+
+    assert res.get('uri', False)
+    storage.delete.assert_awaited_once_with(f'{uid}.pdf')
+    background_tasks.add_task.assert_not_called()
+    saved, = file_repo.save_files_metadata.await_args.args[0]
+    assert saved.storage_filename == 'existing.pdf'
+    assert saved.blob_sha256 == '0' * 64
+
+
+@pytest.mark.asyncio
+async def test_upload_chunk_offset_conflict(post_request, storage):
+    storage, uid = storage
+    post_request.scope['headers'] = [(b'content-type', b'application/offset+octet-stream')]
+    uploads_repo = MagicMock()
+    uploads_repo.claim_session = AsyncMock(return_value=MagicMock(id=uid, offset=10, size=100))
+    uploads_repo.set_offset = AsyncMock(return_value=True)
+
+    with pytest.raises(HTTPException) as e:
+        await upload_chunk(post_request, uid, 0, storage, uploads_repo)
+    assert e.value.status_code == 409
+    # the lease is released
+    uploads_repo.set_offset.assert_awaited_once_with(uid, 10, 10)
+
+
+@pytest.mark.asyncio
+async def test_upload_chunk_changed_meanwhile(mocker, post_request, storage):
+    storage, uid = storage
+    post_request.scope['headers'] = [
+        (b'content-type', b'application/offset+octet-stream'),
+        (b'content-length', b'5'),
+    ]
+    mocker.patch('src.apps.files.router.space_ledger.get_available', return_value=1024 ** 3)
+    reserve = mocker.spy(space_ledger, 'reserve')
+
+    async def write_stream(filepath, stream, offset):
+        async for chunk in stream:
+            offset += len(chunk)
+            yield offset
+
+    async def body():
+        yield {'type': 'http.request', 'body': b'x' * 5, 'more_body': False}
+
+    post_request._receive = body().__anext__
+    storage.write_stream = write_stream
+    uploads_repo = MagicMock()
+    uploads_repo.claim_session = AsyncMock(return_value=MagicMock(id=uid, offset=10, size=100))
+    uploads_repo.set_offset = AsyncMock(return_value=False)
+
+    with pytest.raises(HTTPException) as e:
+        await upload_chunk(post_request, uid, 10, storage, uploads_repo)
+    assert e.value.status_code == 409
+    uploads_repo.set_offset.assert_awaited_once_with(uid, 10, 15)
+    # only the chunk is reserved, not the rest of the upload
+    reserve.assert_called_once_with(5)
+
+
+@pytest.mark.asyncio
+async def test_finalize_incomplete_upload(post_request, background_tasks, storage, file_repo):
+    storage, uid = storage
+    uploads_repo = MagicMock()
+    uploads_repo.get_session = AsyncMock(return_value=MagicMock(offset=10, size=100))
+
+    with pytest.raises(HTTPException) as e:
+        await finalize_upload(post_request, uid, background_tasks, storage, storage, uploads_repo, file_repo)
+    assert e.value.status_code == 409
+    file_repo.save_file_metadata.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_finalize_upload_without_content(post_request, background_tasks, storage, file_repo):
+    storage, uid = storage
+    storage.get_upload_path.side_effect = FileNotFoundError
+    uploads_repo = MagicMock()
+    uploads_repo.get_session = AsyncMock(return_value=MagicMock(offset=100, size=100))
+    uploads_repo.delete_session = AsyncMock()
+
+    with pytest.raises(HTTPException) as e:
+        await finalize_upload(post_request, uid, background_tasks, storage, storage, uploads_repo, file_repo)
+    assert e.value.status_code == 404
+    uploads_repo.delete_session.assert_awaited_once()
+    file_repo.save_file_metadata.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_complete_direct_upload_format_not_allowed(mocker, post_request, file_repo):
+    uid = uuid.uuid4()
+    mocker.patch('src.apps.files.router.settings.ALLOWED_FILE_FORMATS', {'pdf'})
+    file_repo.get_reserved_file = AsyncMock(return_value=FileInfo(size=1, name=uid, extension='exe'))
+    file_repo.delete_reserved_file = AsyncMock()
+    file_repo.confirm_file = AsyncMock()
+    cloud_storage = MagicMock()
+    cloud_storage.get_object_info = AsyncMock(return_value=(1, 'exe'))
+    cloud_storage.delete = AsyncMock()
+
+    with pytest.raises(HTTPException) as e:
+        await complete_direct_upload(post_request, uid, CompleteDirectUploadSchema(), cloud_storage, file_repo)
+    assert e.value.status_code == 415
+    cloud_storage.delete.assert_awaited_once_with(f'{uid}.exe')
+    file_repo.delete_reserved_file.assert_awaited_once_with(uid)
+    file_repo.confirm_file.assert_not_called()
@@ -0,0 +1,68 @@
+import uuid
+
+import pytest
+from unittest.mock import AsyncMock, MagicMock
+
+from src.apps.files.services import FilesMetaRepository
+from src.cache import LocalCache
+from src.exceptions import RecordNotFound
+
+
+@pytest.fixture
+def repo():
+    repo = FilesMetaRepository(MagicMock())
+    repo.cache = LocalCache(maxsize=10, ttl=60)
+    return repo
+
+
+@pytest.mark.asyncio
+async def test_get_file_metadata_cached(repo):
+    uid = uuid.uuid4()
+    row = MagicMock(id=uid, size=1, extension='pdf')
+    result = MagicMock()
+    result.scalars.return_value.first.return_value = row
+    repo.session.execute = AsyncMock(return_value=result)
+
+    first = await repo.get_file_metadata(uid)
+    second = await repo.get_file_metadata(uid)
+
+    assert first is second
+    repo.session.execute.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_get_file_metadata_negative_cache(repo):
+    uid = uuid.uuid4()
+    result = MagicMock()
+    result.scalars.return_value.first.return_value = None
+    repo.session.execute = AsyncMock(return_value=result)
+
+    for _ in range(2):
+        with pytest.raises(RecordNotFound):
+            await repo.get_file_metadata(uid)
+    repo.session.execute.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_delete_files_releases_only_taken_references(repo):
+    plain, deduplicated = uuid.uuid4(), uuid.uuid4()
+    deleted = MagicMock()
+    deleted.all.return_value = [
+        # uploaded with DEDUPLICATE_UPLOADS off, the same content as the blob
+        MagicMock(id=plain, extension='pdf', blob_sha256=None, blob_filename=None),
+        MagicMock(id=deduplicated, extension='pdf', blob_sha256='abc', blob_filename='blob.pdf'),
+    ]
+    blobs = MagicMock()
+    blobs.scalars.return_value = ['abc']
+    removed = MagicMock()
+    removed.scalars.return_value = []
+    repo.session.execute = AsyncMock(side_effect=[deleted, blobs, MagicMock(), removed])
+    repo.session.commit = AsyncMock()
+
+    filenames = await repo.delete_files([plain, deduplicated])
+
+    assert filenames == [f'{plain}.pdf']
+    released = repo.session.execute.await_args_list[1].args[0]
+    assert released.compile().params['sha256_1'] == ['abc']
+    decremented = repo.session.execute.await_args_list[2].args[0]
+    assert decremented.compile().params['ref_count_1'] == 1
@@ -1,9 +1,14 @@
+import os
+import tempfile
 import uuid
 
 import pytest
 from unittest.mock import MagicMock, AsyncMock
 from fastapi.requests import Request
 
+# before the settings are loaded, so test runs don't write logs into the repo
+os.environ.setdefault('LOG_DIR', os.path.join(tempfile.gettempdir(), 'files-test-logs'))
+
 from src.storages.base import FileInfo
 
 
@@ -100,5 +105,7 @@ def file():
 def file_repo():
     repo = MagicMock()
     repo.save_file_metadata = AsyncMock()
+    repo.save_files_metadata = AsyncMock()
     repo.get_file_metadata = AsyncMock()
+    repo.forget_file_metadata = AsyncMock()
     return repo
@@ -0,0 +1,155 @@
+import asyncio
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional
+from uuid import UUID
+
+from PIL import Image, ImageOps
+
+from src.settings import settings
+
+# formats from MIME_FORMAT derivatives are rendered from and to
+IMAGE_FORMATS = {'jpeg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP', 'gif': 'GIF'}
+TMP_SUFFIX = '.tmp'
+
+
+class RenderFailed(Exception):
+    pass
+
+
+def render(source_path: str, target_path: str, width: Optional[int], file_format: str) -> None:
+    """
+    Runs in the process pool
+    """
+    with Image.open(source_path) as image:
+        if width and image.width > width:
+            height = max(round(image.height * width / image.width), 1)
+            # jpeg is decoded at a reduced scale, much faster for big photos
+            image.draft('RGB', (width, height))
+        image = ImageOps.exif_transpose(image)
+        if width and image.width > width:
+            image.thumbnail((width, image.height), Image.Resampling.LANCZOS)
+        if file_format == 'jpeg' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        tmp_path = f'{target_path}{TMP_SUFFIX}{os.getpid()}'
+        try:
+            image.save(tmp_path, IMAGE_FORMATS[file_format])
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+    os.replace(tmp_path, target_path)
+
+
+class DerivativeCache:
+    """
+    Resized / transcoded images rendered in a process pool and kept on disk,
+    least recently used derivatives are deleted when the cache is larger than max_size bytes.
+    Concurrent requests of the same derivative wait for one render.
+    """
+
+    def __init__(self, path: str, max_size: int, workers: int) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.workers = workers
+        self.size = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._entries: Optional[OrderedDict[str, int]] = None
+        self._rendering: Dict[str, asyncio.Future] = {}
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    @staticmethod
+    def get_filename(file_id: UUID, width: Optional[int], file_format: str) -> str:
+        return f'{file_id}_{width or 0}.{file_format}'
+
+    async def get(self, source_path: str, file_id: UUID, width: Optional[int], file_format: str) -> str:
+        if self._entries is None:
+            await asyncio.to_thread(self._load)
+
+        filename = self.get_filename(file_id, width, file_format)
+        path = os.path.join(self.path, filename)
+        if filename in self._entries:
+            if os.path.exists(path):
+                self._entries.move_to_end(filename)
+                return path
+            # evicted by another worker
+            self.size -= self._entries.pop(filename)
+
+        future = self._rendering.get(filename)
+        if future is None:
+            future = asyncio.ensure_future(self._render(source_path, filename, width, file_format))
+            self._rendering[filename] = future
+            future.add_done_callback(lambda _: self._rendering.pop(filename, None))
+        # a cancelled request doesn't cancel the render others wait for
+        return await asyncio.shield(future)
+
+    async def _render(self, source_path: str, filename: str, width: Optional[int], file_format: str) -> str:
+        path = os.path.join(self.path, filename)
+        loop = asyncio.get_running_loop()
+        executor = self.get_executor()
+        try:
+            await loop.run_in_executor(executor, render, source_path, path, width, file_format)
+        except BrokenProcessPool as e:
+            # a worker died, e.g. killed on out of memory in a decoder, the next render starts a new pool
+            if self._executor is executor:
+                self._executor = None
+                executor.shutdown(wait=False, cancel_futures=True)
+            raise RenderFailed('The render process terminated abruptly') from e
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            raise RenderFailed(str(e)) from e
+
+        size = os.path.getsize(path)
+        self._entries[filename] = size
+        self.size += size
+        evicted = self._evict()
+        if evicted:
+            await asyncio.to_thread(self._delete, evicted)
+        return path
+
+    def _load(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        entries = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                # renders in progress, or left by a killed worker
+                if entry.is_file(follow_symlinks=False) and TMP_SUFFIX not in entry.name:
+                    stat = entry.stat()
+                    entries.append((stat.st_atime, entry.name, stat.st_size))
+        self._entries = OrderedDict((name, size) for _, name, size in sorted(entries))
+        self.size = sum(self._entries.values())
+
+    def _evict(self) -> List[str]:
+        evicted = []
+        # the newest derivative is kept even if it is larger than the cache
+        while self.size > self.max_size and len(self._entries) > 1:
+            filename, size = self._entries.popitem(last=False)
+            self.size -= size
+            evicted.append(filename)
+        return evicted
+
+    def _delete(self, filenames: List[str]) -> None:
+        for filename in filenames:
+            try:
+                os.remove(os.path.join(self.path, filename))
+            except FileNotFoundError:
+                pass
+
+
+derivative_cache = DerivativeCache(
+    settings.DERIVATIVES_DIR,
+    max_size=settings.DERIVATIVES_CACHE_SIZE,
+    workers=settings.DERIVATIVES_WORKERS,
+)
@@ -5,3 +5,9 @@ class RecordNotFound(Exception):
     def __init__(self, pk: Any, resource_name: str):
         self.pk = pk
         self.resource_name = resource_name
+
+
+class RecordLocked(Exception):
+    def __init__(self, pk: Any, resource_name: str):
+        self.pk = pk
+        self.resource_name = resource_name
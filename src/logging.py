@@ -1,6 +1,15 @@
 from loguru import logger
+import random
+import re
 import sys
 import os
+import time
+import uuid
+from typing import Dict, Hashable, Tuple
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from src.metrics import get_content_length, get_sent_bytes
 from src.settings import settings
 
 
@@ -15,8 +24,135 @@ log_format = (
     "<level>{message}</level>"
 )
 
+# Records are serialized and written by a background thread, a log call only puts the record into a queue.
+# Every level goes to stdout once.
 logger.remove()
-logger.add(sys.stdout, format=log_format, level='DEBUG', serialize=True)
-logger.add(sys.stdout, format=log_format, level="INFO", serialize=True)
-logger.add(os.path.join(settings.LOG_DIR, "app.log"), format=log_format, level="INFO", serialize=True)
-logger.add(os.path.join(settings.LOG_DIR, "error.log"), format=log_format, level="ERROR", serialize=True)
+logger.add(sys.stdout, format=log_format, level=settings.LOG_LEVEL, serialize=True, enqueue=True)
+logger.add(os.path.join(settings.LOG_DIR, "app.log"), format=log_format, level="INFO", serialize=True, enqueue=True)
+logger.add(os.path.join(settings.LOG_DIR, "error.log"), format=log_format, level="ERROR", serialize=True, enqueue=True)
+
+
+class RateLimiter:
+    """
+    Allow at most `limit` events of a key per `interval` seconds
+    """
+
+    def __init__(self, limit: int, interval: float) -> None:
+        self.limit = limit
+        self.interval = interval
+        self._windows: Dict[Hashable, Tuple[float, int, int]] = {}  # key -> window start, allowed, suppressed
+
+    def allow(self, key: Hashable) -> Tuple[bool, int]:
+        """
+        Whether the event is allowed, and the number of events suppressed since the last allowed one
+        """
+        now = time.monotonic()
+        started, allowed, suppressed = self._windows.get(key, (now, 0, 0))
+        if now - started >= self.interval:
+            started, allowed = now, 0
+        if allowed >= self.limit:
+            self._windows[key] = (started, allowed, suppressed + 1)
+            return False, suppressed + 1
+        self._windows[key] = (started, allowed + 1, 0)
+        return True, suppressed
+
+
+rate_limiter = RateLimiter(settings.LOG_RATE_LIMIT, settings.LOG_RATE_LIMIT_INTERVAL)
+
+
+def log_limited(level: str, key: Hashable, message: str) -> None:
+    """
+    Log a message which can repeat on every request at most LOG_RATE_LIMIT times per LOG_RATE_LIMIT_INTERVAL
+    """
+    allowed, suppressed = rate_limiter.allow(key)
+    if not allowed:
+        return
+    if suppressed:
+        message = f'{message} ({suppressed} similar messages suppressed)'
+    logger.opt(depth=1).log(level, message)
+
+
+REQUEST_ID_HEADER = b'x-request-id'
+REQUEST_ID_PATTERN = re.compile(r'[\w.:-]{1,128}')
+
+
+class AccessLogMiddleware:
+    """
+    Access log record per request with timings of receiving the body (upload) and sending the response (download).
+    The request id from X-Request-Id, or a generated one, is added to all logs of the request and to the response.
+    Requests which are neither failed nor slow are sampled by ACCESS_LOG_SAMPLE_RATE.
+    """
+
+    def __init__(
+            self,
+            app: ASGIApp,
+            sample_rate: float = settings.ACCESS_LOG_SAMPLE_RATE,
+            slow_seconds: float = settings.ACCESS_LOG_SLOW_SECONDS,
+    ) -> None:
+        self.app = app
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+
+    @staticmethod
+    def get_request_id(scope: Scope) -> str:
+        for name, value in scope['headers']:
+            if name == REQUEST_ID_HEADER:
+                request_id = value.decode('latin-1')
+                if REQUEST_ID_PATTERN.fullmatch(request_id):
+                    return request_id
+                break
+        return uuid.uuid4().hex
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        request_id = self.get_request_id(scope)
+        started = time.perf_counter()
+        received_at = response_started_at = None
+        status_code = 500
+        received = 0
+        sent = 0
+        content_length = 0
+
+        async def receive_wrapper() -> Message:
+            nonlocal received, received_at
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+                if not message.get('more_body', False):
+                    received_at = time.perf_counter()
+            return message
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code, sent, content_length, response_started_at
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+                content_length = get_content_length(message)
+                response_started_at = time.perf_counter()
+                message['headers'] = [*message.get('headers', []), (REQUEST_ID_HEADER, request_id.encode('latin-1'))]
+            else:
+                sent += get_sent_bytes(message, content_length)
+            await send(message)
+
+        with logger.contextualize(request_id=request_id):
+            try:
+                await self.app(scope, receive_wrapper, send_wrapper)
+            finally:
+                finished = time.perf_counter()
+                duration = finished - started
+                if status_code >= 400 or duration >= self.slow_seconds or random.random() < self.sample_rate:
+                    logger.bind(
+                        access=True,
+                        method=scope['method'],
+                        path=scope['path'],
+                        status=status_code,
+                        duration=round(duration, 6),
+                        # upload: until the whole body is received
+                        receive_seconds=round(received_at - started, 6) if received_at and received else None,
+                        # download: from the response start until the last byte is sent
+                        send_seconds=round(finished - response_started_at, 6) if response_started_at else None,
+                        received_bytes=received,
+                        sent_bytes=sent,
+                    ).info(f'{scope["method"]} {scope["path"]} {status_code} {duration:.3f}s')
@@ -1,7 +1,47 @@
-from fastapi import FastAPI
+import asyncio
+from contextlib import asynccontextmanager
 
+from fastapi import FastAPI, Depends
+
+from src.apps.files.access import access_recorder
 from src.apps.files.router import router as files_router
+from src.apps.files.services import ReplicationJobsRepository
+from src.derivatives import derivative_cache
+from src.logging import AccessLogMiddleware, log_limited, logger
+from src.metrics import MetricsMiddleware, mark_process_dead, render_metrics, set_replication_backlog, update_disk_free
+from src.settings import settings
+from src.storages.registry import open_storages, close_storages
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await open_storages()
+    await access_recorder.start()
+    yield
+    await access_recorder.stop()
+    derivative_cache.close()
+    await close_storages()
+    mark_process_dead()
+    # flush the queued records
+    await logger.complete()
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(AccessLogMiddleware)
 
 app.include_router(files_router)
+
+
+@app.get('/metrics', include_in_schema=False)
+async def metrics(jobs_repo: ReplicationJobsRepository = Depends()):
+    update_disk_free()
+    if settings.REPLICATION_OUTBOX:
+        # the other metrics are rendered even if the database is slow or down
+        try:
+            backlog = await asyncio.wait_for(jobs_repo.get_backlog(), timeout=settings.METRICS_DB_TIMEOUT)
+        except Exception as e:
+            log_limited('WARNING', 'metrics_backlog', f'Unable to get the replication backlog: {e!r}')
+        else:
+            set_replication_backlog(*backlog)
+    return render_metrics()
@@ -0,0 +1,179 @@
+import functools
+import os
+import shutil
+import time
+from datetime import timedelta
+from typing import Callable, Optional
+
+from fastapi import Response
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from src.settings import settings
+
+# With several uvicorn workers set PROMETHEUS_MULTIPROC_DIR to an empty directory shared by the workers,
+# commands writing to the same directory are exported too
+MULTIPROCESS = 'PROMETHEUS_MULTIPROC_DIR' in os.environ
+
+REQUEST_LATENCY = Histogram(
+    'files_http_request_duration_seconds', 'HTTP request latency', ['method', 'route', 'status'],
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+BYTES_IN = Counter('files_http_received_bytes', 'Request body bytes', ['route'])
+BYTES_OUT = Counter('files_http_sent_bytes', 'Response body bytes', ['route'])
+MULTIPART_PARSE = Histogram(
+    'files_multipart_parse_duration_seconds', 'Receiving and parsing of multipart uploads',
+    buckets=(.01, .05, .1, .5, 1, 5, 10, 30, 60, 300, 900),
+)
+FORMAT_DETECTION = Histogram(
+    'files_format_detection_duration_seconds', 'libmagic format detection',
+    buckets=(.0001, .0005, .001, .005, .01, .05, .1),
+)
+METADATA_QUERY = Histogram(
+    'files_metadata_query_duration_seconds', 'FilesMetaRepository queries', ['operation'],
+    buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1),
+)
+METADATA_CACHE = Counter('files_metadata_cache_requests', 'Metadata cache lookups', ['result'])
+CLOUD_CACHE = Counter('files_cloud_cache_requests', 'Local misses served by the cache of cloud files', ['result'])
+S3_LATENCY = Histogram(
+    'files_s3_request_duration_seconds', 'S3 requests', ['operation'],
+    buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30),
+)
+S3_ERRORS = Counter('files_s3_errors', 'Failed S3 requests', ['operation'])
+BACKGROUND_COPIES = Gauge(
+    'files_background_copies', 'Files being copied by request background tasks', multiprocess_mode='livesum'
+)
+REPLICATION_BACKLOG = Gauge(
+    'files_replication_backlog', 'Files in the replication outbox', multiprocess_mode='mostrecent'
+)
+REPLICATION_LAG = Gauge(
+    'files_replication_lag_seconds', 'Age of the oldest job in the replication outbox', multiprocess_mode='mostrecent'
+)
+DISK_FREE = Gauge('files_upload_dir_free_bytes', 'Free space on UPLOAD_DIR', multiprocess_mode='mostrecent')
+DISK_RESERVED = Gauge(
+    'files_upload_reserved_bytes', 'Space promised to uploads in progress', multiprocess_mode='livesum'
+)
+SPACE_REJECTIONS = Counter('files_uploads_rejected_no_space', 'Uploads rejected for lack of space', ['status'])
+CLEAR_FILES = Gauge('files_clear_last_deleted_files', 'Files deleted by the last ClearOldFiles run',
+                    multiprocess_mode='mostrecent')
+CLEAR_SIZE = Gauge('files_clear_last_deleted_bytes', 'Bytes deleted by the last ClearOldFiles run',
+                   multiprocess_mode='mostrecent')
+CLEAR_DURATION = Gauge('files_clear_last_duration_seconds', 'Duration of the last ClearOldFiles run',
+                       multiprocess_mode='mostrecent')
+CLEAR_FINISHED = Gauge('files_clear_last_finished_timestamp', 'End of the last ClearOldFiles run',
+                       multiprocess_mode='mostrecent')
+
+
+def timed(histogram: Histogram, *labels: str) -> Callable:
+    """
+    Observe duration of a coroutine function
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with histogram.labels(*labels).time():
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_content_length(start_message: Message) -> int:
+    for name, value in start_message.get('headers', []):
+        if name.lower() == b'content-length':
+            return int(value)
+    return 0
+
+
+def get_sent_bytes(message: Message, content_length: int) -> int:
+    """
+    Body bytes of a response message, including the extensions sending files
+    """
+    if message['type'] == 'http.response.body':
+        return len(message.get('body', b''))
+    if message['type'] == 'http.response.zerocopysend':
+        return message['count']
+    if message['type'] == 'http.response.pathsend':
+        return content_length
+    return 0
+
+
+class MetricsMiddleware:
+    """
+    Latency and body bytes per route template, so ids in paths don't create new series
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status_code = 500
+        received = 0
+        sent = 0
+        content_length = 0
+
+        async def receive_wrapper() -> Message:
+            nonlocal received
+            message = await receive()
+            if message['type'] == 'http.request':
+                received += len(message.get('body', b''))
+            return message
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code, sent, content_length
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+                content_length = get_content_length(message)
+            else:
+                sent += get_sent_bytes(message, content_length)
+            await send(message)
+
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            route = scope.get('route')
+            route = route.path if route is not None else 'unmatched'
+            REQUEST_LATENCY.labels(scope['method'], route, status_code).observe(time.perf_counter() - started)
+            if received:
+                BYTES_IN.labels(route).inc(received)
+            if sent:
+                BYTES_OUT.labels(route).inc(sent)
+
+
+def get_registry() -> CollectorRegistry:
+    if not MULTIPROCESS:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def mark_process_dead() -> None:
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+def update_disk_free() -> None:
+    DISK_FREE.set(shutil.disk_usage(settings.UPLOAD_DIR).free)
+
+
+def set_replication_backlog(count: int, lag: Optional[timedelta]) -> None:
+    REPLICATION_BACKLOG.set(count)
+    REPLICATION_LAG.set(lag.total_seconds() if lag else 0)
+
+
+def render_metrics() -> Response:
+    return Response(generate_latest(get_registry()), media_type=CONTENT_TYPE_LATEST)
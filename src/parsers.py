@@ -1,10 +1,218 @@
-from typing import BinaryIO
-from starlette.datastructures import UploadFile, Headers
+import asyncio
+import hashlib
+import os
+from contextlib import contextmanager
+from functools import partial
+from typing import AsyncGenerator, BinaryIO, Callable, Optional, Set
+from fastapi import status
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import UploadFile, Headers, FormData
 from starlette.formparsers import MultiPartParser, MultiPartException, _user_safe_decode
 from starlette.requests import parse_options_header
 
-from src.storages.base import BaseStorage
+from src.settings import settings
+from src.storages.base import BaseStorage, get_format_by_mime, sniff_format
+from src.storages.compression import Compressor, get_compressor, get_storage_encoding
 from src.storages.registry import LOCAL_STORAGE, STORAGES
+from src.storages.space import DISK_FULL_ERRORS, Reservation
+from src.storages.writer import WritePipeline, writer_executor
+
+
+class UploadRejected(MultiPartException):
+    def __init__(self, message: str, status_code: int) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@contextmanager
+def reject_when_disk_full():
+    try:
+        yield
+    except OSError as e:
+        if e.errno in DISK_FULL_ERRORS:
+            raise UploadRejected('Not enough free space', status.HTTP_507_INSUFFICIENT_STORAGE) from e
+        raise
+
+
+def get_content_length(headers: Headers) -> Optional[int]:
+    try:
+        content_length = int(headers['content-length'])
+    except (KeyError, ValueError):
+        return None
+    return content_length if content_length >= 0 else None
+
+
+class TargetUploadFile(UploadFile):
+    """
+    Calculate sha256 and detect the format of the content while it is written to the target file,
+    reject the upload as soon as it is too large or its format is not allowed.
+    Compressible formats are compressed while written if STORAGE_COMPRESSION is set,
+    so nothing is written until the format is known.
+    Parser chunks are collected to buffers of UPLOAD_WRITE_BUFFER_SIZE, hashed, compressed and written
+    by the writer threads, see WritePipeline.
+    Files with a size hint from UPLOAD_PREALLOCATE_MIN_SIZE are preallocated,
+    written bytes are taken from the reservation of the request.
+    Without a file, the target file is created by open_file in a writer thread before the first write.
+    """
+
+    def __init__(
+            self,
+            *args,
+            max_size: Optional[int] = None,
+            allowed_formats: Optional[Set[str]] = None,
+            trust_content_type: bool = False,
+            size_hint: Optional[int] = None,
+            reservation: Optional[Reservation] = None,
+            open_file: Optional[Callable[[], BinaryIO]] = None,
+            **kwargs
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self.max_size = max_size
+        self.allowed_formats = allowed_formats
+        self.size_hint = size_hint
+        self.reservation = reservation
+        self._queued = 0  # bytes passed to the pipeline
+        self._accounted = 0  # bytes taken from the reservation
+        self._sha256 = hashlib.sha256()
+        self._buffer = bytearray()
+        self._open_file = open_file
+        self._opening: Optional[asyncio.Future] = None
+        self._pipeline: Optional[WritePipeline] = None
+        if self.file is not None:
+            self._pipeline = WritePipeline(self.file.fileno())
+        self._finished = False
+        self._file_format: Optional[str] = None
+        self._format_detected = False
+        self._format_checked = False
+        self._compressor: Optional[Compressor] = None
+        self.content_encoding: Optional[str] = None
+        if trust_content_type:
+            self._file_format = get_format_by_mime(self.content_type)
+            if self._file_format is not None:
+                self._format_detected = True
+                self._set_encoding()
+
+    @property
+    def sha256(self) -> str:
+        return self._sha256.hexdigest()
+
+    @property
+    def file_format(self) -> Optional[str]:
+        if not self._format_detected:
+            # file is smaller than MIME_SNIFF_SIZE
+            self._detect_format()
+        return self._file_format
+
+    def _detect_format(self) -> None:
+        head = bytes(self._buffer[:settings.MIME_SNIFF_SIZE])
+        self._file_format = sniff_format(head) if head else None
+        self._format_detected = True
+        self._set_encoding()
+
+    def _set_encoding(self) -> None:
+        self.content_encoding = get_storage_encoding(self._file_format)
+        if self.content_encoding is not None:
+            self._compressor = get_compressor(self.content_encoding)
+
+    def check_format(self) -> None:
+        if self._format_checked or self.allowed_formats is None:
+            return
+        self._format_checked = True
+        if self.file_format not in self.allowed_formats:
+            raise UploadRejected(
+                f'File format {self.file_format} is not allowed',
+                status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
+            )
+
+    def _process(self, data: bytes) -> bytes:
+        # called in a writer thread, hashlib and zlib release the GIL
+        self._sha256.update(data)
+        if self._compressor is not None:
+            data = self._compressor.compress(data)
+        return data
+
+    def _process_last(self, data: bytes) -> bytes:
+        data = self._process(data)
+        if self._compressor is not None:
+            data += self._compressor.flush()
+            self._compressor = None
+        return data
+
+    async def finish(self) -> None:
+        """
+        Write the rest of the content and wait for the disk, called when the part ends
+        """
+        if self._finished:
+            return
+        self._finished = True
+        if not self._format_detected:
+            # file is smaller than MIME_SNIFF_SIZE
+            await run_in_threadpool(self._detect_format)
+        self.check_format()
+        data, self._buffer = self._buffer, bytearray()
+        with reject_when_disk_full():
+            await self._write_buffer(data, self._process_last)
+            await self._pipeline.close()
+
+    async def seek(self, offset: int) -> None:
+        # the parser seeks files to the start when the part ends
+        await self.finish()
+        await super().seek(offset)
+
+    async def abort(self) -> None:
+        """
+        Stop writing, so the file can be removed
+        """
+        if self.file is None and self._opening is not None:
+            try:
+                await self._ensure_file()
+            except Exception:
+                return
+        if self._pipeline is not None:
+            await self._pipeline.abort()
+
+    async def _ensure_file(self) -> None:
+        if self.file is not None:
+            return
+        if self._opening is None:
+            self._opening = asyncio.get_running_loop().run_in_executor(writer_executor, self._open_file)
+        # the file of a cancelled request is still opened, so it can be removed
+        self.file = await asyncio.shield(self._opening)
+        self._pipeline = WritePipeline(self.file.fileno())
+
+    async def write(self, data: bytes) -> None:
+        if self.size is not None:
+            self.size += len(data)
+            if self.max_size is not None and self.size > self.max_size:
+                raise UploadRejected(
+                    f'File is too large. Maximum size is {self.max_size} bytes.',
+                    status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+                )
+        self._buffer += data
+        if not self._format_detected:
+            if len(self._buffer) < settings.MIME_SNIFF_SIZE:
+                return
+            await run_in_threadpool(self._detect_format)
+            self.check_format()
+        if len(self._buffer) >= settings.UPLOAD_WRITE_BUFFER_SIZE:
+            data, self._buffer = self._buffer, bytearray()
+            with reject_when_disk_full():
+                await self._write_buffer(data, self._process)
+
+    async def _write_buffer(self, data: bytes, transform: Callable[[bytes], bytes]) -> None:
+        await self._ensure_file()
+        if self._queued == 0 and self.size_hint and 0 < settings.UPLOAD_PREALLOCATE_MIN_SIZE <= self.size_hint:
+            size_hint = min(self.size_hint, self.max_size or self.size_hint)
+            await self._pipeline.preallocate(size_hint)
+            self._account(size_hint)
+        await self._pipeline.write(data, transform)
+        self._queued += len(data)
+        self._account(self._queued)
+
+    def _account(self, size: int) -> None:
+        if self.reservation is not None and size > self._accounted:
+            self.reservation.consume(size - self._accounted)
+            self._accounted = size
 
 
 class TargetFileMultipartParser(MultiPartParser):
@@ -15,14 +223,74 @@ class TargetFileMultipartParser(MultiPartParser):
 
     max_file_size = 1024 * 1024 * 1024 * 10  # 10 gb
 
-    def __init__(self, *args, storage=STORAGES[LOCAL_STORAGE], **kwargs) -> None:
+    def __init__(
+            self,
+            *args,
+            storage=STORAGES[LOCAL_STORAGE],
+            reservation: Optional[Reservation] = None,
+            **kwargs
+    ) -> None:
         super().__init__(*args, **kwargs)
         self.storage: BaseStorage = storage
-        self._files_to_close_on_error: list[BinaryIO[bytes]] = []
+        self.reservation = reservation
+        self.content_length = get_content_length(self.headers)
+        self.received = 0
+        self.stream = self.count_received(self.stream)
+        # not in _files_to_close_on_error, their writes have to be stopped before the files are closed
+        self._upload_files: list[TargetUploadFile] = []
+
+    async def parse(self) -> FormData:
+        try:
+            form_data = await super().parse()
+            for _, value in form_data.multi_items():
+                if isinstance(value, TargetUploadFile):
+                    # finished when their parts end, unless the body ended without the closing boundary
+                    await value.finish()
+            return form_data
+        except BaseException:
+            # don't leave partial or rejected files in the storage, also on disconnects and cancellation,
+            # nothing else removes files without metadata
+            await self.remove_files()
+            raise
+
+    async def remove_files(self) -> None:
+        for upload_file in self._upload_files:
+            await upload_file.abort()
+            file = upload_file.file
+            if file is None:
+                # nothing was written
+                continue
+            file.close()
+            try:
+                os.remove(file.name)
+            except FileNotFoundError:
+                pass
+
+    async def count_received(self, stream: AsyncGenerator[bytes, None]) -> AsyncGenerator[bytes, None]:
+        async for chunk in stream:
+            self.received += len(chunk)
+            yield chunk
+
+    def get_size_hint(self) -> Optional[int]:
+        """
+        Expected size of the current part: its Content-Length, or the rest of the body for single file uploads
+        """
+        for name, value in self._current_part.item_headers:
+            if name.lower() == b'content-length':
+                try:
+                    return int(value)
+                except ValueError:
+                    return None
+        if self.max_files == 1 and self.content_length is not None:
+            return self.content_length - self.received
+        return None
 
     def get_file_to_write(self, filename: str) -> BinaryIO:
+        """
+        Create the target file, called in a writer thread
+        """
         storage_filename = self.storage.filename_to_storage_filename(filename)
-        storage_upload_path = self.storage.get_upload_path(storage_filename)
+        storage_upload_path = self.storage.get_upload_path(storage_filename, create_dirs=True)
         return open(storage_upload_path, 'w+b')
 
     def on_headers_finished(self) -> None:
@@ -47,15 +315,20 @@ class TargetFileMultipartParser(MultiPartParser):
 
             filename = _user_safe_decode(options[b"filename"], self._charset)
 
-            file = self.get_file_to_write(filename)
-            self._files_to_close_on_error.append(file)
-
-            self._current_part.file = UploadFile(
-                file=file,  # type: ignore[arg-type]
+            # the file is created when the first data of the part is written, not on the event loop
+            self._current_part.file = TargetUploadFile(
+                file=None,  # type: ignore[arg-type]
+                open_file=partial(self.get_file_to_write, filename),
                 size=0,
                 filename=filename,
                 headers=Headers(raw=self._current_part.item_headers),
+                max_size=self.max_file_size,
+                allowed_formats=settings.ALLOWED_FILE_FORMATS,
+                trust_content_type=settings.TRUST_DECLARED_CONTENT_TYPE,
+                size_hint=self.get_size_hint(),
+                reservation=self.reservation,
             )
+            self._upload_files.append(self._current_part.file)
         else:
             self._current_fields += 1
             if self._current_fields > self.max_fields:
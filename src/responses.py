@@ -0,0 +1,398 @@
+import os
+import stat
+import uuid
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, BinaryIO, List, Mapping, Optional, Tuple
+from urllib.parse import quote
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response, StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+from src.settings import settings
+from src.storages.base import FileStream
+from src.storages.compression import get_decompressor
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def make_etag(file_id: uuid.UUID, size: int) -> str:
+    # The content of a file id never changes, so id + size of the stored file is a strong validator
+    # which is also stable between nodes and replicas
+    return f'"{file_id.hex}-{size:x}"'
+
+
+def parse_range_header(range_header: str, file_size: int) -> List[Tuple[int, int]]:
+    """
+    Parse `Range: bytes=...` into a list of inclusive (start, end) pairs.
+    Empty list means the header should be ignored and the full file returned.
+    """
+    unit, _, ranges_spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or not ranges_spec:
+        return []
+
+    ranges = []
+    for spec in ranges_spec.split(','):
+        spec = spec.strip()
+        if not spec:
+            continue
+        start, sep, end = spec.partition('-')
+        if not sep:
+            return []
+        try:
+            if start == '':
+                # suffix range: last N bytes
+                suffix_length = int(end)
+                if suffix_length <= 0:
+                    continue
+                ranges.append((max(file_size - suffix_length, 0), file_size - 1))
+            else:
+                first, last = int(start), int(end) if end else file_size - 1
+                if first >= file_size:
+                    continue
+                if first > last:
+                    return []
+                ranges.append((first, min(last, file_size - 1)))
+        except ValueError:
+            return []
+
+    if not ranges:
+        raise RangeNotSatisfiable
+    return merge_ranges(ranges)
+
+
+def merge_ranges(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """
+    Coalesce overlapping and adjacent ranges so clients can't make us send the same bytes twice
+    """
+    merged: List[Tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class MediaFileResponse(FileResponse):
+    """
+    FileResponse for immutable media files:
+    - strong ETag built from file id and size
+    - If-None-Match / If-Modified-Since -> 304
+    - single and multiple byte ranges -> 206
+    - the body is sent by the server when it supports the pathsend (whole file)
+      or zerocopysend (whole file and ranges, os.sendfile) ASGI extensions
+    - the body is read from the given opened file instead of the path, it is closed by the response
+    """
+    chunk_size = settings.MEDIA_CHUNK_SIZE
+    zerocopy = False
+
+    def __init__(
+            self,
+            path: str,
+            file_id: uuid.UUID,
+            headers: Optional[Mapping[str, str]] = None,
+            cache_control: str = settings.MEDIA_CACHE_CONTROL,
+            file: Optional[BinaryIO] = None,
+            **kwargs,
+    ) -> None:
+        super().__init__(path, headers=headers, **kwargs)
+        self.file_id = file_id
+        self.file = file  # already opened file of the path, sent even if the path is deleted meanwhile
+        self.headers.setdefault('cache-control', cache_control)
+        self.headers.setdefault('accept-ranges', 'bytes')
+
+    def set_stat_headers(self, stat_result: os.stat_result) -> None:
+        self.headers.setdefault('etag', self.make_etag(self.file_id, stat_result))
+        super().set_stat_headers(stat_result)
+
+    @staticmethod
+    def make_etag(file_id: uuid.UUID, stat_result: os.stat_result) -> str:
+        return make_etag(file_id, stat_result.st_size)
+
+    def is_not_modified(self, request_headers: Headers) -> bool:
+        if_none_match = request_headers.get('if-none-match')
+        if if_none_match is not None:
+            etag = self.headers['etag']
+            tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+            return '*' in tags or etag in tags
+
+        if_modified_since = request_headers.get('if-modified-since')
+        if if_modified_since is not None:
+            try:
+                since = parsedate_to_datetime(if_modified_since)
+                last_modified = parsedate_to_datetime(self.headers['last-modified'])
+            except (TypeError, ValueError):
+                return False
+            return last_modified <= since
+
+        return False
+
+    def is_range_allowed(self, request_headers: Headers) -> bool:
+        if_range = request_headers.get('if-range')
+        if if_range is None:
+            return True
+        return if_range in (self.headers['etag'], self.headers['last-modified'])
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await self.send_file(scope, receive, send)
+        finally:
+            if self.file is not None:
+                self.file.close()
+
+    async def send_file(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if self.stat_result is None:
+            try:
+                if self.file is not None:
+                    self.stat_result = os.fstat(self.file.fileno())
+                else:
+                    self.stat_result = await anyio.to_thread.run_sync(os.stat, self.path)
+            except FileNotFoundError:
+                raise RuntimeError(f'File at path {self.path} does not exist.')
+            if not stat.S_ISREG(self.stat_result.st_mode):
+                raise RuntimeError(f'File at path {self.path} is not a file.')
+            self.set_stat_headers(self.stat_result)
+
+        request_headers = Headers(scope=scope)
+        if self.is_not_modified(request_headers):
+            await self.send_not_modified(send)
+            return
+
+        range_header = request_headers.get('range')
+        ranges = []
+        file_size = self.stat_result.st_size
+        if range_header is not None and self.is_range_allowed(request_headers):
+            try:
+                ranges = parse_range_header(range_header, file_size)
+            except RangeNotSatisfiable:
+                await self.send_range_not_satisfiable(send, file_size)
+                return
+
+        self.zerocopy = 'http.response.zerocopysend' in (scope.get('extensions') or {})
+        if not ranges and not self.zerocopy and self.file is None:
+            # pathsend if the server supports it, reading by chunk_size otherwise
+            await super().__call__(scope, receive, send)
+            return
+
+        if not ranges:
+            await self.send_whole_file(scope, send, file_size)
+        elif len(ranges) == 1:
+            await self.send_single_range(scope, send, ranges[0], file_size)
+        else:
+            await self.send_multiple_ranges(scope, send, ranges, file_size)
+
+        if self.background is not None:
+            await self.background()
+
+    async def open_file(self) -> anyio.AsyncFile:
+        if self.file is not None:
+            return anyio.wrap_file(self.file)
+        return await anyio.open_file(self.path, mode='rb')
+
+    async def send_not_modified(self, send: Send) -> None:
+        headers = [
+            (name, value) for name, value in self.raw_headers
+            if name in (b'etag', b'last-modified', b'cache-control', b'date', b'vary')
+        ]
+        await send({'type': 'http.response.start', 'status': 304, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+    async def send_range_not_satisfiable(self, send: Send, file_size: int) -> None:
+        headers = [
+            (b'content-range', f'bytes */{file_size}'.encode('latin-1')),
+            (b'content-length', b'0'),
+        ]
+        await send({'type': 'http.response.start', 'status': 416, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+    async def send_whole_file(self, scope: Scope, send: Send, file_size: int) -> None:
+        await send({'type': 'http.response.start', 'status': self.status_code, 'headers': self.raw_headers})
+        if scope['method'].upper() == 'HEAD' or file_size == 0:
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            return
+
+        async with await self.open_file() as file:
+            await self.send_file_range(file, send, 0, file_size - 1, more_body=False)
+
+    async def send_single_range(self, scope: Scope, send: Send, byte_range: Tuple[int, int], file_size: int) -> None:
+        start, end = byte_range
+        self.headers['content-range'] = f'bytes {start}-{end}/{file_size}'
+        self.headers['content-length'] = str(end - start + 1)
+        await send({'type': 'http.response.start', 'status': 206, 'headers': self.raw_headers})
+        if scope['method'].upper() == 'HEAD':
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            return
+
+        async with await self.open_file() as file:
+            await self.send_file_range(file, send, start, end, more_body=False)
+
+    async def send_multiple_ranges(
+            self, scope: Scope, send: Send, ranges: List[Tuple[int, int]], file_size: int
+    ) -> None:
+        boundary = uuid.uuid4().hex
+        content_type = self.headers.get('content-type', 'application/octet-stream')
+        part_headers = [
+            (
+                f'--{boundary}\r\n'
+                f'Content-Type: {content_type}\r\n'
+                f'Content-Range: bytes {start}-{end}/{file_size}\r\n\r\n'
+            ).encode('latin-1')
+            for start, end in ranges
+        ]
+        closing = f'\r\n--{boundary}--\r\n'.encode('latin-1')
+        content_length = (
+            sum(len(header) for header in part_headers)
+            + sum(end - start + 1 for start, end in ranges)
+            + 2 * (len(ranges) - 1)  # \r\n between parts
+            + len(closing)
+        )
+
+        self.headers['content-type'] = f'multipart/byteranges; boundary={boundary}'
+        self.headers['content-length'] = str(content_length)
+        await send({'type': 'http.response.start', 'status': 206, 'headers': self.raw_headers})
+        if scope['method'].upper() == 'HEAD':
+            await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+            return
+
+        async with await self.open_file() as file:
+            for i, (header, (start, end)) in enumerate(zip(part_headers, ranges)):
+                prefix = header if i == 0 else b'\r\n' + header
+                await send({'type': 'http.response.body', 'body': prefix, 'more_body': True})
+                await self.send_file_range(file, send, start, end, more_body=True)
+        await send({'type': 'http.response.body', 'body': closing, 'more_body': False})
+
+    async def send_file_range(self, file, send: Send, start: int, end: int, more_body: bool) -> None:
+        if self.zerocopy:
+            await send({
+                'type': 'http.response.zerocopysend',
+                'file': file.wrapped,
+                'offset': start,
+                'count': end - start + 1,
+                'more_body': more_body,
+            })
+            return
+
+        await file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await file.read(min(self.chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            await send({
+                'type': 'http.response.body',
+                'body': chunk,
+                'more_body': more_body or remaining > 0,
+            })
+
+
+def content_disposition(filename: str, disposition: str = 'inline') -> str:
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"{disposition}; filename*=utf-8''{quoted}"
+    return f'{disposition}; filename="{filename}"'
+
+
+class OffloadFileResponse(Response):
+    """
+    Empty response telling the web server in front of the app to send the file itself:
+    - X-Accel-Redirect (nginx) - uri of the file in an internal location
+    - X-Sendfile (apache, lighttpd) - absolute path of the file
+    Conditional requests and ranges are handled by the web server.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            root: str,
+            header: str = settings.FILES_OFFLOAD_HEADER,
+            location: str = settings.FILES_OFFLOAD_LOCATION,
+            filename: Optional[str] = None,
+            media_type: Optional[str] = None,
+            headers: Optional[Mapping[str, str]] = None,
+            cache_control: str = settings.MEDIA_CACHE_CONTROL,
+    ) -> None:
+        headers = {**(headers or {}), 'cache-control': cache_control}
+        if filename:
+            headers['content-disposition'] = content_disposition(filename)
+        if header.lower() == 'x-accel-redirect':
+            relative_path = os.path.relpath(path, root).replace(os.sep, '/')
+            headers[header] = quote(f"{location.rstrip('/')}/{relative_path}")
+        else:
+            headers[header] = path
+        super().__init__(headers=headers, media_type=media_type or 'application/octet-stream')
+
+
+class DecodedFileResponse(StreamingResponse):
+    """
+    Decompress a file stored compressed for clients which don't accept its encoding,
+    the file is read from the path, an opened file or the chunks of a storage stream
+    """
+
+    def __init__(
+            self,
+            path: str | BinaryIO | AsyncIterator[bytes],
+            encoding: str,
+            media_type: Optional[str] = None,
+            cache_control: str = settings.MEDIA_CACHE_CONTROL,
+            chunk_size: int = settings.MEDIA_CHUNK_SIZE,
+    ) -> None:
+        chunks = path if isinstance(path, AsyncIterator) else self.read(path, chunk_size)
+        super().__init__(
+            self.decode(chunks, encoding),
+            media_type=media_type or 'application/octet-stream',
+            headers={'cache-control': cache_control, 'vary': 'Accept-Encoding'},
+        )
+
+    @staticmethod
+    async def read(path: str | BinaryIO, chunk_size: int) -> AsyncIterator[bytes]:
+        file = await anyio.open_file(path, mode='rb') if isinstance(path, str) else anyio.wrap_file(path)
+        async with file:
+            while chunk := await file.read(chunk_size):
+                yield chunk
+
+    @staticmethod
+    async def decode(chunks: AsyncIterator[bytes], encoding: str) -> AsyncIterator[bytes]:
+        decompressor = get_decompressor(encoding)
+        async for chunk in chunks:
+            data = await anyio.to_thread.run_sync(decompressor.decompress, chunk)
+            if data:
+                yield data
+
+
+class StorageFileResponse(StreamingResponse):
+    """
+    File streamed from a storage as it is read, e.g. proxied from the cloud storage,
+    206 for a byte range
+    """
+
+    def __init__(
+            self,
+            stream: FileStream,
+            file_id: uuid.UUID,
+            byte_range: Optional[Tuple[int, int]] = None,
+            media_type: Optional[str] = None,
+            headers: Optional[Mapping[str, str]] = None,
+            cache_control: str = settings.MEDIA_CACHE_CONTROL,
+    ) -> None:
+        headers = {
+            **(headers or {}),
+            'cache-control': cache_control,
+            'accept-ranges': 'bytes',
+            'content-length': str(stream.size),
+            'etag': make_etag(file_id, stream.total_size),
+        }
+        status_code = 200
+        if byte_range is not None:
+            headers['content-range'] = 'bytes {}-{}/{}'.format(*byte_range, stream.total_size)
+            status_code = 206
+        super().__init__(
+            stream.chunks,
+            status_code=status_code,
+            media_type=media_type or 'application/octet-stream',
+            headers=headers,
+        )
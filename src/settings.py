@@ -1,25 +1,95 @@
 import os
+from typing import Optional, Set
 from pydantic import PostgresDsn, DirectoryPath
 from pydantic_settings import BaseSettings
 
 
 class Settings(BaseSettings):
     RETURN_FILES_LOCALLY: bool = True  # False if nginx
+    # Let the web server send downloads: 'X-Accel-Redirect' (nginx) or 'X-Sendfile', None - stream from the app
+    FILES_OFFLOAD_HEADER: Optional[str] = None
+    FILES_OFFLOAD_LOCATION: str = '/protected-media'  # internal nginx location with alias to UPLOAD_DIR
     DSN__DB: PostgresDsn = 'postgresql+asyncpg://admin:1111@db:5432/files'
     UPLOAD_DIR: DirectoryPath = os.path.join(
         os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
         "media"
     )
+    # Files are stored in UPLOAD_DIR/ab/cd/abcd...ext, 0 levels - flat UPLOAD_DIR
+    UPLOAD_DIR_SHARD_LEVELS: int = 2
+    UPLOAD_DIR_SHARD_WIDTH: int = 2
     MEDIA_ROOT: str = 'media'
+    MAX_FILES_PER_UPLOAD: int = 200
+    MIME_SNIFF_SIZE: int = 4096  # bytes from the start of the file used to detect the format
+    TRUST_DECLARED_CONTENT_TYPE: bool = False  # use content-type of the part instead of libmagic if it is known
+    ALLOWED_FILE_FORMATS: Optional[Set[str]] = None  # formats from MIME_FORMAT, None - any
+    # Uploads are written by UPLOAD_WRITER_THREADS in buffers of UPLOAD_WRITE_BUFFER_SIZE,
+    # reading of the request pauses when UPLOAD_WRITE_QUEUE_DEPTH buffers of an upload wait for the disk
+    UPLOAD_WRITE_BUFFER_SIZE: int = 1024 * 1024
+    UPLOAD_WRITE_QUEUE_DEPTH: int = 4
+    UPLOAD_WRITER_THREADS: int = 8
+    UPLOAD_FSYNC: bool = False  # fsync uploaded files before the response
+    # Uploads are rejected with 507 unless UPLOAD_DIR keeps this much free space after them
+    UPLOAD_MIN_FREE_SPACE: int = 1024 * 1024 * 1024
+    UPLOAD_PREALLOCATE_MIN_SIZE: int = 8 * 1024 * 1024  # posix_fallocate files of this size hint, 0 - disabled
+    # A resumable upload is leased to the PATCH request receiving it, the lease is renewed while the body is read
+    UPLOAD_SESSION_LEASE: int = 300  # seconds
+    # Store text formats compressed: 'gzip' or 'zstd' (requires zstandard), None - as uploaded
+    STORAGE_COMPRESSION: Optional[str] = None
+    STORAGE_COMPRESSION_LEVEL: Optional[int] = None  # None - default level of the encoding
+    MEDIA_CHUNK_SIZE: int = 1024 * 1024  # read size when the server can't send files itself
+    MEDIA_CACHE_CONTROL: str = 'public, max-age=31536000, immutable'  # content of an uuid never changes
+    METADATA_CACHE_SIZE: int = 100_000  # 0 to disable
+    # The cache is per process, deletes by other workers or the cleanup command aren't seen by it:
+    # metadata of a deleted file is served for up to this long, an entry is dropped when its file is missing
+    METADATA_CACHE_TTL: int = 30  # seconds
+    METADATA_CACHE_NEGATIVE_TTL: int = 5  # seconds to remember unknown ids
+    ACCESS_FLUSH_INTERVAL: float = 10  # seconds between bulk updates of files last access time
+    ACCESS_BUFFER_SIZE: int = 10_000  # flush earlier when so many files are accessed
     LOG_DIR: str = os.path.join(
         os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
         "logs"
     )
+    LOG_LEVEL: str = 'DEBUG'  # of stdout, the files in LOG_DIR get INFO and ERROR
+    ACCESS_LOG_SAMPLE_RATE: float = 1.0  # share of logged requests, errors and slow requests are always logged
+    ACCESS_LOG_SLOW_SECONDS: float = 1.0
+    # Repeated warnings, e.g. files missing on every download, are logged LOG_RATE_LIMIT times per interval
+    LOG_RATE_LIMIT: int = 10
+    LOG_RATE_LIMIT_INTERVAL: float = 60  # seconds
+
+    # Resized images, /media/{uuid}?w=320&fmt=webp
+    DERIVATIVES_DIR: str = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "derivatives"
+    )
+    DERIVATIVES_CACHE_SIZE: int = 1024 * 1024 * 1024  # bytes
+    DERIVATIVES_WORKERS: int = 2  # processes rendering derivatives
+    DERIVATIVE_MAX_WIDTH: int = 2048
 
     if not os.path.exists(UPLOAD_DIR):
         os.mkdir(UPLOAD_DIR)
 
     BUCKET_NAME: str = 'files'
+    # Files missing locally are fetched from the cloud storage into CLOUD_CACHE_DIR, streamed meanwhile,
+    # least recently used are deleted above CLOUD_CACHE_SIZE bytes, 0 - local misses are proxied without caching
+    CLOUD_CACHE_DIR: str = os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        "cloud-cache"
+    )
+    CLOUD_CACHE_SIZE: int = 10 * 1024 * 1024 * 1024
+    # Copy to the cloud by the replicate_files command instead of request background tasks,
+    # enable only together with running the command, otherwise nothing is copied
+    REPLICATION_OUTBOX: bool = False
+    METRICS_DB_TIMEOUT: float = 2  # seconds, /metrics skips the replication backlog if the query is slower
+    S3_MAX_POOL_CONNECTIONS: int = 50
+    S3_KEEPALIVE_TIMEOUT: int = 12  # seconds, s3 closes idle connections after 20
+    S3_MULTIPART_THRESHOLD: int = 64 * 1024 * 1024  # files from this size are uploaded by parts
+    S3_MULTIPART_PART_SIZE: int = 16 * 1024 * 1024  # min 5 mb
+    S3_MULTIPART_CONCURRENCY: int = 8
+    S3_MULTIPART_RETRIES: int = 3
+    S3_PRESIGNED_URL_EXPIRES: int = 3600  # seconds
+
+    # Store identical content once, new uploads reference the existing file
+    DEDUPLICATE_UPLOADS: bool = False
 
 
 settings = Settings()
@@ -1,16 +1,39 @@
+import asyncio
 import os
 import uuid
 import magic
 from datetime import datetime
-from typing import Optional, BinaryIO, List
+from functools import lru_cache
+from typing import Optional, BinaryIO, List, AsyncIterator, Tuple
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from uuid import UUID
 from aiofiles.base import AsyncBase
 from fastapi import UploadFile, Request
 
+from src.metrics import FORMAT_DETECTION, BACKGROUND_COPIES
 from src.settings import settings
-from src.storages.constants import MIME_FORMAT
+from src.storages.constants import MIME_FORMAT, FORMAT_MIME
+
+
+@lru_cache(maxsize=1024)
+def get_format_by_mime(mime: Optional[str]) -> Optional[str]:
+    """
+    Accepts content-type header values, e.g. `text/plain; charset=utf-8`
+    """
+    if not mime:
+        return None
+    return MIME_FORMAT.get(mime.split(';', 1)[0].strip().lower())
+
+
+def get_mime_by_format(file_format: Optional[str]) -> Optional[str]:
+    return FORMAT_MIME.get(file_format)
+
+
+def sniff_format(head: bytes) -> Optional[str]:
+    with FORMAT_DETECTION.time():
+        mime = magic.from_buffer(head, mime=True)
+    return get_format_by_mime(mime)
 
 
 @dataclass
@@ -20,11 +43,30 @@ class FileInfo:
     file_format: Optional[str] = None
     original_filename: Optional[str] = None
     extension: Optional[str] = None
+    sha256: Optional[str] = None
+    blob_filename: Optional[str] = None  # set if the content is stored in the file of another upload
+    blob_sha256: Optional[str] = None  # set if the upload holds a reference to the blob, see register_blob
+    content_encoding: Optional[str] = None  # compression of the stored file, see storages.compression
 
     @property
     def storage_filename(self):
+        if self.blob_filename:
+            return self.blob_filename
         return f'{self.name}.{self.extension}'
 
+    @property
+    def download_filename(self) -> Optional[str]:
+        if self.original_filename and self.extension:
+            return f'{self.original_filename}.{self.extension}'
+        return self.original_filename
+
+
+@dataclass
+class FileStream:
+    chunks: AsyncIterator[bytes]
+    size: int  # bytes in chunks
+    total_size: int  # size of the whole file, differs for a byte range
+
 
 @dataclass
 class StatFileInfo:
@@ -37,12 +79,29 @@ class BaseStorage(ABC):
     def __init__(self, path: str) -> None:
         self.path = path
 
+    async def open(self) -> None:
+        """
+        Acquire long-lived resources (connections), called on application startup
+        """
+
+    async def close(self) -> None:
+        ...
+
     def get_file_format(self, file: BinaryIO) -> Optional[str]:
-        mime = magic.from_buffer(file.read(4048), mime=True)
-        return MIME_FORMAT.get(mime)
+        file.seek(0)
+        head = file.read(settings.MIME_SNIFF_SIZE)
+        file.seek(0)
+        return sniff_format(head)
+
+    def get_path_format(self, path: str) -> Optional[str]:
+        with open(path, 'rb') as f:
+            return self.get_file_format(f)
 
     @abstractmethod
-    async def list_files(self) -> List[StatFileInfo]:
+    def list_files(self, batch_size: int = 1000) -> AsyncIterator[List[StatFileInfo]]:
+        """
+        Yield files of the storage in batches, so memory doesn't depend on the number of files
+        """
         ...
 
     def generate_stem(self) -> UUID:
@@ -71,10 +130,39 @@ class BaseStorage(ABC):
     async def upload_file(self, file: str | UploadFile, **kwargs) -> FileInfo:
         ...
 
+    async def upload_files(self, files: List[str], concurrency: int = 8) -> None:
+        """
+        Upload several files concurrently, a failed file doesn't stop others
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def upload(file: str):
+            async with semaphore:
+                try:
+                    return await self.upload_file(file)
+                finally:
+                    BACKGROUND_COPIES.dec()
+
+        BACKGROUND_COPIES.inc(len(files))
+        await asyncio.gather(*(upload(file) for file in files), return_exceptions=True)
+
     @abstractmethod
     async def get_file(self, filepath: str, open_options: Optional[dict] = None, **kwargs) -> AsyncBase:
         ...
 
+    @abstractmethod
+    async def stream_file(
+            self,
+            filepath: str,
+            byte_range: Optional[Tuple[int, int]] = None,
+            chunk_size: int = settings.MEDIA_CHUNK_SIZE,
+    ) -> FileStream:
+        """
+        Content of the file or of the inclusive byte range without buffering the file,
+        FileNotFoundError is raised before the first chunk
+        """
+        ...
+
     @abstractmethod
     async def delete(self, filepath: str) -> None:
         ...
@@ -89,10 +177,12 @@ class BaseStorage(ABC):
         original_filename, extension = self.splitext(file.filename)
         return FileInfo(
             size=file.size,
-            file_format=self.get_file_format(file.file),
+            file_format=file.file_format if hasattr(file, 'file_format') else self.get_file_format(file.file),
             original_filename=original_filename,
             extension=extension,
-            name=name
+            name=name,
+            sha256=getattr(file, 'sha256', None),
+            content_encoding=getattr(file, 'content_encoding', None),
         )
 
     def get_upload_path(self, filename: str, check_exists: bool = False) -> str:
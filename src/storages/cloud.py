@@ -1,16 +1,37 @@
+import asyncio
+import math
 import os
-from typing import Optional, List
+import time
+from contextlib import AsyncExitStack
+from typing import Optional, List, AsyncIterator, Set, Tuple
 from urllib import parse
 import aioboto3
+import aiofiles
 from aiofiles.base import AsyncBase
-from botocore.exceptions import ClientError
+from aiobotocore.config import AioConfig
+from botocore.exceptions import ClientError, BotoCoreError
 from fastapi import UploadFile, Request
 from aiofiles.tempfile import TemporaryFile
 from src.logging import logger
-from .base import BaseStorage, FileInfo, StatFileInfo
+from src.metrics import S3_LATENCY, S3_ERRORS
+from src.responses import content_disposition
+from src.settings import settings
+from .base import BaseStorage, FileInfo, FileStream, StatFileInfo, get_format_by_mime, sniff_format
+
+
+# error codes of a missing object, other errors (access, throttling, 5xx) are failures of the cloud storage
+NOT_FOUND_ERRORS = {'NoSuchKey', 'NotFound', '404'}
+# complete with parts which are missing or don't match means the file is not uploaded
+NOT_UPLOADED_ERRORS = NOT_FOUND_ERRORS | {'NoSuchUpload', 'InvalidPart', 'InvalidPartOrder', 'EntityTooSmall'}
+
+
+def is_not_found(error: ClientError, codes: Set[str] = NOT_FOUND_ERRORS) -> bool:
+    return error.response.get('Error', {}).get('Code') in codes
 
 
 class CloudStorage(BaseStorage):
+    MAX_PARTS = 10000  # s3 limit
+
     def __init__(
             self,
             bucket_name: str,
@@ -24,40 +45,303 @@ class CloudStorage(BaseStorage):
         if client_options is None:
             client_options = {}
 
+        client_options.setdefault('config', AioConfig(
+            max_pool_connections=settings.S3_MAX_POOL_CONNECTIONS,
+            connector_args={'keepalive_timeout': settings.S3_KEEPALIVE_TIMEOUT},
+        ))
+
         self.session = aioboto3.Session(**session_options)
-        self.s3 = self.session.client('s3', **client_options)
+        self.client_options = client_options
         self.endpoint_url = client_options.get('endpoint_url')
+        self._client = None
+        self._client_stack: Optional[AsyncExitStack] = None
+        self._client_lock = asyncio.Lock()
         super().__init__(path)
 
+    async def open(self) -> None:
+        """
+        Create one client per process, so connections, TLS sessions and credentials are reused
+        """
+        async with self._client_lock:
+            if self._client is not None:
+                return
+            stack = AsyncExitStack()
+            self._client = await stack.enter_async_context(self.session.client('s3', **self.client_options))
+            self._client_stack = stack
+            self._client.meta.events.register('before-call.s3', self._before_call)
+            self._client.meta.events.register('after-call.s3', self._after_call)
+            self._client.meta.events.register('after-call-error.s3', self._after_call_error)
+
+    async def close(self) -> None:
+        async with self._client_lock:
+            if self._client_stack is not None:
+                await self._client_stack.aclose()
+            self._client = None
+            self._client_stack = None
+
+    async def get_client(self):
+        if self._client is None:
+            # not opened by lifespan, e.g. in a script
+            await self.open()
+        return self._client
+
+    @staticmethod
+    def _before_call(model, context, **kwargs) -> None:
+        context['metrics_operation'] = model.name
+        context['metrics_started'] = time.perf_counter()
+
+    @staticmethod
+    def _after_call(http_response, model, context, **kwargs) -> None:
+        S3_LATENCY.labels(model.name).observe(time.perf_counter() - context['metrics_started'])
+        if http_response.status_code >= 400:
+            S3_ERRORS.labels(model.name).inc()
+
+    @staticmethod
+    def _after_call_error(context, **kwargs) -> None:
+        operation = context.get('metrics_operation', 'unknown')
+        if 'metrics_started' in context:
+            S3_LATENCY.labels(operation).observe(time.perf_counter() - context['metrics_started'])
+        S3_ERRORS.labels(operation).inc()
+
+    def pool_stats(self) -> dict:
+        stats = {'max_connections': settings.S3_MAX_POOL_CONNECTIONS, 'acquired': 0, 'idle': 0}
+        if self._client is None:
+            return stats
+        http_session = self._client._endpoint.http_session
+        for session in getattr(http_session, '_sessions', {}).values():
+            connector = session.connector
+            stats['acquired'] += len(connector._acquired)
+            stats['idle'] += sum(len(conns) for conns in connector._conns.values())
+        return stats
+
     async def upload_file(self, file: str | UploadFile, **kwargs) -> Optional[FileInfo]:
         try:
             if isinstance(file, str):
                 filename = os.path.basename(file)
                 filepath = os.path.join(self.path, filename)
-                async with self.s3 as s3:
+                s3 = await self.get_client()
+                if os.path.getsize(file) >= settings.S3_MULTIPART_THRESHOLD:
+                    await self.multipart_upload(s3, file, filepath, **kwargs.get('ExtraArgs', {}))
+                else:
                     await s3.upload_file(file, Bucket=self.bucket_name, Key=filepath, **kwargs)
             else:
                 metadata = self.get_metadata(file)
                 filepath = os.path.join(self.path, metadata.storage_filename)
-                async with self.s3 as s3:
-                    await s3.upload_fileobj(file.file, Bucket=self.bucket_name, Key=filepath, **kwargs)
+                s3 = await self.get_client()
+                await s3.upload_fileobj(file.file, Bucket=self.bucket_name, Key=filepath, **kwargs)
 
                 return metadata
         except Exception as e:
             logger.error(e)
             raise e
 
+    async def multipart_upload(self, s3, file: str, key: str, **kwargs) -> None:
+        """
+        Upload parts of the local file concurrently, at most S3_MULTIPART_CONCURRENCY parts are in memory.
+        The multipart upload is aborted on failure, so no orphan parts are left in the bucket.
+        """
+        size = os.path.getsize(file)
+        part_size = self.get_part_size(size)
+        upload = await s3.create_multipart_upload(Bucket=self.bucket_name, Key=key, **kwargs)
+        upload_id = upload['UploadId']
+        offsets = iter(enumerate(range(0, size, part_size), start=1))
+        parts = []
+
+        async def upload_parts() -> None:
+            # workers take the next part, only S3_MULTIPART_CONCURRENCY parts are read and sent at once
+            for part_number, offset in offsets:
+                async with aiofiles.open(file, 'rb') as f:
+                    await f.seek(offset)
+                    body = await f.read(part_size)
+                response = await self.retry(
+                    s3.upload_part,
+                    Bucket=self.bucket_name,
+                    Key=key,
+                    UploadId=upload_id,
+                    PartNumber=part_number,
+                    Body=body,
+                )
+                parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
+
+        workers = min(settings.S3_MULTIPART_CONCURRENCY, math.ceil(size / part_size))
+        tasks = [asyncio.create_task(upload_parts()) for _ in range(workers)]
+        try:
+            await asyncio.gather(*tasks)
+            await s3.complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': sorted(parts, key=lambda part: part['PartNumber'])},
+            )
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            # a part in flight could be stored after the abort and left in the bucket
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await s3.abort_multipart_upload(Bucket=self.bucket_name, Key=key, UploadId=upload_id)
+            raise
+
+    @classmethod
+    def get_part_size(cls, size: int) -> int:
+        return max(settings.S3_MULTIPART_PART_SIZE, math.ceil(size / cls.MAX_PARTS))
+
+    async def generate_upload_url(
+            self,
+            filepath: str,
+            content_type: Optional[str] = None,
+            expires_in: int = settings.S3_PRESIGNED_URL_EXPIRES,
+    ) -> str:
+        """
+        Presigned PUT, the client uploads the file directly to the bucket
+        """
+        params = {'Bucket': self.bucket_name, 'Key': self.get_upload_path(filepath)}
+        if content_type:
+            params['ContentType'] = content_type
+        s3 = await self.get_client()
+        return await s3.generate_presigned_url('put_object', Params=params, ExpiresIn=expires_in)
+
+    async def create_presigned_multipart_upload(
+            self,
+            filepath: str,
+            size: int,
+            expires_in: int = settings.S3_PRESIGNED_URL_EXPIRES,
+    ) -> Tuple[str, int, List[str]]:
+        """
+        Returns upload id, part size and presigned PUT urls of the parts.
+        The client sends ETags of the uploaded parts to complete_multipart_upload.
+        """
+        key = self.get_upload_path(filepath)
+        part_size = self.get_part_size(size)
+        s3 = await self.get_client()
+        upload = await s3.create_multipart_upload(Bucket=self.bucket_name, Key=key)
+        upload_id = upload['UploadId']
+        urls = [
+            await s3.generate_presigned_url(
+                'upload_part',
+                Params={'Bucket': self.bucket_name, 'Key': key, 'UploadId': upload_id, 'PartNumber': part_number},
+                ExpiresIn=expires_in,
+            )
+            for part_number in range(1, math.ceil(size / part_size) + 1)
+        ]
+        return upload_id, part_size, urls
+
+    async def complete_multipart_upload(self, filepath: str, upload_id: str, parts: List[Tuple[int, str]]) -> None:
+        s3 = await self.get_client()
+        try:
+            await s3.complete_multipart_upload(
+                Bucket=self.bucket_name,
+                Key=self.get_upload_path(filepath),
+                UploadId=upload_id,
+                MultipartUpload={'Parts': [{'PartNumber': number, 'ETag': etag} for number, etag in sorted(parts)]},
+            )
+        except ClientError as e:
+            if is_not_found(e, NOT_UPLOADED_ERRORS):
+                raise FileNotFoundError from e
+            raise
+
+    async def generate_download_url(
+            self,
+            filepath: str,
+            filename: Optional[str] = None,
+            content_encoding: Optional[str] = None,
+            expires_in: int = settings.S3_PRESIGNED_URL_EXPIRES,
+    ) -> str:
+        params = {'Bucket': self.bucket_name, 'Key': self.get_upload_path(filepath)}
+        if filename:
+            params['ResponseContentDisposition'] = content_disposition(filename)
+        if content_encoding:
+            # replicated files are stored compressed as locally
+            params['ResponseContentEncoding'] = content_encoding
+        s3 = await self.get_client()
+        return await s3.generate_presigned_url('get_object', Params=params, ExpiresIn=expires_in)
+
+    async def get_object_info(self, filepath: str) -> Tuple[int, Optional[str]]:
+        """
+        Size and format of an uploaded object: HEAD, and a ranged GET of the first bytes for the format
+        unless the declared content type is trusted
+        """
+        key = self.get_upload_path(filepath)
+        s3 = await self.get_client()
+        try:
+            head = await s3.head_object(Bucket=self.bucket_name, Key=key)
+            file_format = None
+            if settings.TRUST_DECLARED_CONTENT_TYPE:
+                file_format = get_format_by_mime(head.get('ContentType'))
+            if file_format is None and head['ContentLength']:
+                response = await s3.get_object(
+                    Bucket=self.bucket_name, Key=key, Range=f'bytes=0-{settings.MIME_SNIFF_SIZE - 1}'
+                )
+                async with response['Body'] as body:
+                    file_format = sniff_format(await body.read())
+        except ClientError as e:
+            if is_not_found(e):
+                raise FileNotFoundError from e
+            raise
+        return head['ContentLength'], file_format
+
+    @staticmethod
+    async def retry(func, *args, **kwargs):
+        for attempt in range(settings.S3_MULTIPART_RETRIES + 1):
+            try:
+                return await func(*args, **kwargs)
+            except (ClientError, BotoCoreError) as e:
+                if attempt == settings.S3_MULTIPART_RETRIES:
+                    raise
+                logger.warning(f'Retrying s3 request after error: {e}')
+                await asyncio.sleep(2 ** attempt)
+
+    async def stream_file(
+            self,
+            filepath: str,
+            byte_range: Optional[Tuple[int, int]] = None,
+            chunk_size: int = settings.MEDIA_CHUNK_SIZE,
+    ) -> FileStream:
+        """
+        Chunks of the GetObject body, the first one is available as soon as S3 responds
+        """
+        params = {'Bucket': self.bucket_name, 'Key': self.get_upload_path(filepath)}
+        if byte_range is not None:
+            params['Range'] = 'bytes={}-{}'.format(*byte_range)
+        s3 = await self.get_client()
+        try:
+            response = await s3.get_object(**params)
+        except ClientError as e:
+            # InvalidRange: the object is shorter than its metadata
+            if is_not_found(e, NOT_FOUND_ERRORS | {'InvalidRange'}):
+                raise FileNotFoundError from e
+            raise
+
+        size = response['ContentLength']
+        total_size = size
+        if 'ContentRange' in response:
+            # bytes 0-99/1234
+            total_size = int(response['ContentRange'].rsplit('/', 1)[1])
+        return FileStream(self.iter_body(response['Body'], chunk_size), size, total_size)
+
+    @staticmethod
+    async def iter_body(body, chunk_size: int) -> AsyncIterator[bytes]:
+        async with body:
+            async for chunk in body.iter_chunks(chunk_size):
+                yield chunk
+
     async def get_file(self, filepath: str, open_options: Optional[dict] = None, **kwargs) -> AsyncBase:
+        """
+        Temporary file with the whole object, see stream_file to send it without waiting for the download
+        """
         if open_options is None:
             open_options = {}
         path = os.path.join(self.path, filepath)
-        async with self.s3 as s3:
-            f = await TemporaryFile(**open_options)
-            try:
-                downloaded = await s3.download_fileobj(self.bucket_name, path, f, **kwargs)
-                return downloaded
-            except ClientError as e:
-                raise FileNotFoundError
+        s3 = await self.get_client()
+        f = await TemporaryFile(**open_options)
+        try:
+            await s3.download_fileobj(self.bucket_name, path, f, **kwargs)
+        except BaseException as e:
+            await f.close()
+            if isinstance(e, ClientError) and is_not_found(e):
+                raise FileNotFoundError from e
+            raise
+        await f.seek(0)
+        return f
 
     def get_file_url(self, request: Request, filepath: str) -> str:
         full_path = self.get_upload_path(filepath)
@@ -65,17 +349,17 @@ class CloudStorage(BaseStorage):
 
     async def delete(self, filepath: str) -> None:
         full_path = self.get_upload_path(filepath)
-        async with self.s3 as s3:
-            await s3.Object(self.bucket_name, full_path).delete()
-
-    async def list_files(self) -> List[StatFileInfo]:
-        res = []
-        async with self.s3 as s3:
-            bucket = await s3.Bucket(self.bucket_name)
-            async for obj in bucket.objects.all():
-                res.append(StatFileInfo(
-                    path=obj.key,
-                    modified_time=obj.last_modified,
-                ))
-
-        return res
+        s3 = await self.get_client()
+        await s3.delete_object(Bucket=self.bucket_name, Key=full_path)
+
+    async def list_files(self, batch_size: int = 1000) -> AsyncIterator[List[StatFileInfo]]:
+        s3 = await self.get_client()
+        paginator = s3.get_paginator('list_objects_v2')
+        async for page in paginator.paginate(Bucket=self.bucket_name, PaginationConfig={'PageSize': batch_size}):
+            batch = [
+                # local naive time like LocalStorage
+                StatFileInfo(path=obj['Key'], modified_time=obj['LastModified'].astimezone().replace(tzinfo=None))
+                for obj in page.get('Contents', [])
+            ]
+            if batch:
+                yield batch
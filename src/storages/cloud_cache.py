@@ -0,0 +1,263 @@
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, BinaryIO, Dict, List, Optional, Tuple, Union
+
+from src.logging import logger
+from src.metrics import CLOUD_CACHE
+from src.settings import settings
+from src.storages.cloud import CloudStorage
+from src.storages.registry import STORAGES, CLOUD_STORAGE
+
+TOUCH_INTERVAL = 3600  # seconds, atime of hit files is updated for the cleanup command, see CloudCache.trim
+TMP_SUFFIX = '.fetching'
+
+
+class Fetch:
+    """
+    Download of an object into the cache, clients read the part which is already written
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.tmp_path = f'{path}{TMP_SUFFIX}{os.getpid()}'
+        self.size = 0
+        self.written = 0
+        self.error: Optional[Exception] = None
+        self.started = asyncio.get_running_loop().create_future()  # the size is known
+        self.task: Optional[asyncio.Task] = None
+        self.fd: Optional[int] = None
+        self._progress = asyncio.Event()
+
+    def advance(self, size: int) -> None:
+        self.written += size
+        self._notify()
+
+    def fail(self, error: Exception) -> None:
+        self.error = error
+        self._notify()
+
+    def _notify(self) -> None:
+        progress, self._progress = self._progress, asyncio.Event()
+        progress.set()
+
+    async def wait(self) -> BinaryIO:
+        """
+        The cached file opened when the fetch ends
+        """
+        await asyncio.shield(self.task)
+        if self.error is not None:
+            raise self.error
+        return await asyncio.to_thread(open, self.path, 'rb')
+
+    def open_reader(self, chunk_size: int = settings.MEDIA_CHUNK_SIZE) -> Optional[AsyncIterator[bytes]]:
+        """
+        Iterator of the content, None if the fetch has already ended
+        """
+        if self.fd is None:
+            return None
+        # own descriptor, the file is renamed, or even evicted, when the fetch ends
+        return self._read(os.fdopen(os.dup(self.fd), 'rb', buffering=0), chunk_size)
+
+    async def _read(self, file, chunk_size: int) -> AsyncIterator[bytes]:
+        with file:
+            offset = 0
+            while offset < self.size:
+                if offset < self.written:
+                    chunk = await asyncio.to_thread(
+                        os.pread, file.fileno(), min(chunk_size, self.written - offset), offset
+                    )
+                    offset += len(chunk)
+                    yield chunk
+                    continue
+                if self.error is not None:
+                    raise self.error
+                await self._progress.wait()
+
+
+class CloudCache:
+    """
+    Local copies of files fetched from the cloud storage on local misses, the hot tier in front of the cloud.
+    A miss is streamed to the client while it is written to the cache, concurrent misses of a file share the fetch.
+    Least recently used files are deleted when the cache is larger than max_size bytes.
+    The index is per process, the cleanup command trims the directory shared by the workers by atime.
+    """
+
+    def __init__(self, path: str, max_size: int, cloud: CloudStorage) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.cloud = cloud
+        self.size = 0
+        self._entries: Optional[OrderedDict[str, Tuple[int, float]]] = None  # filename -> size, touched
+        self._fetching: Dict[str, Fetch] = {}
+
+    async def get(self, filename: str) -> Union[BinaryIO, Fetch]:
+        """
+        The cached file opened, or the fetch in progress. FileNotFoundError if the cloud doesn't have the file.
+        The opened file can be read even if it is evicted meanwhile, the caller closes it.
+        """
+        if self._entries is None:
+            await asyncio.to_thread(self._load)
+
+        path = os.path.join(self.path, filename)
+        if filename in self._entries:
+            try:
+                file = await asyncio.to_thread(open, path, 'rb')
+            except FileNotFoundError:
+                # evicted by another worker
+                entry = self._entries.pop(filename, None)
+                if entry is not None:
+                    self.size -= entry[0]
+            else:
+                if filename in self._entries:
+                    self._touch(filename, path)
+                CLOUD_CACHE.labels('hit').inc()
+                return file
+
+        fetch = self._fetching.get(filename)
+        if fetch is None:
+            CLOUD_CACHE.labels('miss').inc()
+            fetch = Fetch(path)
+            fetch.task = asyncio.create_task(self._fetch(fetch, filename))
+            self._fetching[filename] = fetch
+        else:
+            CLOUD_CACHE.labels('shared').inc()
+        # a cancelled request doesn't cancel the fetch others wait for
+        await asyncio.shield(fetch.started)
+        return fetch
+
+    async def _fetch(self, fetch: Fetch, filename: str) -> None:
+        try:
+            try:
+                stream = await self.cloud.stream_file(filename)
+                fetch.size = stream.size
+                flags = os.O_RDWR | os.O_CREAT | os.O_TRUNC
+                fetch.fd = await asyncio.to_thread(os.open, fetch.tmp_path, flags, 0o644)
+            except Exception as e:
+                fetch.started.set_exception(e)
+                fetch.error = e
+                return
+            fetch.started.set_result(None)
+
+            try:
+                async for chunk in stream.chunks:
+                    await asyncio.to_thread(self._write, fetch.fd, chunk, fetch.written)
+                    fetch.advance(len(chunk))
+                if fetch.written != fetch.size:
+                    raise IOError(f'Received {fetch.written} of {fetch.size} bytes')
+                await asyncio.to_thread(os.replace, fetch.tmp_path, fetch.path)
+            except Exception as e:
+                logger.error(f'Fetch of {filename} from the cloud storage failed: {e}')
+                fetch.fail(e)
+                await asyncio.to_thread(self._delete_path, fetch.tmp_path)
+                return
+
+            self._entries[filename] = (fetch.size, time.time())
+            self.size += fetch.size
+            evicted = self._evict()
+            if evicted:
+                await asyncio.to_thread(self._delete, evicted)
+        finally:
+            if fetch.fd is not None:
+                os.close(fetch.fd)
+                fetch.fd = None
+            self._fetching.pop(filename, None)
+
+    @staticmethod
+    def _write(fd: int, data: bytes, offset: int) -> None:
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            offset += written
+            view = view[written:]
+
+    def _touch(self, filename: str, path: str) -> None:
+        size, touched = self._entries[filename]
+        now = time.time()
+        if now - touched > TOUCH_INTERVAL:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+            self._entries[filename] = (size, now)
+        self._entries.move_to_end(filename)
+
+    def _scan(self) -> Tuple[List[Tuple[float, str, int]], List[Tuple[float, str]]]:
+        """
+        Cached files sorted by atime, and files of fetches in progress or of dead workers with mtime
+        """
+        os.makedirs(self.path, exist_ok=True)
+        entries, fetching = [], []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                try:
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if TMP_SUFFIX in entry.name:
+                    fetching.append((stat.st_mtime, entry.name))
+                else:
+                    entries.append((stat.st_atime, entry.name, stat.st_size))
+        return sorted(entries), fetching
+
+    def _load(self) -> None:
+        entries, _ = self._scan()
+        self._entries = OrderedDict((name, (size, atime)) for atime, name, size in entries)
+        self.size = sum(size for size, _ in self._entries.values())
+
+    def _evict(self) -> List[str]:
+        evicted = []
+        # the newest file is kept even if it is larger than the cache
+        while self.size > self.max_size and len(self._entries) > 1:
+            filename, (size, _) = self._entries.popitem(last=False)
+            self.size -= size
+            evicted.append(filename)
+        return evicted
+
+    def _delete(self, filenames: List[str]) -> None:
+        for filename in filenames:
+            self._delete_path(os.path.join(self.path, filename))
+
+    @staticmethod
+    def _delete_path(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    async def delete(self, filenames: List[str]) -> None:
+        """
+        Forget deleted files
+        """
+        if self._entries is not None:
+            for filename in filenames:
+                entry = self._entries.pop(filename, None)
+                if entry is not None:
+                    self.size -= entry[0]
+        await asyncio.to_thread(self._delete, filenames)
+
+    async def trim(self, stale_fetch_age: float = 3600) -> int:
+        """
+        Delete least recently accessed files of all workers above max_size, and files of dead fetches.
+        Returns the number of deleted files.
+        """
+        return await asyncio.to_thread(self._trim, stale_fetch_age)
+
+    def _trim(self, stale_fetch_age: float) -> int:
+        entries, fetching = self._scan()
+        stale_before = time.time() - stale_fetch_age
+        evicted = [name for mtime, name in fetching if mtime < stale_before]
+        size = sum(size for _, _, size in entries)
+        for _, name, file_size in entries:
+            if size <= self.max_size:
+                break
+            evicted.append(name)
+            size -= file_size
+        self._delete(evicted)
+        return len(evicted)
+
+
+cloud_cache = CloudCache(settings.CLOUD_CACHE_DIR, max_size=settings.CLOUD_CACHE_SIZE, cloud=STORAGES[CLOUD_STORAGE])
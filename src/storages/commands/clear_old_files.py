@@ -1,16 +1,21 @@
 import argparse
 import asyncio
+import os
+import time
 import uuid
+from dataclasses import dataclass
 from datetime import timedelta, datetime
-from typing import Iterable, List
+from typing import Iterable, List, Optional
 from apscheduler.triggers.cron import CronTrigger
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from src.storages.base import BaseStorage, StatFileInfo
 from loguru import logger
 
-from src.storages.registry import STORAGES, LOCAL_STORAGE
-from src.apps.files.services import FilesMetaRepository
+from src.storages.registry import STORAGES, LOCAL_STORAGE, open_storages, close_storages
+from src.storages.cloud_cache import CloudCache, cloud_cache
+from src.apps.files.services import FilesMetaRepository, UploadSessionsRepository
 from src.db import get_db
+from src.metrics import CLEAR_FILES, CLEAR_SIZE, CLEAR_DURATION, CLEAR_FINISHED
 
 
 STORAGES_FOR_CLEAR = (
@@ -18,25 +23,135 @@ STORAGES_FOR_CLEAR = (
 )
 
 
+@dataclass
+class ClearStats:
+    files: int = 0
+    size: int = 0
+    deleted_from_storages: int = 0
+    missing_in_storages: int = 0
+    duration: float = 0
+
+
 class ClearOldFiles:
     DELETE_IF_NOT_ACCESSED_IN_LAST = timedelta(days=30)
     DELETE_IF_NOT_MODIFIED_IN_LAST = timedelta(days=30)
-
-    def __init__(self, storages: Iterable[BaseStorage]):
+    DELETE_UPLOADS_IF_NOT_UPDATED_IN_LAST = timedelta(days=1)
+    CHUNK_SIZE = 1000
+    STORAGE_DELETE_CONCURRENCY = 32
+
+    def __init__(
+            self,
+            storages: Iterable[BaseStorage],
+            uploads_storage: Optional[BaseStorage] = None,
+            dry_run: bool = False,
+            scan_storages: bool = False,
+            cloud_cache: Optional[CloudCache] = None,
+    ):
+        """
+        dry_run - only count files for delete
+        scan_storages - also scan storages by file times, to find files without metadata
+        cloud_cache - deleted files are removed from it, and it is trimmed to its size
+        """
         self.storages = storages
+        self.uploads_storage = uploads_storage
+        self.cloud_cache = cloud_cache
+        self.dry_run = dry_run
+        self.scan_storages = scan_storages
+        self.semaphore = asyncio.Semaphore(self.STORAGE_DELETE_CONCURRENCY)
+
+    async def clear_storages(self) -> ClearStats:
+        started = time.monotonic()
+        stats = ClearStats()
+        if self.uploads_storage is not None and not self.dry_run:
+            await self.clear_uploads(self.uploads_storage)
+
+        rules = (
+            ('created_at', self.DELETE_IF_NOT_MODIFIED_IN_LAST),
+            ('last_accessed_at', self.DELETE_IF_NOT_ACCESSED_IN_LAST),
+        )
+        for field, older_than in rules:
+            if older_than is not None:
+                await self.clear_expired(field, older_than, stats)
+
+        if self.scan_storages:
+            tasks = [asyncio.create_task(self.clear_storage(storage)) for storage in self.storages]
+            await asyncio.gather(*tasks)
+
+        if self.cloud_cache is not None and not self.dry_run:
+            trimmed = await self.cloud_cache.trim()
+            logger.debug(f'Trimmed {trimmed} files from the cloud cache')
+
+        stats.duration = time.monotonic() - started
+        if not self.dry_run:
+            CLEAR_FILES.set(stats.files)
+            CLEAR_SIZE.set(stats.size)
+            CLEAR_DURATION.set(stats.duration)
+            CLEAR_FINISHED.set_to_current_time()
+        logger.info(f'{"Would delete" if self.dry_run else "Deleted"} old files: {stats}')
+        return stats
+
+    async def clear_expired(self, field: str, older_than: timedelta, stats: ClearStats):
+        """
+        Find expired files by the index of FileMetadata.<field> and delete them chunk by chunk
+        """
+        after = None
+        while True:
+            async for session in get_db():
+                files = await FilesMetaRepository(session).get_expired_files(
+                    field, older_than, self.CHUNK_SIZE, after
+                )
+            if not files:
+                return
+
+            stats.files += len(files)
+            stats.size += sum(size for _, size, _ in files)
+            if not self.dry_run:
+                await self.delete_expired([id for id, _, _ in files], stats)
+
+            last_id, _, last_value = files[-1]
+            after = (last_value, last_id)
+            if len(files) < self.CHUNK_SIZE:
+                return
+
+    async def delete_expired(self, ids: List[uuid.UUID], stats: ClearStats):
+        async for session in get_db():
+            filenames = await FilesMetaRepository(session).delete_files(ids)
+        await self.delete_from_storages(filenames, stats)
+
+    async def delete_from_storages(self, filenames: List[str], stats: ClearStats):
+        if self.cloud_cache is not None:
+            await self.cloud_cache.delete(filenames)
+        tasks = [
+            self.delete_from_storage(filename, storage)
+            for storage in self.storages
+            for filename in filenames
+        ]
+        for deleted in await asyncio.gather(*tasks):
+            if deleted:
+                stats.deleted_from_storages += 1
+            else:
+                stats.missing_in_storages += 1
+
+    async def clear_uploads(self, storage: BaseStorage):
+        """
+        Reclaim resumable uploads which were abandoned before finalize
+        """
+        async for session in get_db():
+            filenames = await UploadSessionsRepository(session).delete_stale_sessions(
+                self.DELETE_UPLOADS_IF_NOT_UPDATED_IN_LAST
+            )
+        logger.debug(f'Deleting stale uploads: {filenames}')
 
-    async def clear_storages(self):
-        tasks = [asyncio.create_task(self.clear_storage(storage)) for storage in self.storages]
+        tasks = [asyncio.create_task(self.delete_from_storage(filename, storage)) for filename in filenames]
         await asyncio.gather(*tasks)
 
     async def clear_storage(self, storage: BaseStorage):
-        files = await storage.list_files()
-        files_for_delete = []
-        for file in files:
-            if self.is_file_for_delete(file):
-                files_for_delete.append(file)
-
-        await self.delete_files(files_for_delete, storage)
+        async for files in storage.list_files():
+            files_for_delete = [file for file in files if self.is_file_for_delete(file)]
+            if files_for_delete:
+                logger.debug(f'{"Would delete" if self.dry_run else "Deleting"} files: {files_for_delete}')
+                if not self.dry_run:
+                    await self.delete_files(files_for_delete, storage)
 
     @classmethod
     def is_file_for_delete(cls, file_info: StatFileInfo):
@@ -56,17 +171,30 @@ class ClearOldFiles:
         logger.debug(f'Deleting files: {ids}')
 
         async for session in get_db():
-            await FilesMetaRepository(session).delete_files(ids)
+            repo = FilesMetaRepository(session)
+            await repo.delete_files(ids)
+            # deduplicated content is kept while other uploads reference it
+            referenced = await repo.get_referenced_blobs([os.path.basename(f.path) for f in files])
+        files = [f for f in files if os.path.basename(f.path) not in referenced]
 
         tasks = [asyncio.create_task(self.delete_from_storage(f.path, storage)) for f in files]
         await asyncio.gather(*tasks)
 
-    @staticmethod
-    async def delete_from_storage(path: str, storage: BaseStorage):
-        try:
-            await storage.delete(path)
-        except FileNotFoundError:
-            pass
+    async def delete_from_storage(self, path: str, storage: BaseStorage) -> bool:
+        async with self.semaphore:
+            try:
+                await storage.delete(path)
+                return True
+            except FileNotFoundError:
+                return False
+
+
+async def run_once(command: ClearOldFiles):
+    await open_storages()
+    try:
+        await command.clear_storages()
+    finally:
+        await close_storages()
 
 
 def main():
@@ -77,11 +205,22 @@ def main():
         action='store_true',
         help="Specify this option if you want to run the scheduler only once or use some other cron, "
              "K8s CronJob for example")
+    parser.add_argument('--dry-run', action='store_true', help='Only report what would be deleted')
+    parser.add_argument(
+        '--scan-storages',
+        action='store_true',
+        help='Also scan storages by file times to delete files without metadata, slow on big storages')
     cmd_args = parser.parse_args()
-    command = ClearOldFiles(STORAGES_FOR_CLEAR)
+    command = ClearOldFiles(
+        STORAGES_FOR_CLEAR,
+        uploads_storage=STORAGES[LOCAL_STORAGE],
+        dry_run=cmd_args.dry_run,
+        scan_storages=cmd_args.scan_storages,
+        cloud_cache=cloud_cache,
+    )
 
     if cmd_args.run_once:
-        asyncio.run(command.clear_storages())
+        asyncio.run(run_once(command))
     else:
         trigger = CronTrigger.from_crontab(cmd_args.schedule)
         scheduler = AsyncIOScheduler()
@@ -89,12 +228,16 @@ def main():
             func=command.clear_storages,
             trigger=trigger
         )
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(open_storages())
         scheduler.start()
 
         try:
-            asyncio.get_event_loop().run_forever()
+            loop.run_forever()
         except (KeyboardInterrupt, SystemExit):
             pass
+        finally:
+            loop.run_until_complete(close_storages())
 
 
 if __name__ == "__main__":
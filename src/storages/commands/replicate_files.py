@@ -0,0 +1,140 @@
+import argparse
+import asyncio
+from datetime import timedelta
+from typing import Set, Tuple
+from loguru import logger
+
+from src.storages.base import BaseStorage
+from src.storages.registry import STORAGES, LOCAL_STORAGE, CLOUD_STORAGE, open_storages, close_storages
+from src.apps.files.services import ReplicationJobsRepository
+from src.db import get_db
+from src.metrics import set_replication_backlog
+
+
+class ReplicateFiles:
+    """
+    Copy files from the replication outbox to the cloud storage.
+    Several workers can run at once, jobs are claimed with SELECT ... FOR UPDATE SKIP LOCKED.
+    """
+    # a job is retried if the worker dies while copying it, the lease is extended while the copy runs
+    LEASE = timedelta(minutes=5)
+    RETRY_BACKOFF = timedelta(seconds=10)
+    MAX_RETRY_BACKOFF = timedelta(hours=1)
+
+    def __init__(
+            self,
+            source: BaseStorage,
+            target: BaseStorage,
+            batch_size: int = 100,
+            concurrency: int = 8,
+            poll_interval: float = 5,
+    ):
+        self.source = source
+        self.target = target
+        self.batch_size = batch_size
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.poll_interval = poll_interval
+
+    async def run(self, run_once: bool = False):
+        while True:
+            replicated = await self.replicate_batch()
+            if replicated == 0:
+                await self.report_backlog()
+                if run_once:
+                    return
+                await asyncio.sleep(self.poll_interval)
+
+    async def replicate_batch(self) -> int:
+        async for session in get_db():
+            jobs = await ReplicationJobsRepository(session).claim_jobs(self.batch_size, self.LEASE)
+        if not jobs:
+            return 0
+
+        in_progress = {job_id for job_id, _, _ in jobs}
+        heartbeat = asyncio.create_task(self.extend_leases(in_progress))
+        try:
+            results = await asyncio.gather(*(self.replicate(job, in_progress) for job in jobs))
+        finally:
+            heartbeat.cancel()
+        completed = [job_id for job_id, ok in results if ok]
+        async for session in get_db():
+            await ReplicationJobsRepository(session).complete_jobs(completed)
+
+        logger.debug(f'Replicated {len(completed)} of {len(jobs)} files')
+        return len(jobs)
+
+    async def extend_leases(self, in_progress: Set[int]):
+        """
+        Extend the lease of the jobs in progress, a copy of a large file can take longer than the lease
+        """
+        while True:
+            await asyncio.sleep(self.LEASE.total_seconds() / 3)
+            if not in_progress:
+                continue
+            try:
+                async for session in get_db():
+                    await ReplicationJobsRepository(session).extend_lease(list(in_progress), self.LEASE)
+            except Exception as e:
+                logger.error(f'Unable to extend the lease of replication jobs: {e}')
+
+    async def replicate(self, job: Tuple[int, str, int], in_progress: Set[int]) -> Tuple[int, bool]:
+        job_id, storage_filename, attempts = job
+        async with self.semaphore:
+            try:
+                await self.target.upload_file(self.source.get_upload_path(storage_filename, check_exists=True))
+                return job_id, True
+            except FileNotFoundError:
+                # deleted before it was copied, nothing to replicate
+                logger.warning(f'File {storage_filename} for replication does not exist')
+                return job_id, True
+            except Exception as e:
+                retry_in = min(self.RETRY_BACKOFF * 2 ** (attempts - 1), self.MAX_RETRY_BACKOFF)
+                logger.error(f'Replication of {storage_filename} failed, attempt {attempts}, retry in {retry_in}: {e}')
+                # completed jobs keep the lease until they are deleted, a failed one waits for the retry
+                in_progress.discard(job_id)
+                async for session in get_db():
+                    await ReplicationJobsRepository(session).retry_job(job_id, retry_in, str(e))
+                return job_id, False
+
+    async def report_backlog(self):
+        async for session in get_db():
+            count, lag = await ReplicationJobsRepository(session).get_backlog()
+        set_replication_backlog(count, lag)
+        if count:
+            logger.info(f'Replication backlog: {count} files, lag {lag}')
+
+
+async def run(command: ReplicateFiles, run_once: bool):
+    await open_storages()
+    try:
+        await command.run(run_once=run_once)
+    finally:
+        await close_storages()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of files copied at once')
+    parser.add_argument('--poll-interval', type=float, default=5, help='Seconds to wait when the outbox is empty')
+    parser.add_argument(
+        '--run-once',
+        action='store_true',
+        help="Exit when the outbox is empty")
+    cmd_args = parser.parse_args()
+    command = ReplicateFiles(
+        STORAGES[LOCAL_STORAGE],
+        STORAGES[CLOUD_STORAGE],
+        batch_size=cmd_args.batch_size,
+        concurrency=cmd_args.concurrency,
+        poll_interval=cmd_args.poll_interval,
+    )
+
+    try:
+        asyncio.run(run(command, cmd_args.run_once))
+    except (KeyboardInterrupt, SystemExit):
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+import os
+from typing import List
+from loguru import logger
+
+from src.storages.local import LocalStorage
+from src.storages.registry import STORAGES, LOCAL_STORAGE
+
+
+class ShardUploadDir:
+    """
+    Move files from the flat UPLOAD_DIR into the sharded layout.
+    Files are moved with rename in batches, reads keep working during the migration
+    because LocalStorage.get_upload_path falls back to the flat path.
+    """
+
+    def __init__(self, storage: LocalStorage, batch_size: int = 1000, pause: float = 0):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.pause = pause
+
+    async def migrate(self) -> int:
+        if not self.storage.get_shard_dir('x' * 64):
+            logger.info('UPLOAD_DIR_SHARD_LEVELS is 0, nothing to migrate')
+            return 0
+
+        moved = 0
+        while batch := await asyncio.to_thread(self.get_batch):
+            moved += await asyncio.to_thread(self.move_files, batch)
+            logger.info(f'Moved {moved} files to the sharded layout')
+            if len(batch) < self.batch_size:
+                break
+            if self.pause:
+                await asyncio.sleep(self.pause)
+        return moved
+
+    def get_batch(self) -> List[str]:
+        batch = []
+        with os.scandir(self.storage.path) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    batch.append(entry.name)
+                    if len(batch) == self.batch_size:
+                        break
+        return batch
+
+    def move_files(self, filenames: List[str]) -> int:
+        moved = 0
+        for filename in filenames:
+            source = os.path.join(self.storage.path, filename)
+            target = self.storage.get_upload_path(filename, create_dirs=True)
+            if source == target:
+                continue
+            try:
+                os.rename(source, target)
+                moved += 1
+            except FileNotFoundError:
+                # deleted meanwhile
+                pass
+        return moved
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--pause', type=float, default=0, help='Seconds to sleep between batches to limit disk load')
+    cmd_args = parser.parse_args()
+    command = ShardUploadDir(STORAGES[LOCAL_STORAGE], batch_size=cmd_args.batch_size, pause=cmd_args.pause)
+    moved = asyncio.run(command.migrate())
+    logger.info(f'Done, {moved} files moved')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import zlib
+from typing import Optional, Protocol
+
+from src.settings import settings
+
+try:
+    import zstandard
+except ImportError:  # optional, only for STORAGE_COMPRESSION = 'zstd'
+    zstandard = None
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+# formats from MIME_FORMAT which are worth compressing
+COMPRESSIBLE_FORMATS = {'txt', 'json', 'csv', 'xml', 'html', 'css', 'svg', 'js', 'sql'}
+
+
+class Compressor(Protocol):
+    def compress(self, data: bytes) -> bytes:
+        ...
+
+    def flush(self) -> bytes:
+        ...
+
+
+class Decompressor(Protocol):
+    def decompress(self, data: bytes) -> bytes:
+        ...
+
+
+def get_storage_encoding(file_format: Optional[str]) -> Optional[str]:
+    """
+    Encoding to store a file of the format with, None - store as is
+    """
+    if settings.STORAGE_COMPRESSION and file_format in COMPRESSIBLE_FORMATS:
+        return settings.STORAGE_COMPRESSION
+    return None
+
+
+def get_compressor(encoding: str) -> Compressor:
+    if encoding == GZIP:
+        return zlib.compressobj(settings.STORAGE_COMPRESSION_LEVEL or 6, zlib.DEFLATED, 31)
+    if encoding == ZSTD:
+        if zstandard is None:
+            raise RuntimeError('zstandard is required for zstd compression')
+        return zstandard.ZstdCompressor(level=settings.STORAGE_COMPRESSION_LEVEL or 3).compressobj()
+    raise ValueError(f'Unknown encoding {encoding}')
+
+
+def get_decompressor(encoding: str) -> Decompressor:
+    if encoding == GZIP:
+        return zlib.decompressobj(31)
+    if encoding == ZSTD:
+        if zstandard is None:
+            raise RuntimeError('zstandard is required for zstd compression')
+        return zstandard.ZstdDecompressor().decompressobj()
+    raise ValueError(f'Unknown encoding {encoding}')
+
+
+def accepts_encoding(accept_encoding: Optional[str], encoding: str) -> bool:
+    """
+    Whether `Accept-Encoding` allows the encoding, q=0 excludes it
+    """
+    if not accept_encoding:
+        return False
+    wildcard = False
+    for item in accept_encoding.split(','):
+        coding, _, params = item.strip().partition(';')
+        coding = coding.strip().lower()
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0
+        if coding == encoding:
+            return q > 0
+        if coding == '*':
+            wildcard = q > 0
+    return wildcard
@@ -3,6 +3,7 @@ MIME_FORMAT = mime_to_format = {
     "text/html": "html",
     "text/css": "css",
     "text/javascript": "js",
+    "text/csv": "csv",
     "application/json": "json",
     "application/xml": "xml",
     "application/xhtml+xml": "xhtml",
@@ -75,3 +76,5 @@ MIME_FORMAT = mime_to_format = {
     "font/woff": "woff",
     "font/woff2": "woff2"
 }
+
+FORMAT_MIME = {file_format: mime for mime, file_format in MIME_FORMAT.items()}
@@ -1,6 +1,8 @@
+import asyncio
+import itertools
 import os
 import aiofiles
-from typing import List, Optional
+from typing import List, Optional, AsyncIterator, Iterator, Tuple
 from datetime import datetime
 from aiofiles import os as aios
 from urllib import parse
@@ -8,56 +10,142 @@ from urllib import parse
 from aiofiles.base import AsyncBase
 from fastapi import UploadFile, Request
 
-from .base import BaseStorage, FileInfo, StatFileInfo
+from .base import BaseStorage, FileInfo, FileStream, StatFileInfo
+from .compression import get_compressor, get_storage_encoding
+from .writer import WritePipeline
 from src.settings import settings
 
 
 class LocalStorage(BaseStorage):
-    STREAM_CHUNK_SIZE = 8192
+    @staticmethod
+    def get_shard_dir(filename: str) -> str:
+        """
+        Directory of the file relative to UPLOAD_DIR built from the prefix of the name, e.g. ab/cd
+        """
+        levels, width = settings.UPLOAD_DIR_SHARD_LEVELS, settings.UPLOAD_DIR_SHARD_WIDTH
+        if levels <= 0:
+            return ''
+        stem = os.path.basename(filename).replace('-', '')
+        return os.path.join(*(stem[i * width:(i + 1) * width] for i in range(levels)))
+
+    def get_upload_path(self, filename: str, check_exists: bool = False, create_dirs: bool = False) -> str:
+        shard_dir = os.path.join(settings.UPLOAD_DIR, self.get_shard_dir(filename))
+        upload_path = os.path.join(shard_dir, filename)
+        if create_dirs:
+            os.makedirs(shard_dir, exist_ok=True)
+        if check_exists and not os.path.exists(upload_path):
+            # not moved to the sharded layout yet
+            flat_path = super().get_upload_path(filename)
+            if os.path.exists(flat_path):
+                return flat_path
+            # could be moved between the checks
+            if not os.path.exists(upload_path):
+                raise FileNotFoundError
+        return upload_path
 
     async def upload_file(self, file: UploadFile | str, **kwargs) -> FileInfo:
         metadata = self.get_metadata(file)
-        upload_path = self.get_upload_path(metadata.storage_filename)
+        upload_path = self.get_upload_path(metadata.storage_filename, create_dirs=True)
+        compressor = None
+        if metadata.content_encoding is None:
+            metadata.content_encoding = get_storage_encoding(metadata.file_format)
+            if metadata.content_encoding is not None:
+                compressor = get_compressor(metadata.content_encoding)
 
-        with open(upload_path, "w+b") as f:
-            file_size = 0
-            while content := await file.read(self.STREAM_CHUNK_SIZE):
-                f.write(content)
-                file_size += len(content)
+        f = await asyncio.to_thread(open, upload_path, "w+b")
+        pipeline = WritePipeline(f.fileno())
+        try:
+            transform = compressor.compress if compressor is not None else None
+            while content := await file.read(settings.UPLOAD_WRITE_BUFFER_SIZE):
+                await pipeline.write(content, transform)
+            if compressor is not None:
+                await pipeline.write(b'', lambda _: compressor.flush())
+            await pipeline.close()
+        except BaseException:
+            await pipeline.abort()
+            raise
+        finally:
+            await asyncio.to_thread(f.close)
 
         return metadata
 
+    async def write_stream(self, filepath: str, stream: AsyncIterator[bytes], offset: int = 0) -> AsyncIterator[int]:
+        """
+        Write the stream into the file from offset, everything after the offset is discarded.
+        Yields offset after every written chunk, so the caller knows what is persisted if the stream breaks.
+        """
+        try:
+            upload_path = self.get_upload_path(filepath, check_exists=True)
+            mode = 'r+b'
+        except FileNotFoundError:
+            upload_path = self.get_upload_path(filepath, create_dirs=True)
+            mode = 'w+b'
+        async with aiofiles.open(upload_path, mode) as f:
+            await f.seek(offset)
+            await f.truncate()
+            async for chunk in stream:
+                await f.write(chunk)
+                offset += len(chunk)
+                yield offset
+
     async def get_file(self, filepath: str, open_options: Optional[dict] = None, **kwargs) -> AsyncBase:
         if open_options is None:
             open_options = {}
         f = await aiofiles.open(filepath, **open_options)
         return f
 
+    async def stream_file(
+            self,
+            filepath: str,
+            byte_range: Optional[Tuple[int, int]] = None,
+            chunk_size: int = settings.MEDIA_CHUNK_SIZE,
+    ) -> FileStream:
+        path = await asyncio.to_thread(self.get_upload_path, filepath, check_exists=True)
+        total_size = (await aios.stat(path)).st_size
+        start, end = byte_range if byte_range is not None else (0, total_size - 1)
+        return FileStream(self.read_range(path, start, end, chunk_size), end - start + 1, total_size)
+
+    @staticmethod
+    async def read_range(path: str, start: int, end: int, chunk_size: int) -> AsyncIterator[bytes]:
+        async with aiofiles.open(path, 'rb') as f:
+            await f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0 and (chunk := await f.read(min(chunk_size, remaining))):
+                remaining -= len(chunk)
+                yield chunk
+
     def get_file_url(self, request: Request, filepath: str) -> str:
         full_path = os.path.join(settings.MEDIA_ROOT, filepath)
         return parse.urljoin(str(request.base_url), full_path)
 
     async def delete(self, filepath: str) -> None:
-        full_path = self.get_upload_path(filepath)
+        full_path = self.get_upload_path(filepath, check_exists=True)
         await aios.remove(full_path)
 
-    async def list_files(self) -> List[StatFileInfo]:
-        async def _list_files(dir_path):
-            res = []
-            for name in await aios.listdir(dir_path):
-                if await aios.path.isdir(name):
-                    inner = os.path.join(dir_path, name)
-                    stat_files = await _list_files(inner)
-                    res = [*res, *stat_files]
-                else:
-                    path = os.path.join(dir_path, name)
-                    stat = await aios.stat(path)
-                    stat_file = StatFileInfo(
-                        path,
+    async def list_files(self, batch_size: int = 1000) -> AsyncIterator[List[StatFileInfo]]:
+        files = self._walk(self.path)
+        while batch := await asyncio.to_thread(lambda: list(itertools.islice(files, batch_size))):
+            yield batch
+
+    @staticmethod
+    def _walk(dir_path: str) -> Iterator[StatFileInfo]:
+        """
+        Walk the tree with scandir, the type of an entry is known without stat
+        """
+        dirs = [dir_path]
+        while dirs:
+            with os.scandir(dirs.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                        continue
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        # deleted meanwhile
+                        continue
+                    yield StatFileInfo(
+                        entry.path,
                         datetime.fromtimestamp(stat.st_atime),
                         datetime.fromtimestamp(stat.st_mtime)
                     )
-                    res.append(stat_file)
-            return res
-
-        return await _list_files(self.path)
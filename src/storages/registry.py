@@ -18,3 +18,13 @@ def get_storage(storage_key: int = LOCAL_STORAGE):
         return STORAGES[storage_key]
 
     return inner
+
+
+async def open_storages():
+    for storage in STORAGES.values():
+        await storage.open()
+
+
+async def close_storages():
+    for storage in STORAGES.values():
+        await storage.close()
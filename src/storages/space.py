@@ -0,0 +1,79 @@
+import errno
+import shutil
+from typing import Optional
+
+from fastapi import status
+
+from src.metrics import DISK_RESERVED, SPACE_REJECTIONS
+from src.settings import settings
+
+DISK_FULL_ERRORS = (errno.ENOSPC, errno.EDQUOT)
+
+
+class InsufficientStorage(Exception):
+    def __init__(self, message: str, status_code: int = status.HTTP_507_INSUFFICIENT_STORAGE) -> None:
+        self.message = message
+        self.status_code = status_code
+
+
+class Reservation:
+    """
+    Space promised to an upload, consumed as the upload is written
+    """
+
+    def __init__(self, ledger: 'SpaceLedger', size: int) -> None:
+        self.ledger = ledger
+        self.remaining = size
+
+    def consume(self, size: int) -> None:
+        """
+        The bytes are on the disk, the free space accounts for them now
+        """
+        size = min(size, self.remaining)
+        self.remaining -= size
+        self.ledger.reserved -= size
+        DISK_RESERVED.dec(size)
+
+    def release(self) -> None:
+        self.consume(self.remaining)
+
+    def __enter__(self) -> 'Reservation':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+
+class SpaceLedger:
+    """
+    Admit an upload only if UPLOAD_DIR keeps UPLOAD_MIN_FREE_SPACE free
+    after it and the uploads in progress are written, so concurrent uploads don't over-commit the disk.
+    The ledger is per process, the watermark leaves room for the other workers.
+    """
+
+    def __init__(self, path: Optional[str] = None, min_free: Optional[int] = None) -> None:
+        self.path = path
+        self.min_free = min_free
+        self.reserved = 0
+
+    def get_available(self) -> int:
+        free = shutil.disk_usage(self.path or settings.UPLOAD_DIR).free
+        min_free = self.min_free if self.min_free is not None else settings.UPLOAD_MIN_FREE_SPACE
+        return free - min_free
+
+    def reserve(self, size: int) -> Reservation:
+        """
+        Raises InsufficientStorage: 413 if the upload doesn't fit even on its own, 507 otherwise
+        """
+        available = self.get_available()
+        if available <= 0 or size > available - self.reserved:
+            status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE if 0 < available < size \
+                else status.HTTP_507_INSUFFICIENT_STORAGE
+            SPACE_REJECTIONS.labels(status_code).inc()
+            raise InsufficientStorage(f'Not enough free space for {size} bytes', status_code)
+        self.reserved += size
+        DISK_RESERVED.inc(size)
+        return Reservation(self, size)
+
+
+space_ledger = SpaceLedger()
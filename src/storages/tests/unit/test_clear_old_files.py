@@ -0,0 +1,68 @@
+import uuid
+from datetime import datetime
+
+import pytest
+
+from unittest.mock import AsyncMock, MagicMock
+
+from src.storages.commands.clear_old_files import ClearOldFiles
+
+
+@pytest.fixture
+def files_repo(mocker):
+    async def get_db():
+        yield MagicMock()
+
+    mocker.patch('src.storages.commands.clear_old_files.get_db', get_db)
+    mocker.patch.object(ClearOldFiles, 'CHUNK_SIZE', 2)
+    mocker.patch.object(ClearOldFiles, 'DELETE_IF_NOT_ACCESSED_IN_LAST', None)
+    files = [(uuid.uuid4(), 10, datetime(2024, 1, i + 1)) for i in range(3)]
+    repo = MagicMock()
+    repo.get_expired_files = AsyncMock(side_effect=[files[:2], files[2:]])
+    repo.delete_files = AsyncMock(side_effect=lambda ids: [f'{id}.pdf' for id in ids])
+    mocker.patch('src.storages.commands.clear_old_files.FilesMetaRepository', return_value=repo)
+    return repo, files
+
+
+@pytest.mark.asyncio
+async def test_clear_expired_in_chunks(files_repo):
+    repo, files = files_repo
+    storage = MagicMock()
+    storage.delete = AsyncMock(side_effect=[None, None, FileNotFoundError])
+
+    stats = await ClearOldFiles([storage]).clear_storages()
+
+    assert (stats.files, stats.size) == (3, 30)
+    assert (stats.deleted_from_storages, stats.missing_in_storages) == (2, 1)
+    assert repo.delete_files.await_count == 2
+    # keyset pagination continues after the last row of the previous chunk
+    assert repo.get_expired_files.await_args_list[1].args[3] == (files[1][2], files[1][0])
+
+
+@pytest.mark.asyncio
+async def test_clear_expired_dry_run(files_repo):
+    repo, files = files_repo
+    storage = MagicMock()
+    storage.delete = AsyncMock()
+
+    stats = await ClearOldFiles([storage], dry_run=True).clear_storages()
+
+    assert stats.files == 3
+    repo.delete_files.assert_not_called()
+    storage.delete.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_clear_expired_cloud_cache(files_repo):
+    repo, files = files_repo
+    storage = MagicMock()
+    storage.delete = AsyncMock()
+    cloud_cache = MagicMock()
+    cloud_cache.delete = AsyncMock()
+    cloud_cache.trim = AsyncMock(return_value=0)
+
+    await ClearOldFiles([storage], cloud_cache=cloud_cache).clear_storages()
+
+    assert cloud_cache.delete.await_count == 2
+    assert cloud_cache.delete.await_args.args[0] == [f'{files[2][0]}.pdf']
+    cloud_cache.trim.assert_awaited_once()
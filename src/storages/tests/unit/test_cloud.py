@@ -0,0 +1,183 @@
+import asyncio
+
+import pytest
+
+from unittest.mock import AsyncMock, MagicMock
+from botocore.exceptions import ClientError
+
+from src.storages.cloud import CloudStorage
+
+
+@pytest.fixture
+def s3():
+    s3 = MagicMock()
+    s3.create_multipart_upload = AsyncMock(return_value={'UploadId': 'upload'})
+    s3.upload_part = AsyncMock(side_effect=lambda **kwargs: {'ETag': str(kwargs['PartNumber'])})
+    s3.complete_multipart_upload = AsyncMock()
+    s3.abort_multipart_upload = AsyncMock()
+    return s3
+
+
+@pytest.fixture
+def local_file(tmp_path):
+    path = tmp_path / 'file.bin'
+    path.write_bytes(b'0123456789')
+    return str(path)
+
+
+@pytest.mark.asyncio
+async def test_multipart_upload(mocker, s3, local_file):
+    mocker.patch('src.storages.cloud.settings.S3_MULTIPART_PART_SIZE', 4)
+    storage = CloudStorage('bucket', 'media')
+
+    await storage.multipart_upload(s3, local_file, 'media/file.bin')
+
+    bodies = [call.kwargs['Body'] for call in s3.upload_part.await_args_list]
+    assert sorted(bodies) == [b'0123', b'4567', b'89']
+    parts = s3.complete_multipart_upload.await_args.kwargs['MultipartUpload']['Parts']
+    assert [p['PartNumber'] for p in parts] == [1, 2, 3]
+    s3.abort_multipart_upload.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_multipart_upload_aborted(mocker, s3, local_file):
+    mocker.patch('src.storages.cloud.settings.S3_MULTIPART_PART_SIZE', 4)
+    mocker.patch('src.storages.cloud.settings.S3_MULTIPART_RETRIES', 0)
+    s3.upload_part = AsyncMock(side_effect=ClientError({'Error': {}}, 'UploadPart'))
+    storage = CloudStorage('bucket', 'media')
+
+    with pytest.raises(ClientError):
+        await storage.multipart_upload(s3, local_file, 'media/file.bin')
+
+    s3.complete_multipart_upload.assert_not_called()
+    s3.abort_multipart_upload.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_multipart_upload_aborted_after_parts_in_flight(mocker, s3, local_file):
+    mocker.patch('src.storages.cloud.settings.S3_MULTIPART_PART_SIZE', 2)
+    mocker.patch('src.storages.cloud.settings.S3_MULTIPART_CONCURRENCY', 2)
+    mocker.patch('src.storages.cloud.settings.S3_MULTIPART_RETRIES', 0)
+    events = []
+    running = 0
+
+    async def upload_part(**kwargs):
+        nonlocal running
+        running += 1
+        events.append(('max', running))
+        try:
+            if kwargs['PartNumber'] == 3:
+                raise ClientError({'Error': {'Code': 'InternalError'}}, 'UploadPart')
+            await asyncio.sleep(0.05 * kwargs['PartNumber'])
+            return {'ETag': str(kwargs['PartNumber'])}
+        finally:
+            running -= 1
+            events.append(('done', kwargs['PartNumber']))
+
+    s3.upload_part = upload_part
+    s3.abort_multipart_upload = AsyncMock(side_effect=lambda **kwargs: events.append(('abort', None)))
+    storage = CloudStorage('bucket', 'media')
+
+    with pytest.raises(ClientError):
+        await storage.multipart_upload(s3, local_file, 'media/file.bin')
+
+    # 5 parts, 2 workers
+    assert max(value for event, value in events if event == 'max') == 2
+    assert events[-1] == ('abort', None)
+    # part 2 was still in flight when part 3 failed
+    assert ('done', 2) in events
+
+
+@pytest.mark.asyncio
+async def test_client_is_reused():
+    storage = CloudStorage('bucket', 'media')
+    client = MagicMock()
+    client.__aenter__ = AsyncMock(return_value=client)
+    client.__aexit__ = AsyncMock(return_value=False)
+    storage.session.client = MagicMock(return_value=client)
+
+    assert await storage.get_client() is await storage.get_client()
+    storage.session.client.assert_called_once()
+
+    await storage.close()
+    client.__aexit__.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_presigned_multipart_upload(mocker, s3):
+    mocker.patch('src.storages.cloud.settings.S3_MULTIPART_PART_SIZE', 4)
+    s3.generate_presigned_url = AsyncMock(side_effect=lambda method, Params, ExpiresIn: f"url-{Params['PartNumber']}")
+    storage = CloudStorage('bucket', 'media')
+    storage.get_client = AsyncMock(return_value=s3)
+
+    upload_id, part_size, urls = await storage.create_presigned_multipart_upload('file.bin', 10)
+
+    assert upload_id == 'upload'
+    assert part_size == 4
+    assert urls == ['url-1', 'url-2', 'url-3']
+
+
+@pytest.mark.asyncio
+async def test_get_object_info_sniffs_format(mocker, s3):
+    s3.head_object = AsyncMock(return_value={'ContentLength': 10, 'ContentType': 'application/octet-stream'})
+    body = MagicMock()
+    body.__aenter__ = AsyncMock(return_value=body)
+    body.__aexit__ = AsyncMock(return_value=False)
+    body.read = AsyncMock(return_value=b'%PDF-1.4\n')
+    s3.get_object = AsyncMock(return_value={'Body': body})
+    storage = CloudStorage('bucket', 'media')
+    storage.get_client = AsyncMock(return_value=s3)
+
+    assert await storage.get_object_info('file.pdf') == (10, 'pdf')
+    assert s3.get_object.await_args.kwargs['Range'].startswith('bytes=0-')
+
+
+@pytest.mark.asyncio
+async def test_get_object_info_not_uploaded(s3):
+    s3.head_object = AsyncMock(side_effect=ClientError({'Error': {'Code': '404'}}, 'HeadObject'))
+    storage = CloudStorage('bucket', 'media')
+    storage.get_client = AsyncMock(return_value=s3)
+
+    with pytest.raises(FileNotFoundError):
+        await storage.get_object_info('file.pdf')
+
+
+@pytest.mark.asyncio
+async def test_stream_file_range(s3):
+    class Body:
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *args):
+            return False
+
+        async def iter_chunks(self, chunk_size):
+            for chunk in (b'0123', b'45'):
+                yield chunk
+
+    s3.get_object = AsyncMock(return_value={'ContentLength': 6, 'ContentRange': 'bytes 2-7/10', 'Body': Body()})
+    storage = CloudStorage('bucket', 'media')
+    storage.get_client = AsyncMock(return_value=s3)
+
+    stream = await storage.stream_file('file.bin', (2, 7))
+
+    assert (stream.size, stream.total_size) == (6, 10)
+    assert [chunk async for chunk in stream.chunks] == [b'0123', b'45']
+    assert s3.get_object.await_args.kwargs['Range'] == 'bytes=2-7'
+
+    s3.get_object = AsyncMock(side_effect=ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject'))
+    with pytest.raises(FileNotFoundError):
+        await storage.stream_file('missing.bin')
+
+
+@pytest.mark.asyncio
+async def test_stream_file_cloud_error(s3):
+    s3.get_object = AsyncMock(side_effect=ClientError(
+        {'Error': {'Code': 'SlowDown'}, 'ResponseMetadata': {'HTTPStatusCode': 503}}, 'GetObject'
+    ))
+    storage = CloudStorage('bucket', 'media')
+    storage.get_client = AsyncMock(return_value=s3)
+
+    # not a missing file
+    with pytest.raises(ClientError):
+        await storage.stream_file('file.bin')
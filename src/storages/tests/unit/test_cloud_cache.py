@@ -0,0 +1,107 @@
+import asyncio
+import os
+
+import pytest
+
+from unittest.mock import MagicMock
+
+from src.storages.base import FileStream
+from src.storages.cloud_cache import CloudCache, Fetch
+
+
+class FakeCloud:
+    def __init__(self, files: dict):
+        self.files = files
+        self.requests = 0
+        self.chunks: asyncio.Queue = asyncio.Queue()
+
+    async def stream_file(self, filename: str):
+        self.requests += 1
+        if filename not in self.files:
+            raise FileNotFoundError
+        size = len(self.files[filename])
+        return FileStream(self.body(), size, size)
+
+    async def body(self):
+        while (chunk := await self.chunks.get()) is not None:
+            yield chunk
+
+
+async def read(fetch: Fetch) -> bytes:
+    return b''.join([chunk async for chunk in fetch.open_reader(chunk_size=4)])
+
+
+@pytest.mark.asyncio
+async def test_shared_fetch(tmp_path):
+    cloud = FakeCloud({'a.txt': b'hello world'})
+    cache = CloudCache(str(tmp_path), max_size=100, cloud=MagicMock(stream_file=cloud.stream_file))
+
+    first, second = await asyncio.gather(cache.get('a.txt'), cache.get('a.txt'))
+    assert first is second
+    readers = asyncio.gather(read(first), read(second))
+    for chunk in (b'hello', b' world', None):
+        await cloud.chunks.put(chunk)
+
+    assert await readers == [b'hello world', b'hello world']
+    with await first.wait() as file:
+        assert file.name == str(tmp_path / 'a.txt')
+    assert cloud.requests == 1
+    with await cache.get('a.txt') as file:
+        # evicted while the file is sent
+        os.remove(file.name)
+        assert file.read() == b'hello world'
+    assert os.listdir(tmp_path) == []
+
+    fetch = await cache.get('a.txt')
+    assert isinstance(fetch, Fetch)
+    await cloud.chunks.put(b'hello world')
+    await cloud.chunks.put(None)
+    (await fetch.wait()).close()
+    assert cloud.requests == 2
+    assert cache.size == len(b'hello world')
+
+
+@pytest.mark.asyncio
+async def test_fetch_missing(tmp_path):
+    cache = CloudCache(str(tmp_path), max_size=100, cloud=MagicMock(stream_file=FakeCloud({}).stream_file))
+
+    with pytest.raises(FileNotFoundError):
+        await cache.get('a.txt')
+
+
+@pytest.mark.asyncio
+async def test_fetch_broken(tmp_path):
+    cloud = FakeCloud({'a.txt': b'hello world'})
+    cache = CloudCache(str(tmp_path), max_size=100, cloud=MagicMock(stream_file=cloud.stream_file))
+
+    fetch = await cache.get('a.txt')
+    reader = asyncio.ensure_future(read(fetch))
+    for chunk in (b'hello', None):
+        await cloud.chunks.put(chunk)
+
+    with pytest.raises(IOError):
+        await reader
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.asyncio
+async def test_evict_and_trim(tmp_path):
+    cloud = FakeCloud({name: b'x' * 60 for name in ('a.txt', 'b.txt')})
+    cache = CloudCache(str(tmp_path), max_size=100, cloud=MagicMock(stream_file=cloud.stream_file))
+    for name in ('a.txt', 'b.txt'):
+        fetch = await cache.get(name)
+        await cloud.chunks.put(b'x' * 60)
+        await cloud.chunks.put(None)
+        (await fetch.wait()).close()
+
+    assert os.listdir(tmp_path) == ['b.txt']
+    assert cache.size == 60
+
+    # written by another worker, and a fetch of a dead worker
+    (tmp_path / 'c.txt').write_bytes(b'x' * 60)
+    (tmp_path / 'd.txt.fetching1').write_bytes(b'x')
+    os.utime(tmp_path / 'b.txt', (1, 1))
+    os.utime(tmp_path / 'd.txt.fetching1', (1, 1))
+
+    assert await cache.trim() == 2
+    assert os.listdir(tmp_path) == ['c.txt']
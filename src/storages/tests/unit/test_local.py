@@ -0,0 +1,72 @@
+import pytest
+
+from src.storages.local import LocalStorage
+from src.storages.commands.shard_upload_dir import ShardUploadDir
+
+
+FILENAME = 'abcdef12-3456-7890-abcd-ef1234567890.pdf'
+
+
+@pytest.fixture
+def storage(mocker, tmp_path):
+    mocker.patch('src.storages.local.settings.UPLOAD_DIR', tmp_path)
+    mocker.patch('src.storages.base.settings.UPLOAD_DIR', tmp_path)
+    mocker.patch('src.storages.local.settings.UPLOAD_DIR_SHARD_LEVELS', 2)
+    mocker.patch('src.storages.local.settings.UPLOAD_DIR_SHARD_WIDTH', 2)
+    return LocalStorage(tmp_path)
+
+
+def test_get_upload_path_sharded(storage, tmp_path):
+    path = storage.get_upload_path(FILENAME, create_dirs=True)
+    assert path == str(tmp_path / 'ab' / 'cd' / FILENAME)
+    assert (tmp_path / 'ab' / 'cd').is_dir()
+
+
+def test_get_upload_path_flat_fallback(storage, tmp_path):
+    (tmp_path / FILENAME).write_bytes(b'content')
+    assert storage.get_upload_path(FILENAME, check_exists=True) == str(tmp_path / FILENAME)
+
+    with pytest.raises(FileNotFoundError):
+        storage.get_upload_path('missing.pdf', check_exists=True)
+
+
+@pytest.mark.asyncio
+async def test_shard_upload_dir(storage, tmp_path):
+    (tmp_path / FILENAME).write_bytes(b'content')
+
+    moved = await ShardUploadDir(storage, batch_size=1).migrate()
+
+    assert moved == 1
+    assert not (tmp_path / FILENAME).exists()
+    assert (tmp_path / 'ab' / 'cd' / FILENAME).read_bytes() == b'content'
+    assert storage.get_upload_path(FILENAME, check_exists=True) == str(tmp_path / 'ab' / 'cd' / FILENAME)
+
+
+@pytest.mark.asyncio
+async def test_list_files(storage, tmp_path):
+    for name in ('a.txt', 'b.txt'):
+        (tmp_path / name).write_bytes(b'1')
+    (tmp_path / 'ab' / 'cd').mkdir(parents=True)
+    (tmp_path / 'ab' / 'cd' / 'c.txt').write_bytes(b'1')
+
+    batches = [batch async for batch in storage.list_files(batch_size=2)]
+
+    assert [len(batch) for batch in batches] == [2, 1]
+    paths = sorted(file.path for batch in batches for file in batch)
+    assert paths == sorted(str(tmp_path / name) for name in ('a.txt', 'b.txt', 'ab/cd/c.txt'))
+
+
+@pytest.mark.asyncio
+async def test_stream_file(storage, tmp_path):
+    (tmp_path / 'ab' / 'cd').mkdir(parents=True)
+    (tmp_path / 'ab' / 'cd' / FILENAME).write_bytes(b'0123456789')
+
+    stream = await storage.stream_file(FILENAME, (2, 7), chunk_size=4)
+    assert (stream.size, stream.total_size) == (6, 10)
+    assert [chunk async for chunk in stream.chunks] == [b'2345', b'67']
+
+    stream = await storage.stream_file(FILENAME)
+    assert b''.join([chunk async for chunk in stream.chunks]) == b'0123456789'
+
+    with pytest.raises(FileNotFoundError):
+        await storage.stream_file('missing.pdf')
@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+from unittest.mock import AsyncMock, MagicMock
+
+from src.storages.commands.replicate_files import ReplicateFiles
+
+
+@pytest.fixture
+def jobs_repo(mocker):
+    async def get_db():
+        yield MagicMock()
+
+    mocker.patch('src.storages.commands.replicate_files.get_db', get_db)
+    repo = MagicMock()
+    repo.claim_jobs = AsyncMock(return_value=[(1, 'a.pdf', 1), (2, 'b.pdf', 3)])
+    repo.complete_jobs = AsyncMock()
+    repo.retry_job = AsyncMock()
+    mocker.patch('src.storages.commands.replicate_files.ReplicationJobsRepository', return_value=repo)
+    return repo
+
+
+@pytest.mark.asyncio
+async def test_replicate_batch(jobs_repo):
+    source = MagicMock()
+    source.get_upload_path = lambda filename, **kwargs: f'/media/{filename}'
+    target = MagicMock()
+    target.upload_file = AsyncMock(side_effect=[None, ConnectionError('s3 is down')])
+
+    replicated = await ReplicateFiles(source, target).replicate_batch()
+
+    assert replicated == 2
+    jobs_repo.complete_jobs.assert_awaited_once_with([1])
+    job_id, retry_in, error = jobs_repo.retry_job.await_args.args
+    assert job_id == 2
+    assert retry_in == ReplicateFiles.RETRY_BACKOFF * 4
+
+
+@pytest.mark.asyncio
+async def test_replicate_batch_extends_lease(mocker, jobs_repo):
+    mocker.patch.object(ReplicateFiles, 'LEASE', ReplicateFiles.LEASE / 10_000)
+    jobs_repo.extend_lease = AsyncMock()
+    source = MagicMock()
+    source.get_upload_path = lambda filename, **kwargs: f'/media/{filename}'
+
+    async def upload_file(path):
+        if path == '/media/b.pdf':
+            raise ConnectionError('s3 is down')
+        await asyncio.sleep(0.2)
+
+    target = MagicMock()
+    target.upload_file = upload_file
+
+    await ReplicateFiles(source, target).replicate_batch()
+
+    ids, lease = jobs_repo.extend_lease.await_args.args
+    assert ids == [1]
+    assert lease == ReplicateFiles.LEASE
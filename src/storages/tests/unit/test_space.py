@@ -0,0 +1,40 @@
+from collections import namedtuple
+
+import pytest
+
+from src.storages.space import InsufficientStorage, SpaceLedger
+
+DiskUsage = namedtuple('DiskUsage', 'total used free')
+
+
+@pytest.fixture
+def ledger(mocker):
+    mocker.patch('src.storages.space.shutil.disk_usage', return_value=DiskUsage(1000, 0, 1000))
+    return SpaceLedger('/media', min_free=100)
+
+
+def test_reserve(ledger):
+    first = ledger.reserve(500)
+    with pytest.raises(InsufficientStorage) as e:
+        ledger.reserve(500)
+    assert e.value.status_code == 507
+
+    first.consume(200)
+    assert ledger.reserved == 300
+    with first:
+        pass
+    assert ledger.reserved == 0
+    ledger.reserve(900).release()
+
+
+def test_reserve_too_large(ledger):
+    with pytest.raises(InsufficientStorage) as e:
+        ledger.reserve(901)
+    assert e.value.status_code == 413
+
+
+def test_reserve_below_watermark(ledger, mocker):
+    mocker.patch('src.storages.space.shutil.disk_usage', return_value=DiskUsage(1000, 950, 50))
+    with pytest.raises(InsufficientStorage) as e:
+        ledger.reserve(0)
+    assert e.value.status_code == 507
@@ -0,0 +1,99 @@
+import asyncio
+import threading
+
+import pytest
+
+from src.storages.writer import WritePipeline
+
+
+@pytest.mark.asyncio
+async def test_write_pipeline_order(tmp_path):
+    with open(tmp_path / 'file', 'w+b') as f:
+        pipeline = WritePipeline(f.fileno(), depth=2)
+        for i in range(10):
+            await pipeline.write(str(i).encode(), lambda data: data * 2)
+        # seeks of the file object don't move the writes
+        f.seek(0)
+        await pipeline.close()
+
+    assert (tmp_path / 'file').read_bytes() == b'00112233445566778899'
+
+
+@pytest.mark.asyncio
+async def test_write_pipeline_backpressure(tmp_path):
+    disk = threading.Event()
+
+    def slow_disk(data: bytes) -> bytes:
+        disk.wait(5)
+        return data
+
+    with open(tmp_path / 'file', 'w+b') as f:
+        pipeline = WritePipeline(f.fileno(), depth=2)
+        await pipeline.write(b'a', slow_disk)
+        await pipeline.write(b'b', slow_disk)
+        third = asyncio.create_task(pipeline.write(b'c', slow_disk))
+        await asyncio.sleep(0.05)
+        assert not third.done()
+
+        disk.set()
+        await third
+        await pipeline.close()
+
+    assert (tmp_path / 'file').read_bytes() == b'abc'
+
+
+@pytest.mark.asyncio
+async def test_write_pipeline_error(mocker, tmp_path):
+    fsync = mocker.patch('src.storages.writer.os.fsync')
+
+    def fail(data: bytes) -> bytes:
+        raise OSError('No space left on device')
+
+    with open(tmp_path / 'file', 'w+b') as f:
+        pipeline = WritePipeline(f.fileno(), fsync=True)
+        await pipeline.write(b'a', fail)
+        await pipeline.write(b'b')
+        with pytest.raises(OSError):
+            await pipeline.close()
+        with pytest.raises(OSError):
+            await pipeline.write(b'c')
+
+        pipeline = WritePipeline(f.fileno(), fsync=True)
+        await pipeline.write(b'd')
+        await pipeline.close()
+
+    assert (tmp_path / 'file').read_bytes() == b'd'
+    fsync.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_write_pipeline_preallocate(tmp_path):
+    with open(tmp_path / 'file', 'w+b') as f:
+        pipeline = WritePipeline(f.fileno())
+        await pipeline.preallocate(1024 * 1024)
+        await pipeline.write(b'content')
+        await pipeline.close()
+
+    assert (tmp_path / 'file').read_bytes() == b'content'
+
+
+@pytest.mark.asyncio
+async def test_write_pipeline_owns_descriptor(tmp_path):
+    disk = threading.Event()
+
+    def slow_disk(data: bytes) -> bytes:
+        disk.wait(5)
+        return data
+
+    f = open(tmp_path / 'file', 'w+b')
+    pipeline = WritePipeline(f.fileno())
+    await pipeline.write(b'queued', slow_disk)
+    # closed by the caller while the write waits for the disk
+    f.close()
+    disk.set()
+    await pipeline.close()
+
+    assert (tmp_path / 'file').read_bytes() == b'queued'
+    assert pipeline.fd is None
+    with pytest.raises(ValueError):
+        await pipeline.write(b'late')
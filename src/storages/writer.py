@@ -0,0 +1,144 @@
+import asyncio
+import errno
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+
+from src.settings import settings
+
+# Separate from the default thread pool, so writes to a slow disk don't hold threads other requests wait for
+writer_executor = ThreadPoolExecutor(settings.UPLOAD_WRITER_THREADS, thread_name_prefix='upload-writer')
+
+
+class WritePipeline:
+    """
+    Append buffers to a file in the writer threads, in order, without blocking the event loop.
+    At most `depth` buffers wait for the disk, then `write` waits too,
+    so a slow disk slows down reading of the request instead of growing memory.
+    Buffers are written with pwrite at the own offset of the pipeline, seeks of the file object don't affect them.
+    The pipeline writes to its own duplicate of fd, closed after the last write, so closing the file object
+    while writes are queued can't redirect them to another file which reused the descriptor.
+    """
+
+    def __init__(
+            self,
+            fd: int,
+            offset: int = 0,
+            depth: int = settings.UPLOAD_WRITE_QUEUE_DEPTH,
+            fsync: bool = settings.UPLOAD_FSYNC,
+            executor: Optional[ThreadPoolExecutor] = None,
+    ) -> None:
+        self.fd: Optional[int] = os.dup(fd)
+        self.offset = offset
+        self.fsync = fsync
+        self.executor = executor or writer_executor
+        self._slots = asyncio.Semaphore(max(depth, 1))
+        self._tail: Optional[asyncio.Future] = None
+        self._error: Optional[Exception] = None
+        self._aborted = False
+        self._closed = False
+        self._allocated = 0  # end of the preallocated blocks
+
+    async def preallocate(self, size: int) -> None:
+        """
+        Allocate disk blocks for the next size bytes with posix_fallocate, so a large file is written sequentially
+        into contiguous blocks and a full disk fails now. The file is truncated to the written size on close.
+        """
+        if size > 0 and hasattr(os, 'posix_fallocate'):
+            await self._submit(self._fallocate, size)
+
+    async def write(self, data: bytes, transform: Optional[Callable[[bytes], bytes]] = None) -> None:
+        """
+        Queue data to be appended to the file, transform (hash, compress) is called in the writer thread
+        """
+        await self._submit(self._write, data, transform)
+
+    async def _submit(self, func: Callable, *args) -> None:
+        self._raise_error()
+        if self._closed:
+            raise ValueError('Write to a closed pipeline')
+        await self._slots.acquire()
+        self._tail = asyncio.ensure_future(self._run_after(self._tail, func, *args))
+
+    async def _run_after(self, previous: Optional[asyncio.Future], func: Callable, *args) -> None:
+        try:
+            if previous is not None:
+                await previous
+            if self._error is None and not self._aborted:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(self.executor, func, *args)
+        except Exception as e:
+            self._error = self._error or e
+        finally:
+            self._slots.release()
+
+    def _write(self, data: bytes, transform: Optional[Callable[[bytes], bytes]]) -> None:
+        if transform is not None:
+            data = transform(data)
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self.fd, view, self.offset)
+            self.offset += written
+            view = view[written:]
+
+    def _fallocate(self, size: int) -> None:
+        try:
+            os.posix_fallocate(self.fd, self.offset, size)
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                raise
+            return
+        self._allocated = max(self._allocated, self.offset + size)
+
+    def _sync(self) -> None:
+        if self._allocated > self.offset:
+            # the size hint was larger than the content
+            os.ftruncate(self.fd, self.offset)
+        if self.fsync:
+            os.fsync(self.fd)
+
+    def _raise_error(self) -> None:
+        if self._error is not None:
+            raise self._error
+
+    async def close(self) -> None:
+        """
+        Wait until everything queued is written, fsync if enabled
+        """
+        try:
+            await self._submit(self._sync)
+            await asyncio.shield(self._tail)
+        finally:
+            self._release()
+        self._raise_error()
+
+    async def abort(self) -> None:
+        """
+        Drop queued buffers and wait for the write in progress, so the file can be closed and removed
+        """
+        self._aborted = True
+        try:
+            if self._tail is not None:
+                await asyncio.shield(self._tail)
+        finally:
+            self._release()
+
+    def _release(self) -> None:
+        """
+        Close the descriptor when the queued writes are done, also if the caller is cancelled meanwhile
+        """
+        self._closed = True
+        if self._tail is None or self._tail.done():
+            self._close_fd()
+        else:
+            self._tail.add_done_callback(lambda _: self._close_fd())
+
+    def _close_fd(self) -> None:
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __del__(self) -> None:
+        # never closed, queued writes hold a reference to the pipeline, so none is left
+        if getattr(self, 'fd', None) is not None:
+            self._close_fd()
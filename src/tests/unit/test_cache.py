@@ -0,0 +1,37 @@
+import pytest
+
+from src.cache import LocalCache
+
+
+@pytest.mark.asyncio
+async def test_lru_eviction():
+    cache = LocalCache(maxsize=2, ttl=60)
+    await cache.set('a', 1)
+    await cache.set('b', 2)
+    assert await cache.get('a') == 1
+    await cache.set('c', 3)
+
+    assert await cache.get('b') is None
+    assert await cache.get('a') == 1
+    assert await cache.get('c') == 3
+    assert cache.stats() == {'size': 2, 'hits': 3, 'misses': 1}
+
+
+@pytest.mark.asyncio
+async def test_ttl(mocker):
+    monotonic = mocker.patch('src.cache.time.monotonic', return_value=100)
+    cache = LocalCache(maxsize=10, ttl=60)
+    await cache.set('a', 1)
+    await cache.set('b', 2, ttl=5)
+
+    monotonic.return_value = 110
+    assert await cache.get('a') == 1
+    assert await cache.get('b') is None
+
+
+@pytest.mark.asyncio
+async def test_delete():
+    cache = LocalCache(maxsize=10, ttl=60)
+    await cache.set('a', 1)
+    await cache.delete(['a', 'missing'])
+    assert await cache.get('a') is None
@@ -0,0 +1,30 @@
+import pytest
+
+from src.storages.compression import accepts_encoding, get_compressor, get_decompressor, get_storage_encoding
+
+
+def test_accepts_encoding():
+    assert accepts_encoding('gzip, deflate, br', 'gzip')
+    assert accepts_encoding('*', 'zstd')
+    assert not accepts_encoding('gzip;q=0, *', 'gzip')
+    assert not accepts_encoding('*;q=0', 'gzip')
+    assert not accepts_encoding('', 'gzip')
+    assert not accepts_encoding(None, 'gzip')
+
+
+def test_storage_encoding(mocker):
+    assert get_storage_encoding('json') is None
+    mocker.patch('src.storages.compression.settings.STORAGE_COMPRESSION', 'gzip')
+    assert get_storage_encoding('json') == 'gzip'
+    assert get_storage_encoding('jpeg') is None
+
+
+def test_gzip_roundtrip():
+    compressor = get_compressor('gzip')
+    data = compressor.compress(b'hello ' * 100) + compressor.flush()
+    assert get_decompressor('gzip').decompress(data) == b'hello ' * 100
+
+
+def test_unknown_encoding():
+    with pytest.raises(ValueError):
+        get_compressor('br')
@@ -0,0 +1,101 @@
+import asyncio
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+from PIL import Image
+
+from src import derivatives
+from src.derivatives import DerivativeCache, RenderFailed
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = tmp_path / 'image.png'
+    Image.new('RGB', (640, 480), 'red').save(path)
+    return str(path)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = DerivativeCache(str(tmp_path / 'derivatives'), max_size=10 * 1024 * 1024, workers=1)
+    cache._executor = ThreadPoolExecutor(1)
+    yield cache
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_render_once(mocker, cache, image_path):
+    render = mocker.spy(derivatives, 'render')
+    file_id = uuid.uuid4()
+
+    paths = await asyncio.gather(*(cache.get(image_path, file_id, 320, 'webp') for _ in range(3)))
+    await cache.get(image_path, file_id, 320, 'webp')
+
+    assert len(set(paths)) == 1
+    render.assert_called_once()
+    with Image.open(paths[0]) as image:
+        assert image.format == 'WEBP'
+        assert image.size == (320, 240)
+
+
+@pytest.mark.asyncio
+async def test_evict_least_recently_used(cache, image_path):
+    file_id = uuid.uuid4()
+    first = await cache.get(image_path, file_id, 100, 'png')
+    cache.max_size = cache.size
+    second = await cache.get(image_path, file_id, 200, 'png')
+
+    assert list(cache._entries) == [derivatives.DerivativeCache.get_filename(file_id, 200, 'png')]
+    assert not os.path.exists(first)
+    assert os.path.exists(second)
+
+
+@pytest.mark.asyncio
+async def test_render_failed(tmp_path, cache):
+    path = tmp_path / 'broken.png'
+    path.write_bytes(b'not an image')
+
+    with pytest.raises(RenderFailed):
+        await cache.get(str(path), uuid.uuid4(), 100, 'png')
+
+
+class BrokenExecutor(ThreadPoolExecutor):
+    def submit(self, *args, **kwargs):
+        raise BrokenProcessPool('A process in the process pool was terminated abruptly')
+
+
+@pytest.mark.asyncio
+async def test_render_process_died(cache, image_path):
+    broken = cache._executor = BrokenExecutor(1)
+
+    with pytest.raises(RenderFailed):
+        await cache.get(image_path, uuid.uuid4(), 320, 'webp')
+    assert cache._executor is None
+
+    cache._executor = ThreadPoolExecutor(1)
+    assert await cache.get(image_path, uuid.uuid4(), 320, 'webp')
+    broken.shutdown()
+
+
+def test_failed_render_removes_tmp_file(mocker, tmp_path, image_path):
+    def save(self, path, *args, **kwargs):
+        open(path, 'wb').close()
+        raise OSError('No space left on device')
+
+    mocker.patch.object(Image.Image, 'save', save)
+    with pytest.raises(OSError):
+        derivatives.render(image_path, str(tmp_path / 'target.webp'), 320, 'webp')
+    assert sorted(os.listdir(tmp_path)) == ['image.png']
+
+
+def test_load_skips_tmp_files(cache):
+    os.makedirs(cache.path)
+    open(os.path.join(cache.path, f'{uuid.uuid4()}_320.webp'), 'wb').close()
+    open(os.path.join(cache.path, f'{uuid.uuid4()}_320.webp.tmp123'), 'wb').close()
+
+    cache._load()
+
+    assert len(cache._entries) == 1
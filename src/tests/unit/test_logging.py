@@ -0,0 +1,69 @@
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+
+from src.logging import AccessLogMiddleware, RateLimiter, logger
+
+
+def make_app(**kwargs) -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(AccessLogMiddleware, **kwargs)
+
+    @app.post('/echo')
+    async def echo(request: Request):
+        logger.info('echo')
+        return {'size': len(await request.body())}
+
+    return app
+
+
+def test_access_log_middleware():
+    records = []
+    sink = logger.add(lambda message: records.append(message.record), level='INFO')
+    try:
+        client = TestClient(make_app())
+        response = client.post('/echo', content=b'x' * 100, headers={'x-request-id': 'req-1'})
+        assert response.headers['x-request-id'] == 'req-1'
+        response = client.post('/echo', headers={'x-request-id': 'not valid'})
+        assert response.headers['x-request-id'] != 'not valid'
+    finally:
+        logger.remove(sink)
+
+    echo, access = records[:2]
+    assert echo['extra']['request_id'] == 'req-1'
+    assert access['extra']['request_id'] == 'req-1'
+    assert access['extra']['status'] == 200
+    assert access['extra']['received_bytes'] == 100
+    assert access['extra']['sent_bytes'] == len(b'{"size":100}')
+    assert access['extra']['receive_seconds'] is not None
+    assert access['extra']['send_seconds'] is not None
+    assert records[3]['extra']['request_id'] == response.headers['x-request-id']
+
+
+def test_access_log_sampling():
+    records = []
+    sink = logger.add(
+        lambda message: records.append(message.record), level='INFO', filter=lambda record: 'access' in record['extra']
+    )
+    try:
+        client = TestClient(make_app(sample_rate=0))
+        client.post('/echo')
+        client.get('/unknown')
+    finally:
+        logger.remove(sink)
+
+    assert [record['extra']['status'] for record in records] == [404]
+
+
+def test_rate_limiter(mocker):
+    monotonic = mocker.patch('src.logging.time.monotonic', return_value=0)
+    limiter = RateLimiter(limit=2, interval=60)
+
+    assert limiter.allow('key') == (True, 0)
+    assert limiter.allow('key') == (True, 0)
+    assert limiter.allow('key') == (False, 1)
+    assert limiter.allow('key') == (False, 2)
+    assert limiter.allow('other') == (True, 0)
+
+    monotonic.return_value = 60
+    assert limiter.allow('key') == (True, 2)
+    assert limiter.allow('key') == (True, 0)
@@ -0,0 +1,45 @@
+from unittest.mock import AsyncMock, MagicMock
+
+import pytest
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+from src.main import metrics
+from src.metrics import MetricsMiddleware
+
+
+def test_metrics_middleware():
+    app = FastAPI()
+    app.add_middleware(MetricsMiddleware)
+
+    @app.post('/items/{item_id}')
+    async def echo(item_id: int, request: Request):
+        return {'size': len(await request.body())}
+
+    client = TestClient(app)
+    for item_id in (1, 2):
+        assert client.post(f'/items/{item_id}', content=b'x' * 100).status_code == 200
+    client.get('/unknown')
+
+    labels = {'method': 'POST', 'route': '/items/{item_id}', 'status': '200'}
+    assert REGISTRY.get_sample_value('files_http_request_duration_seconds_count', labels) == 2
+    assert REGISTRY.get_sample_value('files_http_received_bytes_total', {'route': '/items/{item_id}'}) == 200
+    assert REGISTRY.get_sample_value('files_http_sent_bytes_total', {'route': '/items/{item_id}'}) > 0
+    assert REGISTRY.get_sample_value(
+        'files_http_request_duration_seconds_count', {'method': 'GET', 'route': 'unmatched', 'status': '404'}
+    ) == 1
+
+
+@pytest.mark.asyncio
+async def test_metrics_without_database(mocker):
+    mocker.patch('src.main.settings.REPLICATION_OUTBOX', True)
+    set_backlog = mocker.patch('src.main.set_replication_backlog')
+    jobs_repo = MagicMock()
+    jobs_repo.get_backlog = AsyncMock(side_effect=ConnectionRefusedError())
+
+    response = await metrics(jobs_repo)
+
+    assert response.status_code == 200
+    assert b'files_upload_dir_free_bytes' in response.body
+    set_backlog.assert_not_called()
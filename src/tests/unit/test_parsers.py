@@ -0,0 +1,183 @@
+import errno
+import gzip
+import hashlib
+import threading
+
+import pytest
+
+from unittest.mock import MagicMock
+from starlette.datastructures import Headers
+from starlette.requests import ClientDisconnect
+
+from src.parsers import TargetFileMultipartParser, TargetUploadFile, UploadRejected
+from src.storages.space import SpaceLedger
+from src.storages.writer import WritePipeline
+
+
+@pytest.mark.asyncio
+async def test_target_upload_file_sha256(tmp_path):
+    with open(tmp_path / 'file', 'w+b') as f:
+        file = TargetUploadFile(f, size=0, filename='file.txt')
+        await file.write(b'hello ')
+        await file.write(b'world')
+        await file.finish()
+
+    assert file.size == 11
+    assert file.sha256 == hashlib.sha256(b'hello world').hexdigest()
+    assert (tmp_path / 'file').read_bytes() == b'hello world'
+
+
+@pytest.mark.asyncio
+async def test_target_upload_file_format(tmp_path):
+    with open(tmp_path / 'file', 'w+b') as f:
+        file = TargetUploadFile(f, size=0, filename='file.pdf')
+        await file.write(b'%PDF-1.4\n')
+        await file.write(b'%' * 8192)
+        assert file._format_detected
+
+    assert file.file_format == 'pdf'
+
+
+@pytest.mark.asyncio
+async def test_target_upload_file_trusted_content_type(tmp_path):
+    with open(tmp_path / 'file', 'w+b') as f:
+        headers = Headers({'content-type': 'image/png'})
+        file = TargetUploadFile(f, size=0, filename='file.png', headers=headers, trust_content_type=True)
+        await file.write(b'not really a png')
+
+    assert file.file_format == 'png'
+
+
+@pytest.mark.asyncio
+async def test_target_upload_file_rejected(tmp_path):
+    with open(tmp_path / 'file', 'w+b') as f:
+        file = TargetUploadFile(f, size=0, filename='file.txt', max_size=4)
+        with pytest.raises(UploadRejected) as e:
+            await file.write(b'hello')
+        assert e.value.status_code == 413
+
+        file = TargetUploadFile(f, size=0, filename='file.txt', allowed_formats={'pdf'})
+        await file.write(b'hello')
+        with pytest.raises(UploadRejected) as e:
+            file.check_format()
+        assert e.value.status_code == 415
+
+
+@pytest.mark.asyncio
+async def test_target_upload_file_compressed(mocker, tmp_path):
+    mocker.patch('src.storages.compression.settings.STORAGE_COMPRESSION', 'gzip')
+    content = b'{"key": "value"}\n' * 1000
+    with open(tmp_path / 'file', 'w+b') as f:
+        headers = Headers({'content-type': 'application/json'})
+        file = TargetUploadFile(f, size=0, filename='file.json', headers=headers, trust_content_type=True)
+        await file.write(content[:10000])
+        await file.write(content[10000:])
+        await file.finish()
+
+    assert file.content_encoding == 'gzip'
+    assert file.size == len(content)
+    assert file.sha256 == hashlib.sha256(content).hexdigest()
+    stored = (tmp_path / 'file').read_bytes()
+    assert len(stored) < len(content)
+    assert gzip.decompress(stored) == content
+
+
+@pytest.mark.asyncio
+async def test_target_upload_file_buffered(mocker, tmp_path):
+    mocker.patch('src.parsers.settings.UPLOAD_WRITE_BUFFER_SIZE', 8192)
+    content = b'%PDF-1.4\n' + b'%' * 20000
+    with open(tmp_path / 'file', 'w+b') as f:
+        file = TargetUploadFile(f, size=0, filename='file.pdf')
+        for i in range(0, len(content), 1000):
+            await file.write(content[i:i + 1000])
+        # the parser seeks to the start when the part ends
+        await file.seek(0)
+        assert f.read() == content
+
+    assert file.sha256 == hashlib.sha256(content).hexdigest()
+
+
+@pytest.mark.asyncio
+async def test_target_upload_file_reservation(mocker, tmp_path):
+    mocker.patch('src.parsers.settings.UPLOAD_PREALLOCATE_MIN_SIZE', 8192)
+    mocker.patch('src.parsers.settings.UPLOAD_WRITE_BUFFER_SIZE', 8192)
+    preallocate = mocker.spy(WritePipeline, 'preallocate')
+    reservation = SpaceLedger(str(tmp_path), min_free=0).reserve(50000)
+    content = b'%PDF-1.4\n' + b'%' * 20000
+    with open(tmp_path / 'file', 'w+b') as f:
+        file = TargetUploadFile(f, size=0, filename='file.pdf', size_hint=30000, reservation=reservation)
+        await file.write(content)
+        assert reservation.remaining == 20000
+        await file.finish()
+
+    preallocate.assert_called_once_with(mocker.ANY, 30000)
+    assert (tmp_path / 'file').read_bytes() == content
+    assert reservation.remaining == 20000
+
+
+@pytest.mark.asyncio
+async def test_target_upload_file_disk_full(mocker, tmp_path):
+    mocker.patch('src.storages.writer.os.pwrite', side_effect=OSError(errno.ENOSPC, 'No space left on device'))
+    with open(tmp_path / 'file', 'w+b') as f:
+        file = TargetUploadFile(f, size=0, filename='file.txt')
+        await file.write(b'hello')
+        with pytest.raises(UploadRejected) as e:
+            await file.finish()
+
+    assert e.value.status_code == 507
+
+
+@pytest.mark.asyncio
+async def test_parser_removes_files_on_disconnect(mocker, tmp_path):
+    mocker.patch('src.parsers.settings.UPLOAD_WRITE_BUFFER_SIZE', 8192)
+    storage = MagicMock()
+    storage.filename_to_storage_filename = lambda filename: filename
+    storage.get_upload_path = lambda filename, **kwargs: str(tmp_path / filename)
+    headers = Headers({'content-type': 'multipart/form-data; boundary=boundary'})
+
+    async def stream():
+        yield (
+            b'--boundary\r\n'
+            b'Content-Disposition: form-data; name="file"; filename="file.txt"\r\n\r\n'
+        )
+        for _ in range(4):
+            yield b'x' * 4096
+        raise ClientDisconnect()
+
+    parser = TargetFileMultipartParser(headers, stream(), storage=storage)
+    with pytest.raises(ClientDisconnect):
+        await parser.parse()
+
+    assert list(tmp_path.iterdir()) == []
+    upload_file, = parser._upload_files
+    assert upload_file.file.closed
+    assert upload_file._pipeline.fd is None
+
+
+@pytest.mark.asyncio
+async def test_parser_creates_files_in_writer_thread(tmp_path):
+    threads = []
+    storage = MagicMock()
+    storage.filename_to_storage_filename = lambda filename: filename
+
+    def get_upload_path(filename, **kwargs):
+        threads.append(threading.current_thread().name)
+        return str(tmp_path / filename)
+
+    storage.get_upload_path = get_upload_path
+    headers = Headers({'content-type': 'multipart/form-data; boundary=boundary'})
+
+    async def stream():
+        yield (
+            b'--boundary\r\n'
+            b'Content-Disposition: form-data; name="file"; filename="file.txt"\r\n\r\n'
+            b'hello world\r\n'
+            b'--boundary--\r\n'
+        )
+
+    form = await TargetFileMultipartParser(headers, stream(), storage=storage).parse()
+
+    assert form['file'].file.name == str(tmp_path / 'file.txt')
+    assert (tmp_path / 'file.txt').read_bytes() == b'hello world'
+    assert len(threads) == 1 and threads[0].startswith('upload-writer')
+    await form.close()
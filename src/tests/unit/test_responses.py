@@ -0,0 +1,130 @@
+import uuid
+
+import pytest
+from starlette.testclient import TestClient
+
+from src.responses import MediaFileResponse, OffloadFileResponse, parse_range_header, RangeNotSatisfiable
+
+
+CONTENT = bytes(range(256)) * 4
+
+
+@pytest.fixture
+def client(tmp_path):
+    path = tmp_path / 'file.bin'
+    path.write_bytes(CONTENT)
+    file_id = uuid.uuid4()
+
+    async def app(scope, receive, send):
+        await MediaFileResponse(str(path), file_id=file_id)(scope, receive, send)
+
+    return TestClient(app)
+
+
+def test_parse_range_header():
+    assert parse_range_header('bytes=0-9', 100) == [(0, 9)]
+    assert parse_range_header('bytes=-10', 100) == [(90, 99)]
+    assert parse_range_header('bytes=90-', 100) == [(90, 99)]
+    assert parse_range_header('bytes=0-9,5-20,50-60', 100) == [(0, 20), (50, 60)]
+    assert parse_range_header('items=0-9', 100) == []
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range_header('bytes=200-300', 100)
+
+
+def test_full_response_headers(client):
+    res = client.get('/')
+    assert res.status_code == 200
+    assert res.content == CONTENT
+    assert 'immutable' in res.headers['cache-control']
+    assert res.headers['accept-ranges'] == 'bytes'
+    assert res.headers['etag']
+
+
+def test_single_range(client):
+    res = client.get('/', headers={'Range': 'bytes=10-19'})
+    assert res.status_code == 206
+    assert res.content == CONTENT[10:20]
+    assert res.headers['content-range'] == f'bytes 10-19/{len(CONTENT)}'
+
+
+def test_multiple_ranges(client):
+    res = client.get('/', headers={'Range': 'bytes=0-1,100-101'})
+    assert res.status_code == 206
+    assert res.headers['content-type'].startswith('multipart/byteranges')
+    assert int(res.headers['content-length']) == len(res.content)
+    assert CONTENT[100:102] in res.content
+
+
+def test_range_not_satisfiable(client):
+    res = client.get('/', headers={'Range': f'bytes={len(CONTENT)}-'})
+    assert res.status_code == 416
+
+
+def test_conditional_get(client):
+    etag = client.get('/').headers['etag']
+    assert client.get('/', headers={'If-None-Match': etag}).status_code == 304
+
+    last_modified = client.get('/').headers['last-modified']
+    assert client.get('/', headers={'If-Modified-Since': last_modified}).status_code == 304
+
+
+def test_offload_response_accel_redirect():
+    response = OffloadFileResponse(
+        '/srv/media/ab/cd/abcd.pdf',
+        root='/srv/media',
+        header='X-Accel-Redirect',
+        location='/protected-media/',
+        filename='отчёт.pdf',
+        media_type='application/pdf',
+    )
+
+    assert response.body == b''
+    assert response.headers['x-accel-redirect'] == '/protected-media/ab/cd/abcd.pdf'
+    assert response.headers['content-type'] == 'application/pdf'
+    assert response.headers['content-disposition'].startswith("inline; filename*=utf-8''")
+    assert 'immutable' in response.headers['cache-control']
+
+
+def test_offload_response_sendfile():
+    response = OffloadFileResponse('/srv/media/abcd.pdf', root='/srv/media', header='X-Sendfile', filename='a.pdf')
+
+    assert response.headers['x-sendfile'] == '/srv/media/abcd.pdf'
+    assert response.headers['content-disposition'] == 'inline; filename="a.pdf"'
+    assert response.headers['content-type'] == 'application/octet-stream'
+
+
+async def call_with_extensions(path, extensions, headers=()):
+    scope = {'type': 'http', 'method': 'GET', 'headers': list(headers), 'extensions': extensions}
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    await MediaFileResponse(path, file_id=uuid.uuid4())(scope, None, send)
+    return messages
+
+
+@pytest.mark.asyncio
+async def test_pathsend(tmp_path):
+    path = tmp_path / 'file.bin'
+    path.write_bytes(CONTENT)
+
+    messages = await call_with_extensions(str(path), {'http.response.pathsend': {}})
+
+    assert messages[1] == {'type': 'http.response.pathsend', 'path': str(path)}
+
+
+@pytest.mark.asyncio
+async def test_zerocopysend_range(tmp_path):
+    path = tmp_path / 'file.bin'
+    path.write_bytes(CONTENT)
+
+    messages = await call_with_extensions(
+        str(path), {'http.response.zerocopysend': {}}, headers=[(b'range', b'bytes=10-19')]
+    )
+
+    assert messages[0]['status'] == 206
+    body = messages[1]
+    assert body['type'] == 'http.response.zerocopysend'
+    assert (body['offset'], body['count'], body['more_body']) == (10, 10, False)
+    assert body['file'].name == str(path)
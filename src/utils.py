@@ -1,17 +1,53 @@
-from typing import Tuple
+from typing import Tuple, AsyncIterator
 
 from fastapi import Request, UploadFile, HTTPException
 from fastapi import status
+from starlette.datastructures import UploadFile as StarletteUploadFile
 from starlette.formparsers import MultiPartException
 
-from src.parsers import TargetFileMultipartParser
+from src.metrics import MULTIPART_PARSE
+from src.parsers import TargetFileMultipartParser, UploadRejected, get_content_length
+from src.settings import settings
+from src.storages.space import InsufficientStorage, space_ledger
 
 
-async def parse_files_from_request(request: Request) -> Tuple[UploadFile, ...]:
+async def parse_files_from_request(
+        request: Request,
+        max_files: int = settings.MAX_FILES_PER_UPLOAD
+) -> Tuple[UploadFile, ...]:
     try:
-        parser = TargetFileMultipartParser(request.headers, request.stream())
-        form_data = await parser.parse()
-        files = tuple(form_data.values())
+        # Content-Length is an upper bound of the files in the request
+        reservation = space_ledger.reserve(get_content_length(request.headers) or 0)
+    except InsufficientStorage as e:
+        raise HTTPException(status_code=e.status_code, detail=e.message)
+    try:
+        with reservation:
+            parser = TargetFileMultipartParser(
+                request.headers, request.stream(), max_files=max_files, reservation=reservation
+            )
+            with MULTIPART_PARSE.time():
+                form_data = await parser.parse()
+        files = tuple(value for _, value in form_data.multi_items() if isinstance(value, StarletteUploadFile))
+    except UploadRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.message)
     except MultiPartException:
         raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail='Unable to parse file(s)')
+    if not files:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail='No files in the request')
     return files
+
+
+def files_from_request(max_files: int = settings.MAX_FILES_PER_UPLOAD):
+    async def inner(request: Request) -> Tuple[UploadFile, ...]:
+        return await parse_files_from_request(request, max_files=max_files)
+
+    return inner
+
+
+async def limit_stream(stream: AsyncIterator[bytes], limit: int) -> AsyncIterator[bytes]:
+    received = 0
+    async for chunk in stream:
+        received += len(chunk)
+        if received > limit:
+            raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail='Upload length exceeded')
+        yield chunk